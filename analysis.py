@@ -0,0 +1,101 @@
+"""
+analysis.py - Анализ сигналов в пуле процессов (вне event loop)
+"""
+import pickle
+import asyncio
+import logging
+import multiprocessing
+from typing import Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config import ANALYSIS_WORKERS, ANALYSIS_BATCH_SIZE
+from indicators import CANDLES, analyze_batch, analyze_pickled
+
+logger = logging.getLogger(__name__)
+
+class AnalysisExecutor:
+    """Отправляет снимки свечей пачками в ProcessPoolExecutor.
+
+    При workers=0 (или если пул не поднялся/упал) анализ идёт inline,
+    с передачей управления event loop между пачками.
+
+    Воркеры запускаются через forkserver (или spawn): fork процесса с
+    потоками aiosqlite и httpx может унаследовать захваченные блокировки.
+    """
+    def __init__(self, workers: int = ANALYSIS_WORKERS, batch_size: int = ANALYSIS_BATCH_SIZE):
+        self.workers = workers
+        self.batch_size = batch_size
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def inline(self) -> bool:
+        return self._pool is None
+
+    def start(self):
+        if self.workers <= 0 or self._pool is not None:
+            return
+        try:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context(method))
+            logger.info(f"Analysis pool started with {self.workers} workers")
+        except (OSError, NotImplementedError) as e:
+            logger.warning(f"Analysis pool unavailable, falling back to inline: {e}")
+            self._pool = None
+
+    def shutdown(self):
+        """Остановить пул (блокирует до конца текущих задач - вызывать вне event loop)"""
+        pool, self._pool = self._pool, None  # новые пачки - уже inline
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _batches(self, items: list) -> List[list]:
+        return [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+
+    async def _run_inline(self, pairs: List[str]) -> Dict[str, Dict]:
+        results = {}
+        for batch in self._batches(pairs):
+            snapshots = [
+                (pair, CANDLES.get_state(pair), CANDLES.get_column(pair, "c"))
+                for pair in batch
+            ]
+            for pair, signal in analyze_batch(snapshots):
+                if signal:
+                    results[pair] = signal
+            await asyncio.sleep(0)
+        return results
+
+    async def analyze(self, pairs: List[str]) -> Dict[str, Dict]:
+        """Проанализировать пары, вернуть {pair: signal} только для найденных сигналов"""
+        if not pairs:
+            return {}
+        if self.inline:
+            return await self._run_inline(pairs)
+
+        # Сериализуем снимки сразу: одна копия, согласованная с текущим состоянием
+        loop = asyncio.get_running_loop()
+        payloads = [
+            pickle.dumps([CANDLES.snapshot(pair) for pair in batch], pickle.HIGHEST_PROTOCOL)
+            for batch in self._batches(pairs)
+        ]
+        futures = [
+            loop.run_in_executor(self._pool, analyze_pickled, payload)
+            for payload in payloads
+        ]
+        try:
+            batches = await asyncio.gather(*futures)
+        except BrokenProcessPool as e:
+            logger.error(f"Analysis pool broken, switching to inline: {e}")
+            await loop.run_in_executor(None, self.shutdown)
+            return await self._run_inline(pairs)
+
+        return {
+            pair: signal
+            for batch in batches
+            for pair, signal in batch
+            if signal
+        }
+
+# Глобальный исполнитель анализа
+ANALYZER = AnalysisExecutor()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+bench_database.py - Пропускная способность записи в БД при рассылке
+Запуск: python bench_database.py [строк] [параллельных отправителей]
+
+Сравнивает три способа записать лог рассылки signals_sent:
+  1. как раньше - пул из 5 соединений, коммит на каждую строку;
+  2. очередь записи DBPool - операции объединяются в group commit;
+  3. буфер SignalLogWriter поверх очереди - executemany пачками.
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import aiosqlite
+
+import database
+from database import DBPool, SignalLogWriter, INIT_SQL
+
+INSERT_SQL = "INSERT INTO signals_sent(user_id, pair, side, price, score, sent_ts) VALUES(?,?,?,?,?,?)"
+
+async def fan_out(rows: int, senders: int, write_one):
+    """rows записей от senders параллельных отправителей"""
+    queue = asyncio.Queue()
+    for uid in range(rows):
+        queue.put_nowait(uid)
+    
+    async def sender():
+        while not queue.empty():
+            uid = queue.get_nowait()
+            await write_one(uid)
+            await asyncio.sleep(0)  # отправка сообщения
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(senders)))
+    return time.perf_counter() - started
+
+async def bench_commit_per_row(path: str, rows: int, senders: int):
+    pool = asyncio.Queue()
+    conns = []
+    for _ in range(5):
+        conn = await aiosqlite.connect(path, timeout=30)
+        conns.append(conn)
+        pool.put_nowait(conn)
+    await conns[0].executescript(INIT_SQL)
+    
+    async def write_one(uid: int):
+        conn = await pool.get()
+        try:
+            await conn.execute(INSERT_SQL, (uid, "BENCHUSDT", "LONG", 1.0, 80, int(time.time())))
+            await conn.commit()
+        finally:
+            pool.put_nowait(conn)
+    
+    try:
+        elapsed = await fan_out(rows, senders, write_one)
+    finally:
+        for conn in conns:
+            await conn.close()
+    return elapsed, rows
+
+async def bench_write_queue(path: str, rows: int, senders: int):
+    database.db_pool = DBPool(path)
+    await database.db_pool.init()
+    
+    async def write_one(uid: int):
+        await database.db_pool.write((INSERT_SQL, (uid, "BENCHUSDT", "LONG", 1.0, 80, int(time.time()))))
+    
+    try:
+        elapsed = await fan_out(rows, senders, write_one)
+        return elapsed, database.db_pool.commits
+    finally:
+        await database.db_pool.close()
+
+async def bench_signal_log(path: str, rows: int, senders: int):
+    database.db_pool = DBPool(path)
+    await database.db_pool.init()
+    writer = SignalLogWriter()
+    
+    async def write_one(uid: int):
+        await writer.add(uid, "BENCHUSDT", "LONG", 1.0, 80)
+    
+    try:
+        elapsed = await fan_out(rows, senders, write_one)
+        started = time.perf_counter()
+        await writer.flush()
+        return elapsed + time.perf_counter() - started, database.db_pool.commits
+    finally:
+        await database.db_pool.close()
+
+async def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    senders = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    
+    print("=" * 60)
+    print(f"📊 ЗАПИСЬ ЛОГА РАССЫЛКИ: {rows} строк, {senders} отправителей")
+    print("=" * 60)
+    
+    benches = [
+        ("Коммит на строку (5 соединений)", bench_commit_per_row),
+        ("Очередь записи (group commit)", bench_write_queue),
+        ("SignalLogWriter (executemany)", bench_signal_log),
+    ]
+    for name, bench in benches:
+        with tempfile.TemporaryDirectory() as tmp:
+            elapsed, commits = await bench(os.path.join(tmp, "bench.db"), rows, senders)
+        print(f"{name:34s} {elapsed:7.2f}s  {rows / elapsed:9.0f} строк/с  коммитов: {commits}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,181 @@
+"""
+broadcasts.py - Фоновые рассылки администратора (пагинация, прогресс, пауза/отмена)
+"""
+import time
+import asyncio
+import logging
+from typing import Dict, Optional
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.exceptions import TelegramAPIError
+
+from config import BROADCAST_PAGE, BROADCAST_PROGRESS_INTERVAL, t
+from database import (
+    get_user_lang, get_reachable_users_count, get_user_ids_page,
+    create_broadcast, get_broadcast, get_broadcasts, save_broadcast_progress, set_broadcast_status
+)
+from dispatcher import DISPATCHER, PRIORITY_BROADCAST, SENT
+
+logger = logging.getLogger(__name__)
+
+RUNNING, PAUSED, CANCELLED, DONE = "running", "paused", "cancelled", "done"
+
+def progress_kb(bid: int, status: str, lang: str) -> Optional[InlineKeyboardMarkup]:
+    """Кнопки управления рассылкой (для завершённой - без кнопок)"""
+    if status not in (RUNNING, PAUSED):
+        return None
+    kb = InlineKeyboardMarkup(row_width=2)
+    if status == RUNNING:
+        first = InlineKeyboardButton(t(lang, "btn_pause"), callback_data=f"bc_pause_{bid}")
+    else:
+        first = InlineKeyboardButton(t(lang, "btn_resume"), callback_data=f"bc_resume_{bid}")
+    kb.add(first, InlineKeyboardButton(t(lang, "btn_cancel"), callback_data=f"bc_cancel_{bid}"))
+    return kb
+
+class BroadcastManager:
+    """Рассылки как фоновые задания.
+
+    Получатели читаются из БД страницами по page_size и отправляются через
+    DISPATCHER с низким приоритетом, поэтому сигналы не ждут рассылку.
+    Позиция сохраняется после каждой страницы: пауза, отмена и рестарт
+    бота продолжают задание с того же места.
+    """
+    def __init__(self, page_size: int = BROADCAST_PAGE,
+                 progress_interval: float = BROADCAST_PROGRESS_INTERVAL, dispatcher=DISPATCHER):
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.dispatcher = dispatcher
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self._requests: Dict[int, str] = {}  # запрошенная пауза/отмена
+
+    async def start(self, bot: Bot, admin_id: int, chat_id: int, text: str) -> int:
+        """Создать задание, отправить сообщение о прогрессе и запустить рассылку"""
+        total = await get_reachable_users_count()
+        bid = await create_broadcast(admin_id, chat_id, text, total)
+        job = await get_broadcast(bid)
+        lang = await get_user_lang(admin_id)
+        message = await bot.send_message(chat_id, self.render(job, lang), reply_markup=progress_kb(bid, RUNNING, lang))
+        await set_broadcast_status(bid, RUNNING, message_id=message.message_id)
+        self._spawn(bot, bid)
+        return bid
+
+    def render(self, job: dict, lang: str) -> str:
+        return t(lang, "broadcast_progress", bid=job["id"], status=t(lang, f"broadcast_{job['status']}"),
+                 sent=job["sent"], failed=job["failed"], done=job["sent"] + job["failed"], total=job["total"])
+
+    async def show_progress(self, bot: Bot, job: dict):
+        """Обновить сообщение о прогрессе у администратора"""
+        if not job.get("message_id"):
+            return
+        lang = await get_user_lang(job["admin_id"])
+        try:
+            await bot.edit_message_text(self.render(job, lang), job["chat_id"], job["message_id"],
+                                        reply_markup=progress_kb(job["id"], job["status"], lang))
+        except TelegramAPIError:
+            pass
+
+    def _spawn(self, bot: Bot, bid: int):
+        if bid in self.tasks:
+            return
+        task = asyncio.create_task(self._run(bot, bid))
+        self.tasks[bid] = task
+        task.add_done_callback(lambda _: self.tasks.pop(bid, None))
+
+    async def _run(self, bot: Bot, bid: int):
+        job = await get_broadcast(bid)
+        last_edit = time.monotonic()
+        try:
+            while True:
+                requested = self._requests.pop(bid, None)
+                if requested:
+                    job["status"] = requested
+                    break
+                ids = await get_user_ids_page(job["cursor"], self.page_size)
+                if not ids:
+                    job["status"] = DONE
+                    break
+                
+                futures = self.dispatcher.enqueue_many(ids, job["text"], priority=PRIORITY_BROADCAST,
+                                                       disable_web_page_preview=True)
+                results = await asyncio.gather(*futures, return_exceptions=True)
+                sent = sum(1 for r in results if r == SENT)
+                job["sent"] += sent
+                job["failed"] += len(ids) - sent
+                job["cursor"] = ids[-1]
+                await save_broadcast_progress(bid, job["cursor"], job["sent"], job["failed"])
+                
+                if time.monotonic() - last_edit >= self.progress_interval:
+                    last_edit = time.monotonic()
+                    await self.show_progress(bot, job)
+        except Exception as e:
+            # Ставим на паузу: админ увидит статус и продолжит задание кнопкой
+            logger.error(f"Broadcast {bid} error, paused: {e}")
+            job["status"] = PAUSED
+        
+        try:
+            await set_broadcast_status(bid, job["status"])
+            await self.show_progress(bot, job)
+        except Exception as e:
+            logger.error(f"Broadcast {bid} status update failed: {e}")
+        logger.info(f"Broadcast {bid} {job['status']}: {job['sent']}/{job['total']}")
+
+    async def pause(self, bot: Bot, bid: int) -> bool:
+        return await self._request(bot, bid, PAUSED)
+
+    async def cancel(self, bot: Bot, bid: int) -> bool:
+        return await self._request(bot, bid, CANCELLED)
+
+    async def _request(self, bot: Bot, bid: int, status: str) -> bool:
+        """Пауза/отмена: идущее задание остановится после текущей страницы"""
+        if bid in self.tasks:
+            self._requests[bid] = status
+            return True
+        job = await get_broadcast(bid)
+        if job is None or job["status"] not in (RUNNING, PAUSED):
+            return False
+        if job["status"] != status:
+            await set_broadcast_status(bid, status)
+            job["status"] = status
+            await self.show_progress(bot, job)
+        return True
+
+    async def resume(self, bot: Bot, bid: int) -> bool:
+        """Продолжить задание на паузе (или зависшее после рестарта)"""
+        job = await get_broadcast(bid)
+        if job is None or job["status"] not in (RUNNING, PAUSED):
+            return False
+        self._requests.pop(bid, None)
+        if job["status"] == PAUSED:
+            await set_broadcast_status(bid, RUNNING)
+            job["status"] = RUNNING
+            await self.show_progress(bot, job)
+        self._spawn(bot, bid)
+        return True
+
+    async def resume_all(self, bot: Bot) -> int:
+        """После рестарта: продолжить все незавершённые задания"""
+        jobs = await get_broadcasts(RUNNING)
+        for job in jobs:
+            self._spawn(bot, job["id"])
+        return len(jobs)
+
+    async def stop(self, timeout: float = 30.0):
+        """Остановить задания после текущей страницы (её позиция сохраняется).
+
+        Задания остаются running и продолжатся после рестарта. Не успевшие
+        за timeout отменяются - их последняя страница будет отправлена снова.
+        """
+        tasks = list(self.tasks.values())
+        if not tasks:
+            return
+        for bid in self.tasks:
+            self._requests[bid] = RUNNING
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logger.warning(f"{len(pending)} broadcasts cancelled mid-page on shutdown")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+# Глобальный менеджер рассылок
+BROADCASTS = BroadcastManager()
@@ -0,0 +1,240 @@
+"""
+candle_archive.py - Бинарный архив свечей (файл на пару и таймфрейм, чтение через mmap)
+
+Формат файла: заголовок 32 байта (magic, версия, таймфрейм, размер записи),
+далее записи фиксированной длины - 6 double (ts, o, h, l, c, v).
+"""
+import os
+import mmap
+import struct
+import logging
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+from config import CANDLE_ARCHIVE_DIR, CANDLE_TF
+from indicators import CANDLE_FIELDS, CandleStorage
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"AEBCNDL1"
+VERSION = 1
+HEADER = struct.Struct("<8sIII12x")  # magic, version, tf, record_size
+RECORD = struct.Struct("<" + "d" * len(CANDLE_FIELDS))
+
+class CandleArchive:
+    """Архив закрытых свечей: append при закрытии, загрузка через mmap без копий"""
+    def __init__(self, directory: str = CANDLE_ARCHIVE_DIR, tf: int = CANDLE_TF):
+        self.directory = directory
+        self.tf = tf
+        self._maps: Dict[str, Tuple[object, mmap.mmap]] = {}
+
+    def path(self, pair: str) -> str:
+        return os.path.join(self.directory, f"{pair.upper()}_{self.tf}.bin")
+
+    def pairs(self) -> List[str]:
+        """Пары, для которых есть архив текущего таймфрейма"""
+        if not os.path.isdir(self.directory):
+            return []
+        suffix = f"_{self.tf}.bin"
+        return sorted(name[:-len(suffix)] for name in os.listdir(self.directory) if name.endswith(suffix))
+
+    def _header(self) -> bytes:
+        return HEADER.pack(MAGIC, VERSION, self.tf, RECORD.size)
+
+    def repair(self, pair: str) -> int:
+        """Проверить файл и отрезать недописанный хвост; вернуть число записей"""
+        path = self.path(pair)
+        size = os.path.getsize(path)
+        with open(path, "r+b") as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+                logger.warning(f"Candle archive {path}: bad header, resetting")
+                f.seek(0)
+                f.write(self._header())
+                f.truncate(HEADER.size)
+                return 0
+            _, _, tf, record_size = HEADER.unpack(header)
+            if tf != self.tf or record_size != RECORD.size:
+                raise ValueError(f"Candle archive {path}: tf/record mismatch ({tf}, {record_size})")
+
+            count = (size - HEADER.size) // RECORD.size
+            # Последняя запись могла быть записана частично или с мусором
+            while count > 0:
+                f.seek(HEADER.size + (count - 1) * RECORD.size)
+                ts = RECORD.unpack(f.read(RECORD.size))[0]
+                if count > 1:
+                    f.seek(HEADER.size + (count - 2) * RECORD.size)
+                    prev_ts = RECORD.unpack(f.read(RECORD.size))[0]
+                else:
+                    prev_ts = -1.0
+                if np.isfinite(ts) and ts > prev_ts and ts % self.tf == 0:
+                    break
+                count -= 1
+            expected = HEADER.size + count * RECORD.size
+            if expected != size:
+                logger.warning(f"Candle archive {path}: repaired tail ({size} -> {expected} bytes)")
+                f.truncate(expected)
+            return count
+
+    def open(self, pair: str) -> np.ndarray:
+        """Отобразить архив пары в память: массив (N x 6) без копирования"""
+        pair = pair.upper()
+        self.close(pair)
+        if not os.path.exists(self.path(pair)):
+            return np.empty((0, len(CANDLE_FIELDS)))
+        count = self.repair(pair)
+        if count == 0:
+            return np.empty((0, len(CANDLE_FIELDS)))
+
+        f = open(self.path(pair), "rb")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[pair] = (f, mm)
+        return np.frombuffer(mm, dtype="<f8", count=count * len(CANDLE_FIELDS),
+                             offset=HEADER.size).reshape(count, len(CANDLE_FIELDS))
+
+    def close(self, pair: Optional[str] = None):
+        """Снять отображения (все или одной пары)"""
+        for key in ([pair.upper()] if pair else list(self._maps)):
+            f, mm = self._maps.pop(key, (None, None))
+            if mm is not None:
+                try:
+                    mm.close()
+                except BufferError:
+                    # На mmap ещё ссылаются массивы - закроется вместе с ними
+                    pass
+                f.close()
+
+    def append(self, pair: str, candles: List[dict]) -> int:
+        """Дописать закрытые свечи. Свеча с тем же ts, что последняя в файле,
+        перезаписывает её; более старые (догрузка пропусков) вливаются через merge().
+        Возвращает число записанных.
+        """
+        if not candles:
+            return 0
+        pair = pair.upper()
+        path = self.path(pair)
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(self._header())
+            count = 0
+        else:
+            count = self.repair(pair)
+
+        with open(path, "r+b") as f:
+            last_ts = None
+            if count:
+                f.seek(HEADER.size + (count - 1) * RECORD.size)
+                last_ts = RECORD.unpack(f.read(RECORD.size))[0]
+
+            written = 0
+            older = []
+            for candle in sorted(candles, key=lambda c: c["ts"]):
+                ts = float(candle["ts"])
+                if last_ts is not None and ts < last_ts:
+                    older.append(candle)
+                    continue
+                if last_ts is not None and ts == last_ts:
+                    f.seek(HEADER.size + (count - 1) * RECORD.size)
+                else:
+                    f.seek(HEADER.size + count * RECORD.size)
+                    count += 1
+                f.write(RECORD.pack(*(float(candle[name]) for name in CANDLE_FIELDS)))
+                last_ts = ts
+                written += 1
+            f.flush()
+            os.fsync(f.fileno())
+        if older:
+            self.merge(pair, older)
+            written += len(older)
+        return written
+
+    def range(self, pair: str) -> Optional[Tuple[int, int, int]]:
+        """(first_ts, last_ts, count) архива пары или None"""
+        rows = self.open(pair)
+        result = (int(rows[0, 0]), int(rows[-1, 0]), len(rows)) if len(rows) else None
+        del rows
+        self.close(pair)
+        return result
+
+    def merge(self, pair: str, candles: List[dict]) -> int:
+        """Влить свечи в любое место архива (импорт истории назад по времени).
+
+        Файл переписывается целиком во временный и атомарно подменяется,
+        поэтому обрыв не портит уже сохранённые данные. Возвращает число записей.
+        """
+        pair = pair.upper()
+        existing = self.open(pair)
+        merged = {int(row[0]): row.tolist() for row in existing}
+        del existing
+        self.close(pair)
+        for candle in candles:
+            merged[int(candle["ts"])] = [float(candle[name]) for name in CANDLE_FIELDS]
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(pair)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self._header())
+            f.write(b"".join(RECORD.pack(*merged[ts]) for ts in sorted(merged)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return len(merged)
+
+    def compact(self, pair: str, keep: int) -> int:
+        """Оставить в архиве пары последние keep записей; вернуть число удалённых.
+
+        Файл переписывается, только когда лишних записей набралось больше
+        четверти keep, - иначе каждая новая свеча переписывала бы весь архив.
+        """
+        pair = pair.upper()
+        rows = self.open(pair)
+        excess = len(rows) - keep
+        if excess <= keep // 4:
+            del rows
+            self.close(pair)
+            return 0
+        tail = rows[-keep:].tobytes() if keep > 0 else b""
+        del rows
+        self.close(pair)
+
+        path = self.path(pair)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self._header())
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return excess
+
+    def compact_all(self, keep: int, depths: Optional[Dict[str, int]] = None) -> int:
+        """Сжать архивы всех пар; для пар с импортированной историей
+        хранится не меньше её глубины. Возвращает число удалённых записей.
+        """
+        depths = depths or {}
+        return sum(self.compact(pair, max(keep, depths.get(pair, 0))) for pair in self.pairs())
+
+    def append_rows(self, rows: List[Tuple[str, dict]]) -> int:
+        """Дописать пачку (pair, candle) из CandleStorage.drain_pending()"""
+        by_pair: Dict[str, List[dict]] = {}
+        for pair, candle in rows:
+            by_pair.setdefault(pair, []).append(candle)
+        return sum(self.append(pair, candles) for pair, candles in by_pair.items())
+
+    def load_into(self, storage: CandleStorage) -> int:
+        """Загрузить хвосты архивов всех пар в хранилище; вернуть число свечей.
+
+        В load_array уходит view на mmap - записи не копируются в dict по одной.
+        """
+        total = 0
+        for pair in self.pairs():
+            rows = self.open(pair)
+            tail = rows[-(storage.maxlen + 1):]
+            if len(tail):
+                storage.load_array(pair, tail)
+                total += len(tail)
+            del rows, tail
+            self.close(pair)
+        return total
@@ -9,8 +9,32 @@ BOT_NAME = os.getenv("BOT_NAME", "Alpha Entry Bot")
 SUPPORT_URL = os.getenv("SUPPORT_URL", "https://t.me/support")
 ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()}
 DB_PATH = os.getenv("DB_PATH", "bot.db")
+DB_READERS = 4                  # Соединений только для чтения (запись - одно отдельное)
+DB_WRITE_BATCH = 500            # Максимум операций записи в одной транзакции
+SIGNAL_LOG_BATCH = 500          # Записей signals_sent в одной транзакции
+SIGNAL_LOG_FLUSH_INTERVAL = 2.0  # Максимальная задержка записи лога сигналов (сек)
+USER_CACHE_TTL = 300            # Время жизни профиля пользователя в кэше (сек)
+USER_CACHE_SIZE = 50000         # Максимум профилей в кэше
+OUTBOX_BATCH = 100              # Строк outbox, забираемых на доставку за раз
+OUTBOX_POLL_INTERVAL = 5.0      # Проверка outbox, если новых сообщений не было (сек)
+OUTBOX_RETENTION = 3 * 86400    # Сколько хранить доставленные сообщения (сек)
+OUTBOX_RETRY_DELAY = 30         # Пауза перед повтором после временной ошибки (удваивается)
+OUTBOX_MAX_ATTEMPTS = 5         # Попыток доставки, после которых строка считается недоставленной
+BROADCAST_PAGE = 200            # Получателей рассылки, читаемых из БД за раз
+BROADCAST_PROGRESS_INTERVAL = 5.0  # Как часто обновлять прогресс у админа (сек)
 
 # ==================== TRADING SETTINGS ====================
+BINANCE_API_URL = os.getenv("BINANCE_API_URL", "https://api.binance.com")
+BINANCE_WS_URL = os.getenv("BINANCE_WS_URL", "wss://stream.binance.com:9443")
+
+# Источник рыночных данных:
+#   "rest"   - опрос ticker/24hr, свечи синтезируются из снимков цены
+#   "klines" - свечи биржи (запрос на пару на закрытие и для открытой свечи раз в CHECK_INTERVAL)
+#   "ws"     - стримы kline/miniTicker
+MARKET_DATA_MODE = os.getenv("MARKET_DATA_MODE", "rest")
+WS_STREAMS_PER_CONNECTION = 400  # Binance: до 1024 стримов на соединение
+WS_RECONCILE_INTERVAL = 30       # Сверка подписок с парами пользователей (сек)
+
 # Дефолтные монеты
 DEFAULT_PAIRS = ["BTCUSDT", "ETHUSDT", "TONUSDT"]
 
@@ -46,6 +70,14 @@ else:  # 4h и больше
     CHECK_INTERVAL = 900  # Проверять каждые 15 минут
 
 MAX_CANDLES = 300  # Максимум свечей в истории
+CANDLE_FLUSH_INTERVAL = 10  # Запись закрытых свечей в БД пачками раз в N секунд
+CANDLE_RETENTION = MAX_CANDLES * 2  # Свечей пары, хранимых в БД (не меньше глубины импорта истории)
+CANDLE_PRUNE_INTERVAL = 3600  # Очистка старых свечей в БД раз в N секунд
+GAP_SCAN_INTERVAL = max(CANDLE_TF, 900)  # Поиск и догрузка пропущенных свечей
+KLINE_RETRY_DELAY = max(5, CANDLE_TF // 60)  # Минимальная пауза перед повтором klines пары (сек)
+# Хранилище свечей: "sqlite" (таблица candles) или "mmap" (бинарные файлы на пару)
+CANDLE_STORE = os.getenv("CANDLE_STORE", "sqlite").lower()
+CANDLE_ARCHIVE_DIR = os.getenv("CANDLE_ARCHIVE_DIR", "candles")
 
 # ==================== INDICATORS ====================
 EMA_FAST = 9
@@ -71,8 +103,22 @@ SIGNAL_COOLDOWN = CANDLE_TF * 6  # 6 свечей между сигналами
 
 # ==================== OPTIMIZATION ====================
 PRICE_CACHE_TTL = 30       # Кэш цен на 30 секунд
-BATCH_SEND_SIZE = 30       # Отправлять группами по 30
-BATCH_SEND_DELAY = 0.05    # Задержка между сообщениями
+BULK_TICKER_MAX_SYMBOLS = 100  # До стольких пар - symbols=[...], больше - все тикеры
+HTTP_MAX_CONNECTIONS = 20  # Размер пула соединений общего HTTP-клиента
+HTTP_CONCURRENCY = 10      # Одновременных поштучных запросов к Binance
+IMPORT_CONCURRENCY = 5     # Пар, импортируемых одновременно (import_history_tf.py)
+IMPORT_WEIGHT_PER_MINUTE = 2400  # Бюджет веса запросов импорта в минуту (лимит Binance 6000)
+SEND_WORKERS = 16          # Параллельных отправителей в диспетчере рассылки
+SEND_RATE = 30             # Сообщений в секунду на бота (лимит Telegram ~30)
+SEND_CHAT_INTERVAL = 1.0   # Не чаще одного сообщения в секунду в один чат
+SEND_MAX_RETRIES = 3       # Повторов одного сообщения после RetryAfter
+SEND_MIN_RATE = 5          # Нижняя граница скорости после снижений из-за флуда
+FLOOD_BACKOFF = 0.5        # Во сколько раз снижать скорость при RetryAfter
+FLOOD_RECOVERY_INTERVAL = 10  # Секунд без флуда на каждый +1 msg/s к скорости
+
+# Анализ сигналов в пуле процессов (0 - считать прямо в event loop)
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+ANALYSIS_BATCH_SIZE = 50   # Пар в одной задаче для воркера
 
 # ==================== IMAGES ====================
 IMG_START = os.getenv("IMG_START", "")
@@ -149,14 +195,23 @@ TEXTS = {
         
         # Админ панель
         "admin_title": "👑 <b>Админ-панель</b>",
-        "admin_stats": "📊 <b>Статистика</b>\n\n👥 Всего: {total}\n💎 Оплативших: {paid}\n📈 Активных: {active}",
+        "admin_stats": "📊 <b>Статистика</b>\n\n👥 Всего: {total}\n💎 Оплативших: {paid}\n📈 Активных: {active}\n\n🗄 Кэш профилей: {cache_hits} попаданий / {cache_misses} промахов",
         "admin_send_broadcast": "📢 Отправь текст рассылки",
         "admin_send_user_id": "✅ Отправь ID пользователя",
         "admin_send_amount": "Отправь сумму",
         "admin_invalid_id": "❌ ID должен быть числом",
         "admin_access_granted": "✅ Доступ выдан: {uid}",
         "admin_balance_added": "✅ Начислено ${amount:.2f} → {uid}",
-        "admin_broadcast_done": "✅ Разослано: {sent}/{total}",
+        "broadcast_progress": "📢 <b>Рассылка #{bid}</b>\n\n{status}\n\nОтправлено: {sent}\nНе доставлено: {failed}\nПрогресс: {done}/{total}",
+        "broadcast_running": "⏳ Идёт",
+        "broadcast_paused": "⏸ На паузе",
+        "broadcast_cancelled": "✖️ Отменена",
+        "broadcast_done": "✅ Завершена",
+        "broadcast_not_found": "❌ Рассылка не найдена или уже завершена",
+        "broadcast_cmd_format": "❌ Формат: /broadcast_cancel ID или /broadcast_resume ID",
+        "btn_pause": "⏸ Пауза",
+        "btn_resume": "▶️ Продолжить",
+        "btn_cancel": "✖️ Отменить",
         "admin_no_access": "❌ Нет доступа",
         
         # Язык
@@ -229,14 +284,23 @@ TEXTS = {
         
         # Admin panel
         "admin_title": "👑 <b>Admin Panel</b>",
-        "admin_stats": "📊 <b>Statistics</b>\n\n👥 Total: {total}\n💎 Paid: {paid}\n📈 Active: {active}",
+        "admin_stats": "📊 <b>Statistics</b>\n\n👥 Total: {total}\n💎 Paid: {paid}\n📈 Active: {active}\n\n🗄 Profile cache: {cache_hits} hits / {cache_misses} misses",
         "admin_send_broadcast": "📢 Send broadcast message",
         "admin_send_user_id": "✅ Send user ID",
         "admin_send_amount": "Send amount",
         "admin_invalid_id": "❌ ID must be a number",
         "admin_access_granted": "✅ Access granted: {uid}",
         "admin_balance_added": "✅ Added ${amount:.2f} → {uid}",
-        "admin_broadcast_done": "✅ Sent: {sent}/{total}",
+        "broadcast_progress": "📢 <b>Broadcast #{bid}</b>\n\n{status}\n\nSent: {sent}\nFailed: {failed}\nProgress: {done}/{total}",
+        "broadcast_running": "⏳ Running",
+        "broadcast_paused": "⏸ Paused",
+        "broadcast_cancelled": "✖️ Cancelled",
+        "broadcast_done": "✅ Finished",
+        "broadcast_not_found": "❌ Broadcast not found or already finished",
+        "broadcast_cmd_format": "❌ Format: /broadcast_cancel ID or /broadcast_resume ID",
+        "btn_pause": "⏸ Pause",
+        "btn_resume": "▶️ Resume",
+        "btn_cancel": "✖️ Cancel",
         "admin_no_access": "❌ No access",
         
         # Language
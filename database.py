@@ -1,14 +1,18 @@
 """
 database.py - Работа с базой данных
 """
+import json
 import time
 import asyncio
 import logging
-from typing import List
-from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from collections import OrderedDict, defaultdict
 import aiosqlite
 
-from config import DB_PATH
+from config import (
+    DB_PATH, DB_READERS, DB_WRITE_BATCH, SIGNAL_LOG_BATCH, SIGNAL_LOG_FLUSH_INTERVAL,
+    USER_CACHE_TTL, USER_CACHE_SIZE
+)
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +29,7 @@ CREATE TABLE IF NOT EXISTS users (
     balance REAL DEFAULT 0,
     paid INTEGER DEFAULT 0,
     language TEXT DEFAULT 'ru',
+    status TEXT NOT NULL DEFAULT 'active',
     created_ts INTEGER NOT NULL
 );
 
@@ -44,93 +49,484 @@ CREATE TABLE IF NOT EXISTS signals_sent (
     sent_ts INTEGER NOT NULL
 );
 
+CREATE TABLE IF NOT EXISTS candles (
+    pair TEXT NOT NULL,
+    tf INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    o REAL NOT NULL,
+    h REAL NOT NULL,
+    l REAL NOT NULL,
+    c REAL NOT NULL,
+    v REAL NOT NULL,
+    PRIMARY KEY (pair, tf, ts)
+) WITHOUT ROWID;
+
+-- Глубина истории, запрошенная import_history_tf.py: очистка её не удаляет
+CREATE TABLE IF NOT EXISTS candle_depth (
+    pair TEXT NOT NULL,
+    tf INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (pair, tf)
+) WITHOUT ROWID;
+
+-- Исходящие сообщения: текст один раз, получатели - строками outbox
+CREATE TABLE IF NOT EXISTS outbox_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    pair TEXT,
+    side TEXT,
+    price REAL,
+    score INTEGER,
+    text TEXT NOT NULL,
+    created_ts INTEGER NOT NULL
+);
+
+-- status: 0 - ожидает, 1 - отправлено, 2 - не доставлено
+-- attempts/next_ts: временные ошибки, повтор не раньше next_ts
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_ts INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS signal_cooldowns (
+    pair TEXT NOT NULL,
+    side TEXT NOT NULL,
+    last_ts INTEGER NOT NULL,
+    PRIMARY KEY (pair, side)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    admin_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    cursor INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    created_ts INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(id) WHERE status = 0;
+CREATE INDEX IF NOT EXISTS idx_outbox_message ON outbox(message_id);
+CREATE INDEX IF NOT EXISTS idx_outbox_messages_ts ON outbox_messages(created_ts);
 CREATE INDEX IF NOT EXISTS idx_signals_pair_ts ON signals_sent(pair, sent_ts);
 CREATE INDEX IF NOT EXISTS idx_user_pairs_user ON user_pairs(user_id);
 CREATE INDEX IF NOT EXISTS idx_users_paid ON users(paid);
 """
 
+# Колонки, добавленные в уже существующие таблицы: (таблица, колонка, определение)
+MIGRATIONS = [
+    ("users", "status", "TEXT NOT NULL DEFAULT 'active'"),
+    ("outbox", "attempts", "INTEGER NOT NULL DEFAULT 0"),
+    ("outbox", "next_ts", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+# Статусы пользователя: active - доставка идёт, остальные - чат недоступен
+USER_ACTIVE = "active"
+
+# Читающие соединения: запись запрещена на уровне SQLite
+READER_SQL = """
+PRAGMA query_only=ON;
+PRAGMA cache_size=10000;
+PRAGMA temp_store=MEMORY;
+"""
+
 # ==================== DATABASE POOL ====================
 class DBPool:
-    """Пул соединений к БД"""
-    def __init__(self, path: str, pool_size: int = 5):
+    """Пул соединений к БД: один писатель и несколько читателей.
+
+    Чтение - через acquire()/release() из пула соединений с query_only.
+    Запись - через write()/write_many(): операции встают в очередь, а
+    единственное пишущее соединение применяет их пачками, по одной
+    транзакции (group commit) на пачку. Каждая операция выполняется
+    в своём SAVEPOINT, поэтому ошибка в одной не откатывает соседние.
+    """
+    def __init__(self, path: str, pool_size: int = DB_READERS, batch_size: int = DB_WRITE_BATCH):
         self.path = path
         self.pool_size = pool_size
+        self.batch_size = batch_size
         self._pool: List[aiosqlite.Connection] = []
         self._available = asyncio.Queue()
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writes: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
         self._initialized = False
+        self.commits = 0
+        self.write_ops = 0
     
     async def init(self):
         if self._initialized:
             return
         
+        # Писатель в autocommit-режиме: транзакциями управляем сами
+        self._writer = await aiosqlite.connect(self.path, isolation_level=None)
+        self._writer.row_factory = aiosqlite.Row
+        await self._writer.executescript(INIT_SQL)
+        await self._migrate()
+        
         for _ in range(self.pool_size):
             conn = await aiosqlite.connect(self.path)
             conn.row_factory = aiosqlite.Row
+            await conn.executescript(READER_SQL)
             self._pool.append(conn)
             await self._available.put(conn)
         
-        conn = await self.acquire()
-        try:
-            await conn.executescript(INIT_SQL)
-            await conn.commit()
-        finally:
-            await self.release(conn)
-        
+        self._writes = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._write_loop())
         self._initialized = True
-        logger.info(f"Database pool initialized with {self.pool_size} connections")
+        logger.info(f"Database pool initialized: 1 writer, {self.pool_size} readers")
+    
+    async def _migrate(self):
+        """Добавить недостающие колонки в БД, созданную старой версией"""
+        for table, column, definition in MIGRATIONS:
+            cursor = await self._writer.execute(f"PRAGMA table_info({table})")
+            columns = {r["name"] for r in await cursor.fetchall()}
+            if column not in columns:
+                await self._writer.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                logger.info(f"Database migrated: {table}.{column}")
     
     async def acquire(self) -> aiosqlite.Connection:
+        """Соединение только для чтения"""
         return await self._available.get()
     
     async def release(self, conn: aiosqlite.Connection):
         await self._available.put(conn)
     
+    async def write(self, *statements: Tuple[str, tuple]) -> int:
+        """Выполнить (sql, params) атомарно в очереди записи; вернуть rowcount последнего"""
+        return await self._submit([(sql, params, False) for sql, params in statements])
+    
+    async def insert(self, sql: str, params: tuple) -> int:
+        """INSERT через очередь записи; вернуть lastrowid"""
+        return await self._submit([(sql, params, None)])
+    
+    async def write_many(self, sql: str, seq_params: list) -> int:
+        """executemany через очередь записи"""
+        return await self._submit([(sql, list(seq_params), True)])
+    
+    async def _submit(self, op: list) -> int:
+        if not self._initialized:
+            raise RuntimeError("Database pool is not initialized")
+        future = asyncio.get_running_loop().create_future()
+        await self._writes.put((op, future))
+        return await future
+    
+    async def _write_loop(self):
+        stopping = False
+        while not stopping:
+            batch = [await self._writes.get()]
+            while len(batch) < self.batch_size and not self._writes.empty():
+                batch.append(self._writes.get_nowait())
+            # Сигнал остановки (None) может оказаться в любом месте пачки:
+            # дописываем всё, что успели поставить в очередь, и выходим
+            if any(item is None for item in batch):
+                stopping = True
+                while not self._writes.empty():
+                    batch.append(self._writes.get_nowait())
+                batch = [item for item in batch if item is not None]
+            error: BaseException = RuntimeError("Database writer stopped")
+            try:
+                await self._apply(batch)
+            except Exception as e:
+                # Писатель не должен умирать - иначе следующие записи зависнут
+                error = e
+                logger.error(f"Database writer error ({len(batch)} ops): {e}")
+            finally:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+    
+    async def _apply(self, batch: list):
+        """Применить пачку операций одной транзакцией"""
+        if not batch:
+            return
+        conn = self._writer
+        results = []
+        try:
+            await conn.execute("BEGIN")
+            for op, future in batch:
+                await conn.execute("SAVEPOINT op")
+                try:
+                    rowcount = 0
+                    for sql, params, many in op:
+                        if many:
+                            cursor = await conn.executemany(sql, params)
+                        else:
+                            cursor = await conn.execute(sql, params)
+                        # many=None - операция из insert(), нужен id новой строки
+                        rowcount = cursor.lastrowid if many is None else cursor.rowcount
+                    await conn.execute("RELEASE op")
+                    results.append((future, rowcount, None))
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO op")
+                    await conn.execute("RELEASE op")
+                    results.append((future, None, e))
+            await conn.execute("COMMIT")
+            self.commits += 1
+            self.write_ops += len(batch)
+        except Exception as e:
+            logger.error(f"Group commit failed ({len(batch)} ops): {e}")
+            try:
+                if conn.in_transaction:
+                    await conn.execute("ROLLBACK")
+            except Exception as rollback_error:
+                logger.error(f"Rollback failed: {rollback_error}")
+            results = [(future, None, e) for _, future in batch]
+        
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
     async def close(self):
+        # Новые записи отклоняются сразу, а не повисают после остановки писателя
+        self._initialized = False
+        if self._writer_task is not None:
+            await self._writes.put(None)  # дописать очередь и остановиться
+            await self._writer_task
+            self._writer_task = None
         for conn in self._pool:
             await conn.close()
+        self._pool.clear()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
 
 # Глобальный пул
-db_pool = DBPool(DB_PATH, pool_size=5)
+db_pool = DBPool(DB_PATH)
 
-# ==================== USER FUNCTIONS ====================
-async def get_user_lang(uid: int) -> str:
-    """Получить язык пользователя"""
+# ==================== USER CACHE ====================
+class UserProfileCache:
+    """Read-through кэш профилей пользователей (lang, paid, balance, pairs).
+
+    Запись живёт ttl секунд; функции, меняющие профиль, сбрасывают её сразу.
+    При переполнении вытесняются давно не читанные записи.
+    """
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_size: int = USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: "OrderedDict[int, Tuple[dict, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Растёт при каждом сбросе: профиль, прочитанный до изменения, не кэшируется
+        self.version = 0
+
+    def get(self, uid: int) -> Optional[dict]:
+        entry = self.entries.get(uid)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self.entries.move_to_end(uid)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def set(self, uid: int, profile: dict, version: Optional[int] = None):
+        if version is not None and version != self.version:
+            return
+        self.entries[uid] = (profile, time.monotonic())
+        self.entries.move_to_end(uid)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, uid: int):
+        self.version += 1
+        self.entries.pop(uid, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+# Глобальный кэш профилей
+USER_CACHE = UserProfileCache()
+
+async def get_user_profile(uid: int) -> dict:
+    """Профиль пользователя одним запросом (из кэша, если он свежий)"""
+    profile = USER_CACHE.get(uid)
+    if profile is not None:
+        return profile
+    
+    version = USER_CACHE.version
     conn = await db_pool.acquire()
     try:
-        cursor = await conn.execute("SELECT language FROM users WHERE id=?", (uid,))
+        cursor = await conn.execute(
+            "SELECT u.language, u.paid, u.balance, u.status, GROUP_CONCAT(up.pair) AS pairs "
+            "FROM users u LEFT JOIN user_pairs up ON up.user_id = u.id "
+            "WHERE u.id=? GROUP BY u.id",
+            (uid,)
+        )
         row = await cursor.fetchone()
-        return row["language"] if row and row["language"] else "ru"
     finally:
         await db_pool.release(conn)
+    
+    profile = {
+        "lang": row["language"] if row and row["language"] else "ru",
+        "paid": bool(row and row["paid"]),
+        "balance": row["balance"] if row and row["balance"] is not None else 0.0,
+        # GROUP_CONCAT не гарантирует порядок - пары по алфавиту, как раньше
+        "pairs": tuple(sorted(row["pairs"].split(","))) if row and row["pairs"] else (),
+        "status": row["status"] if row else USER_ACTIVE,
+    }
+    USER_CACHE.set(uid, profile, version)
+    return profile
+
+# ==================== SUBSCRIPTION INDEX ====================
+class SubscriptionIndex:
+    """Индекс подписок в памяти: пара -> пользователи, пользователь -> пары.
+
+    Загружается один раз при старте и дальше обновляется функциями,
+    меняющими пары и доступ, поэтому фоновым циклам не нужен JOIN по БД.
+    Недоступные пользователи (заблокировали бота и т.п.) остаются в
+    user_pairs, но не попадают в списки получателей пар.
+    """
+    def __init__(self):
+        self.user_pairs: Dict[int, Set[str]] = defaultdict(set)
+        self.pair_users: Dict[str, Set[int]] = defaultdict(set)       # все доступные подписчики
+        self.pair_paid_users: Dict[str, Set[int]] = defaultdict(set)  # только оплатившие
+        self.paid: Set[int] = set()
+        self.inactive: Set[int] = set()
+        self.loaded = False
+
+    async def load(self):
+        """Построить индекс по таблицам users и user_pairs"""
+        conn = await db_pool.acquire()
+        try:
+            cursor = await conn.execute("SELECT id, paid, status FROM users WHERE paid=1 OR status != 'active'")
+            users = await cursor.fetchall()
+            cursor = await conn.execute("SELECT user_id, pair FROM user_pairs")
+            rows = await cursor.fetchall()
+        finally:
+            await db_pool.release(conn)
+        
+        self.clear()
+        self.paid = {r["id"] for r in users if r["paid"]}
+        self.inactive = {r["id"] for r in users if r["status"] != USER_ACTIVE}
+        for r in rows:
+            self._link(r["user_id"], r["pair"])
+        self.loaded = True
+        logger.info(f"Subscription index: {len(self.user_pairs)} users, {len(self.pair_users)} pairs")
+
+    def clear(self):
+        self.user_pairs.clear()
+        self.pair_users.clear()
+        self.pair_paid_users.clear()
+        self.paid = set()
+        self.inactive = set()
+        self.loaded = False
+
+    def _link(self, uid: int, pair: str):
+        self.user_pairs[uid].add(pair)
+        if uid in self.inactive:
+            return
+        self.pair_users[pair].add(uid)
+        if uid in self.paid:
+            self.pair_paid_users[pair].add(uid)
+
+    @staticmethod
+    def _discard(index: Dict, key, value):
+        members = index.get(key)
+        if members is not None:
+            members.discard(value)
+            if not members:
+                del index[key]
+
+    def add_pair(self, uid: int, pair: str):
+        self._link(uid, pair)
+
+    def remove_pair(self, uid: int, pair: str):
+        self._discard(self.user_pairs, uid, pair)
+        self._discard(self.pair_users, pair, uid)
+        self._discard(self.pair_paid_users, pair, uid)
+
+    def clear_user(self, uid: int):
+        for pair in list(self.user_pairs.get(uid, ())):
+            self.remove_pair(uid, pair)
+
+    def set_paid(self, uid: int):
+        self.paid.add(uid)
+        if uid in self.inactive:
+            return
+        for pair in self.user_pairs.get(uid, ()):
+            self.pair_paid_users[pair].add(uid)
+
+    def set_inactive(self, uid: int):
+        """Чат недоступен - убрать из получателей, подписки сохранить"""
+        self.inactive.add(uid)
+        for pair in self.user_pairs.get(uid, ()):
+            self._discard(self.pair_users, pair, uid)
+            self._discard(self.pair_paid_users, pair, uid)
+
+    def set_active(self, uid: int):
+        self.inactive.discard(uid)
+        for pair in list(self.user_pairs.get(uid, ())):
+            self._link(uid, pair)
+
+    def tracked_pairs(self) -> List[str]:
+        """Пары, на которые подписан хоть один пользователь"""
+        return list(self.pair_users)
+
+    def paid_subscribers(self) -> Dict[str, Set[int]]:
+        """Пара -> оплатившие подписчики (живой индекс, не изменять)"""
+        return self.pair_paid_users
+
+# Глобальный индекс подписок
+SUBSCRIPTIONS = SubscriptionIndex()
+
+# ==================== USER FUNCTIONS ====================
+async def get_user_lang(uid: int) -> str:
+    """Получить язык пользователя"""
+    return (await get_user_profile(uid))["lang"]
 
 async def set_user_lang(uid: int, lang: str):
     """Установить язык пользователя"""
-    conn = await db_pool.acquire()
-    try:
-        await conn.execute("UPDATE users SET language=? WHERE id=?", (lang, uid))
-        await conn.commit()
-    finally:
-        await db_pool.release(conn)
+    await db_pool.write(("UPDATE users SET language=? WHERE id=?", (lang, uid)))
+    USER_CACHE.invalidate(uid)
+
+async def add_user(uid: int, invited_by: Optional[int] = None) -> bool:
+    """Создать пользователя, если его ещё нет; вернуть True для нового"""
+    created = await db_pool.write(
+        ("INSERT OR IGNORE INTO users(id, invited_by, created_ts) VALUES(?,?,?)",
+         (uid, invited_by, int(time.time())))
+    )
+    USER_CACHE.invalidate(uid)
+    return created == 1
+
+async def set_user_status(uid: int, status: str) -> bool:
+    """Отметить чат недоступным (blocked, not_found, deactivated) или снова активным.
+
+    Недоступные пользователи исключаются из сигналов и рассылок.
+    Возвращает True, если статус изменился.
+    """
+    changed = await db_pool.write(
+        ("UPDATE users SET status=? WHERE id=? AND status != ?", (status, uid, status))
+    )
+    if changed != 1:
+        return False
+    USER_CACHE.invalidate(uid)
+    if status == USER_ACTIVE:
+        SUBSCRIPTIONS.set_active(uid)
+    else:
+        SUBSCRIPTIONS.set_inactive(uid)
+    return True
 
 async def is_paid(uid: int) -> bool:
     """Проверить оплачен ли доступ"""
-    conn = await db_pool.acquire()
-    try:
-        cursor = await conn.execute("SELECT paid FROM users WHERE id=?", (uid,))
-        row = await cursor.fetchone()
-        return bool(row and row["paid"])
-    finally:
-        await db_pool.release(conn)
+    return (await get_user_profile(uid))["paid"]
 
 async def get_user_balance(uid: int) -> float:
     """Получить баланс пользователя"""
-    conn = await db_pool.acquire()
-    try:
-        cursor = await conn.execute("SELECT balance FROM users WHERE id=?", (uid,))
-        row = await cursor.fetchone()
-        return row["balance"] if row else 0.0
-    finally:
-        await db_pool.release(conn)
+    return (await get_user_profile(uid))["balance"]
 
 async def get_user_refs_count(uid: int) -> int:
     """Получить количество рефералов"""
@@ -148,90 +544,319 @@ async def get_user_refs_count(uid: int) -> int:
 # ==================== PAIRS FUNCTIONS ====================
 async def get_user_pairs(uid: int) -> List[str]:
     """Получить пары пользователя"""
+    return list((await get_user_profile(uid))["pairs"])
+
+async def add_user_pair(uid: int, pair: str):
+    """Добавить пару пользователю"""
+    await db_pool.write(("INSERT OR IGNORE INTO user_pairs(user_id, pair) VALUES(?,?)", (uid, pair.upper())))
+    USER_CACHE.invalidate(uid)
+    SUBSCRIPTIONS.add_pair(uid, pair.upper())
+
+async def remove_user_pair(uid: int, pair: str):
+    """Удалить пару у пользователя"""
+    await db_pool.write(("DELETE FROM user_pairs WHERE user_id=? AND pair=?", (uid, pair.upper())))
+    USER_CACHE.invalidate(uid)
+    SUBSCRIPTIONS.remove_pair(uid, pair.upper())
+
+async def clear_user_pairs(uid: int):
+    """Очистить все пары пользователя"""
+    await db_pool.write(("DELETE FROM user_pairs WHERE user_id=?", (uid,)))
+    USER_CACHE.invalidate(uid)
+    SUBSCRIPTIONS.clear_user(uid)
+
+# ==================== SIGNALS FUNCTIONS ====================
+async def count_signal_events(since_ts: int) -> Dict[str, int]:
+    """Число сигнальных событий по парам с since_ts.
+
+    Каждый сигнал - одна строка outbox_messages (получатели - в outbox),
+    поэтому событие считается точно, независимо от длительности доставки.
+    """
     conn = await db_pool.acquire()
     try:
-        cursor = await conn.execute("SELECT pair FROM user_pairs WHERE user_id=?", (uid,))
+        cursor = await conn.execute(
+            "SELECT pair, COUNT(*) AS cnt FROM outbox_messages "
+            "WHERE kind='signal' AND created_ts >= ? GROUP BY pair",
+            (since_ts,)
+        )
         rows = await cursor.fetchall()
-        return [r["pair"] for r in rows]
+        return {r["pair"]: r["cnt"] for r in rows}
     finally:
         await db_pool.release(conn)
 
-async def add_user_pair(uid: int, pair: str):
-    """Добавить пару пользователю"""
+class SignalLogWriter:
+    """Буфер записей signals_sent.
+
+    Строки копятся в памяти и пишутся executemany одной транзакцией -
+    при накоплении max_rows, через max_delay после первой строки
+    или явным flush() (конец рассылки, остановка бота).
+    """
+    def __init__(self, max_rows: int = SIGNAL_LOG_BATCH, max_delay: float = SIGNAL_LOG_FLUSH_INTERVAL):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.rows: List[Tuple] = []
+        self.commits = 0
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+
+    async def add(self, uid: int, pair: str, side: str, price: float, score: int):
+        self.rows.append((uid, pair, side, price, score, int(time.time())))
+        if len(self.rows) >= self.max_rows:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Signal log flush error: {e}")
+
+    async def flush(self) -> int:
+        """Записать накопленные строки; вернуть их число"""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None
+        async with self._lock:
+            rows, self.rows = self.rows, []
+            if not rows:
+                return 0
+            try:
+                await db_pool.write_many(
+                    "INSERT INTO signals_sent(user_id, pair, side, price, score, sent_ts) VALUES(?,?,?,?,?,?)",
+                    rows
+                )
+                self.commits += 1
+            except Exception:
+                # Не теряем записи - попробуем при следующем сбросе
+                self.rows[:0] = rows
+                raise
+            return len(rows)
+
+# Глобальный буфер лога сигналов
+SIGNAL_LOG = SignalLogWriter()
+
+async def log_signal(uid: int, pair: str, side: str, price: float, score: int):
+    """Записать отправленный сигнал (через буфер SIGNAL_LOG)"""
+    await SIGNAL_LOG.add(uid, pair, side, price, score)
+
+# ==================== OUTBOX ====================
+OUTBOX_PENDING, OUTBOX_SENT, OUTBOX_FAILED = 0, 1, 2
+
+async def queue_signal(pair: str, side: str, price: float, score: int, text: str,
+                       user_ids: List[int], ts: int):
+    """Положить сигнал и его получателей в outbox вместе с cooldown - одной транзакцией"""
+    await db_pool.write(
+        ("INSERT INTO outbox_messages(kind, pair, side, price, score, text, created_ts) "
+         "VALUES('signal',?,?,?,?,?,?)", (pair, side, price, score, text, ts)),
+        # Писатель один, поэтому MAX(id) - только что вставленное сообщение
+        ("INSERT INTO outbox(message_id, user_id) "
+         "SELECT (SELECT MAX(id) FROM outbox_messages), value FROM json_each(?)",
+         (json.dumps([int(uid) for uid in user_ids]),)),
+        ("INSERT OR REPLACE INTO signal_cooldowns(pair, side, last_ts) VALUES(?,?,?)", (pair, side, ts))
+    )
+
+async def claim_outbox(limit: int, now: Optional[int] = None,
+                       exclude: Iterable[int] = ()) -> List[aiosqlite.Row]:
+    """Следующая пачка ожидающих доставки строк, у которых подошло время повтора
+
+    exclude - id строк, которые уже отправляются (ещё не отмечены).
+    """
+    now = int(time.time()) if now is None else now
+    exclude = list(exclude)
+    skip = f"AND o.id NOT IN ({','.join('?' * len(exclude))}) " if exclude else ""
     conn = await db_pool.acquire()
     try:
-        await conn.execute("INSERT OR IGNORE INTO user_pairs(user_id, pair) VALUES(?,?)", (uid, pair.upper()))
-        await conn.commit()
+        cursor = await conn.execute(
+            "SELECT o.id, o.user_id, m.kind, m.pair, m.side, m.price, m.score, m.text "
+            "FROM outbox o JOIN outbox_messages m ON m.id = o.message_id "
+            f"WHERE o.status = 0 AND o.next_ts <= ? {skip}ORDER BY o.id LIMIT ?",
+            (now, *exclude, limit)
+        )
+        return await cursor.fetchall()
     finally:
         await db_pool.release(conn)
 
-async def remove_user_pair(uid: int, pair: str):
-    """Удалить пару у пользователя"""
+async def mark_outbox(sent: List[int], failed: List[int], retry: List[int],
+                      now: int, retry_delay: int, max_attempts: int):
+    """Записать итог пачки одной транзакцией.
+
+    sent - доставлены, failed - чат недоступен навсегда. Строки retry
+    (временная ошибка) остаются в очереди с паузой retry_delay * 2^attempts;
+    после max_attempts попыток они тоже считаются недоставленными.
+    """
+    def ids(values: List[int]) -> str:
+        return ",".join("?" * len(values))
+    
+    statements = []
+    if sent:
+        statements.append((f"UPDATE outbox SET status={OUTBOX_SENT} WHERE id IN ({ids(sent)})", tuple(sent)))
+    if failed:
+        statements.append((f"UPDATE outbox SET status={OUTBOX_FAILED} WHERE id IN ({ids(failed)})", tuple(failed)))
+    if retry:
+        # В UPDATE справа - старые значения колонок
+        statements.append((
+            f"UPDATE outbox SET attempts = attempts + 1, next_ts = ? + ? * (1 << attempts), "
+            f"status = CASE WHEN attempts + 1 >= ? THEN {OUTBOX_FAILED} ELSE {OUTBOX_PENDING} END "
+            f"WHERE id IN ({ids(retry)})",
+            (now, retry_delay, max_attempts) + tuple(retry)
+        ))
+    if statements:
+        await db_pool.write(*statements)
+
+async def purge_outbox(before_ts: int) -> int:
+    """Удалить доставленные строки старых сообщений и сами сообщения без ожидающих строк"""
+    return await db_pool.write(
+        ("DELETE FROM outbox WHERE status != 0 AND message_id IN "
+         "(SELECT id FROM outbox_messages WHERE created_ts < ?)", (before_ts,)),
+        ("DELETE FROM outbox_messages WHERE created_ts < ? AND NOT EXISTS "
+         "(SELECT 1 FROM outbox o WHERE o.message_id = outbox_messages.id)", (before_ts,))
+    )
+
+async def load_signal_cooldowns() -> Dict[Tuple[str, str], int]:
+    """Время последнего сигнала по (pair, side) - для LAST_SIGNALS после рестарта"""
     conn = await db_pool.acquire()
     try:
-        await conn.execute("DELETE FROM user_pairs WHERE user_id=? AND pair=?", (uid, pair.upper()))
-        await conn.commit()
+        cursor = await conn.execute("SELECT pair, side, last_ts FROM signal_cooldowns")
+        rows = await cursor.fetchall()
+        return {(r["pair"], r["side"]): r["last_ts"] for r in rows}
     finally:
         await db_pool.release(conn)
 
-async def clear_user_pairs(uid: int):
-    """Очистить все пары пользователя"""
+# ==================== BROADCASTS ====================
+async def create_broadcast(admin_id: int, chat_id: int, text: str, total: int) -> int:
+    """Создать задание рассылки; вернуть его id"""
+    return await db_pool.insert(
+        "INSERT INTO broadcasts(admin_id, chat_id, text, total, created_ts) VALUES(?,?,?,?,?)",
+        (admin_id, chat_id, text, total, int(time.time()))
+    )
+
+async def get_broadcast(bid: int) -> Optional[dict]:
     conn = await db_pool.acquire()
     try:
-        await conn.execute("DELETE FROM user_pairs WHERE user_id=?", (uid,))
-        await conn.commit()
+        cursor = await conn.execute("SELECT * FROM broadcasts WHERE id=?", (bid,))
+        row = await cursor.fetchone()
+        return dict(row) if row else None
     finally:
         await db_pool.release(conn)
 
-async def get_all_tracked_pairs() -> List[str]:
-    """Получить все отслеживаемые пары"""
+async def get_broadcasts(status: str) -> List[dict]:
+    """Задания рассылки в заданном статусе"""
     conn = await db_pool.acquire()
     try:
-        cursor = await conn.execute("SELECT DISTINCT pair FROM user_pairs")
+        cursor = await conn.execute("SELECT * FROM broadcasts WHERE status=? ORDER BY id", (status,))
         rows = await cursor.fetchall()
-        return [r["pair"] for r in rows]
+        return [dict(r) for r in rows]
     finally:
         await db_pool.release(conn)
 
-async def get_pairs_with_users():
-    """Получить пары с пользователями (для рассылки сигналов)"""
+async def save_broadcast_progress(bid: int, cursor: int, sent: int, failed: int):
+    """Сохранить позицию рассылки (после каждой страницы получателей)"""
+    await db_pool.write(
+        ("UPDATE broadcasts SET cursor=?, sent=?, failed=? WHERE id=?", (cursor, sent, failed, bid))
+    )
+
+async def set_broadcast_status(bid: int, status: str, message_id: Optional[int] = None):
+    if message_id is None:
+        await db_pool.write(("UPDATE broadcasts SET status=? WHERE id=?", (status, bid)))
+    else:
+        await db_pool.write(("UPDATE broadcasts SET status=?, message_id=? WHERE id=?", (status, message_id, bid)))
+
+# ==================== CANDLES FUNCTIONS ====================
+async def save_candles(tf: int, rows: List[Tuple[str, dict]]):
+    """Сохранить закрытые свечи одной транзакцией"""
+    if not rows:
+        return
+    await db_pool.write_many(
+        "INSERT OR REPLACE INTO candles(pair, tf, ts, o, h, l, c, v) VALUES(?,?,?,?,?,?,?,?)",
+        [
+            (pair, tf, int(c["ts"]), c["o"], c["h"], c["l"], c["c"], c["v"])
+            for pair, c in rows
+        ]
+    )
+
+async def get_candle_pairs(tf: int) -> List[str]:
+    """Пары, для которых есть свечи таймфрейма tf"""
     conn = await db_pool.acquire()
     try:
-        cursor = await conn.execute(
-            "SELECT up.user_id, up.pair FROM user_pairs up "
-            "JOIN users u ON up.user_id = u.id WHERE u.paid = 1"
-        )
-        rows = await cursor.fetchall()
-        return rows
+        cursor = await conn.execute("SELECT DISTINCT pair FROM candles WHERE tf=?", (tf,))
+        return [r["pair"] for r in await cursor.fetchall()]
     finally:
         await db_pool.release(conn)
 
-# ==================== SIGNALS FUNCTIONS ====================
-async def count_signals_today(pair: str) -> int:
-    """Подсчитать сигналы за сегодня"""
+async def load_candles(tf: int, limit: int) -> Dict[str, List[dict]]:
+    """Загрузить последние limit свечей каждой пары (по возрастанию времени)
+
+    Запрос на пару читает только хвост первичного ключа (pair, tf, ts),
+    а не всю таблицу.
+    """
+    pairs = await get_candle_pairs(tf)
+    result: Dict[str, List[dict]] = {}
     conn = await db_pool.acquire()
     try:
-        today_start = int(datetime.now().replace(hour=0, minute=0, second=0).timestamp())
-        cursor = await conn.execute(
-            "SELECT COUNT(*) as cnt FROM signals_sent WHERE pair=? AND sent_ts >= ?",
-            (pair, today_start)
-        )
-        row = await cursor.fetchone()
-        return row["cnt"] if row else 0
+        for pair in pairs:
+            cursor = await conn.execute(
+                "SELECT ts, o, h, l, c, v FROM candles WHERE pair=? AND tf=? ORDER BY ts DESC LIMIT ?",
+                (pair, tf, limit)
+            )
+            rows = await cursor.fetchall()
+            result[pair] = [
+                {"ts": r["ts"], "o": r["o"], "h": r["h"], "l": r["l"], "c": r["c"], "v": r["v"]}
+                for r in reversed(rows)
+            ]
     finally:
         await db_pool.release(conn)
+    return result
 
-async def log_signal(uid: int, pair: str, side: str, price: float, score: int):
-    """Записать отправленный сигнал"""
+async def set_candle_depth(tf: int, pairs: List[str], depth: int):
+    """Запомнить глубину импортированной истории (глубже прежней - увеличить)"""
+    await db_pool.write_many(
+        "INSERT INTO candle_depth(pair, tf, depth) VALUES(?,?,?) "
+        "ON CONFLICT(pair, tf) DO UPDATE SET depth = MAX(depth, excluded.depth)",
+        [(pair, tf, depth) for pair in pairs]
+    )
+
+async def get_candle_depths(tf: int) -> Dict[str, int]:
+    """Глубина импортированной истории по парам: {pair: depth}"""
     conn = await db_pool.acquire()
     try:
-        await conn.execute(
-            "INSERT INTO signals_sent(user_id, pair, side, price, score, sent_ts) VALUES(?,?,?,?,?,?)",
-            (uid, pair, side, price, score, int(time.time()))
+        cursor = await conn.execute("SELECT pair, depth FROM candle_depth WHERE tf=?", (tf,))
+        rows = await cursor.fetchall()
+    finally:
+        await db_pool.release(conn)
+    return {r["pair"]: r["depth"] for r in rows}
+
+async def prune_candles(tf: int, keep: int) -> int:
+    """Оставить в БД последние keep свечей каждой пары; вернуть число удалённых
+
+    Для пар с импортированной историей хранится не меньше её глубины
+    (candle_depth), чтобы импорт не приходилось повторять.
+    """
+    pairs = await get_candle_pairs(tf)
+    if not pairs:
+        return 0
+    # По паре: удаление диапазона по первичному ключу, одной транзакцией
+    return await db_pool.write_many(
+        "DELETE FROM candles WHERE pair=? AND tf=? AND ts <= "
+        "(SELECT MAX(ts) FROM candles WHERE pair=? AND tf=?) - ? * "
+        "MAX(?, COALESCE((SELECT depth FROM candle_depth WHERE pair=? AND tf=?), 0))",
+        [(pair, tf, pair, tf, tf, keep, pair, tf) for pair in pairs]
+    )
+
+async def get_candle_ranges(tf: int) -> Dict[str, Tuple[int, int, int]]:
+    """Диапазон сохранённых свечей по парам: {pair: (first_ts, last_ts, count)}"""
+    conn = await db_pool.acquire()
+    try:
+        cursor = await conn.execute(
+            "SELECT pair, MIN(ts) AS first_ts, MAX(ts) AS last_ts, COUNT(*) AS cnt "
+            "FROM candles WHERE tf=? GROUP BY pair",
+            (tf,)
         )
-        await conn.commit()
+        rows = await cursor.fetchall()
     finally:
         await db_pool.release(conn)
+    return {r["pair"]: (r["first_ts"], r["last_ts"], r["cnt"]) for r in rows}
 
 # ==================== ADMIN FUNCTIONS ====================
 async def get_users_count() -> int:
@@ -254,6 +879,16 @@ async def get_paid_users_count() -> int:
     finally:
         await db_pool.release(conn)
 
+async def get_reachable_users_count() -> int:
+    """Получить количество пользователей, которым доступна доставка"""
+    conn = await db_pool.acquire()
+    try:
+        cursor = await conn.execute("SELECT COUNT(*) as cnt FROM users WHERE status = 'active'")
+        row = await cursor.fetchone()
+        return row["cnt"] if row else 0
+    finally:
+        await db_pool.release(conn)
+
 async def get_active_users_count() -> int:
     """Получить количество активных (с парами)"""
     conn = await db_pool.acquire()
@@ -264,11 +899,13 @@ async def get_active_users_count() -> int:
     finally:
         await db_pool.release(conn)
 
-async def get_all_user_ids() -> List[int]:
-    """Получить ID всех пользователей"""
+async def get_user_ids_page(after_id: int, limit: int) -> List[int]:
+    """Страница ID доступных пользователей по возрастанию (id > after_id) - для рассылок"""
     conn = await db_pool.acquire()
     try:
-        cursor = await conn.execute("SELECT id FROM users")
+        cursor = await conn.execute(
+            "SELECT id FROM users WHERE id > ? AND status = 'active' ORDER BY id LIMIT ?", (after_id, limit)
+        )
         rows = await cursor.fetchall()
         return [r["id"] for r in rows]
     finally:
@@ -276,23 +913,20 @@ async def get_all_user_ids() -> List[int]:
 
 async def grant_access(uid: int):
     """Выдать доступ пользователю"""
-    conn = await db_pool.acquire()
-    try:
-        await conn.execute("INSERT OR IGNORE INTO users(id, created_ts) VALUES(?,?)", (uid, int(time.time())))
-        await conn.execute("UPDATE users SET paid=1 WHERE id=?", (uid,))
-        await conn.commit()
-    finally:
-        await db_pool.release(conn)
+    await db_pool.write(
+        ("INSERT OR IGNORE INTO users(id, created_ts) VALUES(?,?)", (uid, int(time.time()))),
+        ("UPDATE users SET paid=1 WHERE id=?", (uid,))
+    )
+    USER_CACHE.invalidate(uid)
+    SUBSCRIPTIONS.set_paid(uid)
 
 async def add_balance(uid: int, amount: float):
     """Добавить баланс пользователю"""
-    conn = await db_pool.acquire()
-    try:
-        await conn.execute("INSERT OR IGNORE INTO users(id, created_ts) VALUES(?,?)", (uid, int(time.time())))
-        await conn.execute("UPDATE users SET balance = COALESCE(balance, 0) + ? WHERE id=?", (amount, uid))
-        await conn.commit()
-    finally:
-        await db_pool.release(conn)
+    await db_pool.write(
+        ("INSERT OR IGNORE INTO users(id, created_ts) VALUES(?,?)", (uid, int(time.time()))),
+        ("UPDATE users SET balance = COALESCE(balance, 0) + ? WHERE id=?", (amount, uid))
+    )
+    USER_CACHE.invalidate(uid)
 
 # ==================== INIT ====================
 async def init_db():
@@ -0,0 +1,266 @@
+"""
+dispatcher.py - Рассылка сообщений в Telegram: очередь, воркеры, лимиты скорости
+"""
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+from aiogram import Bot
+from aiogram.utils.exceptions import (
+    RetryAfter, TelegramAPIError, BotBlocked, BotKicked, UserDeactivated,
+    ChatNotFound, CantInitiateConversation, CantTalkWithBots
+)
+
+from config import (
+    SEND_WORKERS, SEND_RATE, SEND_CHAT_INTERVAL, SEND_MAX_RETRIES,
+    SEND_MIN_RATE, FLOOD_BACKOFF, FLOOD_RECOVERY_INTERVAL
+)
+from database import set_user_status
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Глобальный лимит: rate токенов в секунду, запас не больше capacity"""
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def drain(self):
+        """Обнулить запас (после паузы не отправлять пачкой)"""
+        self._refill()
+        self.tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class FloodGate:
+    """Общий для всех отправителей контроль флуда Telegram.
+
+    Первый RetryAfter приостанавливает все отправки на указанное время и
+    снижает скорость bucket в FLOOD_BACKOFF раз (не ниже SEND_MIN_RATE).
+    Пока флуда нет, скорость постепенно возвращается к исходной.
+    """
+    def __init__(self, bucket: TokenBucket, backoff: float = FLOOD_BACKOFF,
+                 min_rate: float = SEND_MIN_RATE, recovery_interval: float = FLOOD_RECOVERY_INTERVAL):
+        self.bucket = bucket
+        self.backoff = backoff
+        self.min_rate = min_rate
+        self.recovery_interval = recovery_interval
+        self.paused_until = 0.0
+        self.last_change = 0.0
+        self.trips = 0
+
+    async def acquire(self):
+        """Дождаться конца паузы и получить токен скорости"""
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.bucket.acquire()
+            # Пауза могла начаться, пока ждали токен
+            if time.monotonic() >= self.paused_until:
+                return
+
+    def trip(self, timeout: float):
+        """RetryAfter: пауза для всех; скорость снижается один раз на пачку ошибок"""
+        now = time.monotonic()
+        if now >= self.paused_until:
+            self.trips += 1
+            old_rate = self.bucket.rate
+            self.bucket.rate = max(self.min_rate, old_rate * self.backoff)
+            self.last_change = now
+            logger.warning(f"Flood control: pause {timeout}s, rate {old_rate:.1f} -> {self.bucket.rate:.1f} msg/s")
+        self.paused_until = max(self.paused_until, now + timeout)
+        self.bucket.drain()
+
+    def success(self):
+        """Успешная отправка: без флуда скорость растёт на 1 msg/s за интервал"""
+        bucket = self.bucket
+        if bucket.rate < bucket.max_rate:
+            now = time.monotonic()
+            if now - self.last_change >= self.recovery_interval:
+                bucket.rate = min(bucket.max_rate, bucket.rate + 1)
+                self.last_change = now
+
+# Глобальный лимит отправки и контроль флуда (общие для рассылок и хендлеров)
+FLOOD_GATE = FloodGate(TokenBucket(SEND_RATE))
+
+# Итог доставки. BLOCKED, NOT_FOUND и DEACTIVATED - чат недоступен навсегда
+SENT = "sent"
+FAILED = "failed"
+BLOCKED = "blocked"
+NOT_FOUND = "not_found"
+DEACTIVATED = "deactivated"
+UNREACHABLE = (BLOCKED, NOT_FOUND, DEACTIVATED)
+
+def classify_error(error: TelegramAPIError) -> str:
+    """Постоянная ли ошибка доставки: такие чаты больше не пробуем"""
+    if isinstance(error, (BotBlocked, BotKicked)):
+        return BLOCKED
+    if isinstance(error, UserDeactivated):
+        return DEACTIVATED
+    if isinstance(error, (ChatNotFound, CantInitiateConversation, CantTalkWithBots)):
+        return NOT_FOUND
+    return FAILED
+
+async def deliver(bot: Bot, user_id: int, text: str, gate: Optional[FloodGate] = None,
+                  retries: int = SEND_MAX_RETRIES, **kwargs) -> str:
+    """Отправка с общим лимитом скорости и ограниченными повторами при RetryAfter;
+    вернуть итог доставки (SENT, FAILED или один из UNREACHABLE)"""
+    gate = gate or FLOOD_GATE
+    for _ in range(retries + 1):
+        await gate.acquire()
+        try:
+            await bot.send_message(user_id, text, **kwargs)
+            gate.success()
+            return SENT
+        except RetryAfter as e:
+            gate.trip(e.timeout)
+        except TelegramAPIError as e:
+            return classify_error(e)
+    logger.warning(f"Message to {user_id} dropped after {retries} retries (flood control)")
+    return FAILED
+
+async def send_message_safe(bot: Bot, user_id: int, text: str, gate: Optional[FloodGate] = None,
+                            retries: int = SEND_MAX_RETRIES, **kwargs) -> bool:
+    """Безопасная отправка: True, если сообщение доставлено"""
+    return await deliver(bot, user_id, text, gate, retries, **kwargs) == SENT
+
+# Приоритеты очереди: меньше - раньше. Сигналы обгоняют массовые рассылки
+PRIORITY_SIGNAL = 0
+PRIORITY_BROADCAST = 10
+
+@dataclass
+class SendJob:
+    chat_id: int
+    text: str
+    kwargs: dict
+    on_sent: Optional[Callable[[int], Awaitable]] = None
+    future: asyncio.Future = field(default=None)
+
+class MessageDispatcher:
+    """Очередь исходящих сообщений с N воркерами.
+
+    Общая скорость ограничена FloodGate (~30 сообщений/с для бота),
+    в один чат - не чаще раза в chat_interval секунд. Отправитель кладёт
+    сообщения в очередь и не ждёт доставки. Очередь приоритетная:
+    сигналы уходят раньше уже стоящих в очереди сообщений рассылки.
+    """
+    def __init__(self, workers: int = SEND_WORKERS, gate: Optional[FloodGate] = None,
+                 chat_interval: float = SEND_CHAT_INTERVAL,
+                 on_unreachable: Optional[Callable[[int, str], Awaitable]] = None):
+        self.workers = workers
+        self.gate = gate or FLOOD_GATE
+        self.on_unreachable = on_unreachable
+        self.chat_interval = chat_interval
+        self.bot: Optional[Bot] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._chat_next: Dict[int, float] = {}
+        self._seq = 0
+        self.sent = 0
+        self.failed = 0
+        self.unreachable = 0
+
+    def start(self, bot: Bot):
+        if self._tasks:
+            return
+        self.bot = bot
+        self.queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Message dispatcher started: {self.workers} workers, {self.gate.bucket.rate} msg/s")
+
+    async def stop(self, timeout: float = 10.0):
+        """Дождаться отправки очереди (не дольше timeout) и остановить воркеров"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dispatcher stopped with {self.queue.qsize()} messages pending")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Неотправленные сообщения: отменяем future, чтобы ожидающие не зависли
+        while not self.queue.empty():
+            _, _, job = self.queue.get_nowait()
+            job.future.cancel()
+            self.queue.task_done()
+
+    def enqueue(self, chat_id: int, text: str, on_sent: Optional[Callable[[int], Awaitable]] = None,
+                priority: int = PRIORITY_SIGNAL, **kwargs) -> asyncio.Future:
+        """Поставить сообщение в очередь; future вернёт итог доставки (SENT, FAILED, ...)"""
+        job = SendJob(chat_id, text, kwargs, on_sent, asyncio.get_running_loop().create_future())
+        # seq сохраняет порядок FIFO внутри одного приоритета
+        self._seq += 1
+        self.queue.put_nowait((priority, self._seq, job))
+        return job.future
+
+    def enqueue_many(self, chat_ids: Iterable[int], text: str,
+                     on_sent: Optional[Callable[[int], Awaitable]] = None,
+                     priority: int = PRIORITY_SIGNAL, **kwargs) -> List[asyncio.Future]:
+        return [self.enqueue(chat_id, text, on_sent, priority, **kwargs) for chat_id in chat_ids]
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Отправить через очередь и дождаться результата; True, если доставлено"""
+        return await self.enqueue(chat_id, text, **kwargs) == SENT
+
+    async def _wait_chat(self, chat_id: int):
+        """Лимит на чат: резервируем ближайший свободный слот"""
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        if len(self._chat_next) > 10000:
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self.queue.get()
+            status = FAILED
+            try:
+                await self._wait_chat(job.chat_id)
+                status = await deliver(self.bot, job.chat_id, job.text, self.gate, **job.kwargs)
+                if status == SENT and job.on_sent is not None:
+                    await job.on_sent(job.chat_id)
+                elif status in UNREACHABLE:
+                    # Чат недоступен навсегда - отмечаем, чтобы не тратить лимит в следующий раз
+                    self.unreachable += 1
+                    if self.on_unreachable is not None:
+                        await self.on_unreachable(job.chat_id, status)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                logger.error(f"Dispatcher error for {job.chat_id}: {e}")
+            finally:
+                ok = status == SENT
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                if not job.future.done():
+                    job.future.set_result(status)
+                self.queue.task_done()
+
+# Глобальный диспетчер рассылки; недоступные чаты помечаются в users.status
+DISPATCHER = MessageDispatcher(on_unreachable=set_user_status)
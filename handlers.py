@@ -9,8 +9,10 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from config import ADMIN_IDS, SUPPORT_URL, t, BOT_NAME
 from config import IMG_START, IMG_ALERTS, IMG_GUIDE, IMG_PAYWALL, IMG_REF
 from database import *
-from indicators import fetch_price
-import httpx
+from market_data import MARKET_DATA
+from broadcasts import BROADCASTS
+from dispatcher import send_message_safe
+from middlewares import UserContextMiddleware
 
 # Состояния пользователей для диалогов
 USER_STATES = {}
@@ -19,18 +21,6 @@ USER_STATES = {}
 def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
 
-async def send_message_safe_local(bot, user_id: int, text: str, **kwargs):
-    """Локальная версия для handlers"""
-    from aiogram.utils.exceptions import RetryAfter, TelegramAPIError
-    try:
-        await bot.send_message(user_id, text, **kwargs)
-        return True
-    except RetryAfter as e:
-        await asyncio.sleep(e.timeout)
-        return await send_message_safe_local(bot, user_id, text, **kwargs)
-    except TelegramAPIError:
-        return False
-
 async def send_photo_or_text(message_or_call, photo_url: str, text: str, reply_markup=None, is_callback=False):
     """Отправить фото если есть URL, иначе текст"""
     try:
@@ -143,6 +133,8 @@ def admin_kb(lang: str = "ru"):
 # ==================== SETUP HANDLERS ====================
 def setup_handlers(dp):
     """Регистрация всех хендлеров"""
+    # Профиль пользователя загружается один раз на апдейт и передаётся в хендлеры
+    dp.middleware.setup(UserContextMiddleware())
     
     # ==================== MAIN COMMANDS ====================
     async def show_language_selection(message: types.Message):
@@ -163,40 +155,29 @@ def setup_handlers(dp):
             await message.answer(text, reply_markup=kb)
     
     @dp.message_handler(commands=["start"])
-    async def cmd_start(message: types.Message):
+    async def cmd_start(message: types.Message, profile: dict):
         uid = message.from_user.id
         args = message.get_args()
         invited_by = int(args) if args and args.isdigit() and int(args) != uid else None
         
-        # Проверяем, новый ли пользователь
-        conn = await db_pool.acquire()
-        try:
-            cursor = await conn.execute("SELECT id FROM users WHERE id=?", (uid,))
-            existing_user = await cursor.fetchone()
-            
-            if not existing_user:
-                # Новый пользователь - создаём запись
-                await conn.execute(
-                    "INSERT INTO users(id, invited_by, created_ts) VALUES(?,?,?)",
-                    (uid, invited_by, int(time.time()))
-                )
-                await conn.commit()
-                
-                # Показываем выбор языка для новых пользователей
-                await show_language_selection(message)
-                return
-        finally:
-            await db_pool.release(conn)
+        # Новый пользователь - создаём запись и показываем выбор языка
+        if await add_user(uid, invited_by):
+            await show_language_selection(message)
+            return
+        
+        # Пользователь вернулся после блокировки бота - снова получает сигналы
+        if profile["status"] != USER_ACTIVE:
+            await set_user_status(uid, USER_ACTIVE)
         
         # Существующий пользователь - показываем главное меню
-        lang = await get_user_lang(uid)
+        lang = profile["lang"]
         text = t(lang, "start_text")
         
-        paid = await is_paid(uid)
+        paid = profile["paid"]
         await send_photo_or_text(message, IMG_START, text, main_menu_kb(is_admin(uid), paid, lang))
     
     @dp.callback_query_handler(lambda c: c.data.startswith("first_lang_"))
-    async def set_first_language(call: types.CallbackQuery):
+    async def set_first_language(call: types.CallbackQuery, profile: dict):
         """Установить язык при первом запуске"""
         uid = call.from_user.id
         lang = call.data.split("_")[2]  # ru или en
@@ -206,7 +187,7 @@ def setup_handlers(dp):
         
         # Показываем главное меню с выбранным языком
         text = t(lang, "start_text")
-        paid = await is_paid(uid)
+        paid = profile["paid"]
         
         try:
             await call.message.delete()
@@ -236,19 +217,19 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.callback_query_handler(lambda c: c.data.startswith("lang_"))
-    async def set_language(call: types.CallbackQuery):
+    async def set_language(call: types.CallbackQuery, profile: dict):
         """Установить язык"""
         lang = call.data.split("_")[1]
         await set_user_lang(call.from_user.id, lang)
         
         await call.answer(t(lang, "language_changed"), show_alert=True)
-        await back_main(call)
+        await back_main(call, dict(profile, lang=lang))
     
     # ==================== NAVIGATION ====================
     @dp.callback_query_handler(lambda c: c.data == "back_main")
-    async def back_main(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
-        paid = await is_paid(call.from_user.id)
+    async def back_main(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
+        paid = profile["paid"]
         
         text = t(lang, "main_menu")
         await send_photo_or_text(call, IMG_START, text, main_menu_kb(is_admin(call.from_user.id), paid, lang), is_callback=True)
@@ -256,49 +237,50 @@ def setup_handlers(dp):
     
     # ==================== ALERTS ====================
     @dp.callback_query_handler(lambda c: c.data == "menu_alerts")
-    async def menu_alerts(call: types.CallbackQuery):
-        uid = call.from_user.id
-        lang = await get_user_lang(uid)
+    async def menu_alerts(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         
-        if not await is_paid(uid):
+        if not profile["paid"]:
             await call.answer(t(lang, "access_required"), show_alert=True)
             return
         
-        pairs = await get_user_pairs(uid)
+        pairs = list(profile["pairs"])
         text = t(lang, "alerts_title", count=len(pairs))
         
         await send_photo_or_text(call, IMG_ALERTS, text, alerts_kb(pairs, lang), is_callback=True)
         await call.answer()
     
     @dp.callback_query_handler(lambda c: c.data.startswith("toggle_"))
-    async def toggle_pair(call: types.CallbackQuery):
+    async def toggle_pair(call: types.CallbackQuery, profile: dict):
         uid = call.from_user.id
-        lang = await get_user_lang(uid)
+        lang = profile["lang"]
         
-        if not await is_paid(uid):
+        if not profile["paid"]:
             await call.answer(t(lang, "access_required"), show_alert=True)
             return
         
         pair = call.data.split("_", 1)[1]
-        pairs = await get_user_pairs(uid)
+        pairs = list(profile["pairs"])
         
         if pair in pairs:
             await remove_user_pair(uid, pair)
+            pairs.remove(pair)
             await call.answer(t(lang, "coin_removed", pair=pair))
         else:
             if len(pairs) >= 10:
                 await call.answer(t(lang, "max_coins"), show_alert=True)
                 return
             await add_user_pair(uid, pair)
+            pairs.append(pair)
             await call.answer(t(lang, "coin_added", pair=pair))
         
-        await menu_alerts(call)
+        await menu_alerts(call, dict(profile, pairs=tuple(pairs)))
     
     @dp.callback_query_handler(lambda c: c.data == "add_custom")
-    async def add_custom(call: types.CallbackQuery):
+    async def add_custom(call: types.CallbackQuery, profile: dict):
         uid = call.from_user.id
-        lang = await get_user_lang(uid)
-        pairs = await get_user_pairs(uid)
+        lang = profile["lang"]
+        pairs = list(profile["pairs"])
         
         if len(pairs) >= 10:
             await call.answer(t(lang, "max_coins"), show_alert=True)
@@ -314,29 +296,28 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.message_handler(lambda m: USER_STATES.get(m.from_user.id, {}).get("mode") == "waiting_custom_pair")
-    async def handle_custom_pair(message: types.Message):
+    async def handle_custom_pair(message: types.Message, profile: dict):
         uid = message.from_user.id
-        lang = await get_user_lang(uid)
+        lang = profile["lang"]
         pair = message.text.strip().upper()
         
         if not pair.endswith("USDT") or len(pair) < 6:
             await message.answer(t(lang, "invalid_format"))
             return
         
-        async with httpx.AsyncClient() as client:
-            price_data = await fetch_price(client, pair)
-            if not price_data:
-                await message.answer(t(lang, "pair_not_found", pair=pair))
-                return
+        price_data = await MARKET_DATA.fetch_price(pair)
+        if not price_data:
+            await message.answer(t(lang, "pair_not_found", pair=pair))
+            return
         
         await add_user_pair(uid, pair)
         USER_STATES.pop(uid, None)
         await message.answer(t(lang, "coin_added", pair=pair))
     
     @dp.callback_query_handler(lambda c: c.data == "my_pairs")
-    async def my_pairs(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
-        pairs = await get_user_pairs(call.from_user.id)
+    async def my_pairs(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
+        pairs = list(profile["pairs"])
         
         if not pairs:
             await call.answer(t(lang, "no_active_coins"), show_alert=True)
@@ -356,15 +337,15 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.callback_query_handler(lambda c: c.data == "clear_all")
-    async def clear_all(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def clear_all(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         await clear_user_pairs(call.from_user.id)
         await call.answer(t(lang, "all_removed"))
-        await menu_alerts(call)
+        await menu_alerts(call, dict(profile, pairs=()))
     
     @dp.callback_query_handler(lambda c: c.data == "alerts_info")
-    async def alerts_info(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def alerts_info(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         
         text = t(lang, "guide_title") + "\n\n"
         text += t(lang, "guide_step1") + "\n"
@@ -383,21 +364,21 @@ def setup_handlers(dp):
     
     # ==================== PAYMENT ====================
     @dp.callback_query_handler(lambda c: c.data == "menu_pay")
-    async def menu_pay(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def menu_pay(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         text = t(lang, "payment_title") + "\n\n" + t(lang, "payment_features")
         
         await send_photo_or_text(call, IMG_PAYWALL, text, pay_kb(lang), is_callback=True)
         await call.answer()
     
     @dp.callback_query_handler(lambda c: c.data == "pay_stars")
-    async def pay_stars(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def pay_stars(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         await call.answer(t(lang, "in_development"), show_alert=True)
     
     @dp.callback_query_handler(lambda c: c.data == "pay_crypto")
-    async def pay_crypto(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def pay_crypto(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         text = t(lang, "crypto_payment_info", support_url=SUPPORT_URL)
         
         try:
@@ -407,8 +388,8 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.callback_query_handler(lambda c: c.data == "pay_code")
-    async def pay_code(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def pay_code(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         USER_STATES[call.from_user.id] = {"mode": "waiting_promo"}
         text = t(lang, "send_promo")
         
@@ -419,23 +400,23 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.message_handler(lambda m: USER_STATES.get(m.from_user.id, {}).get("mode") == "waiting_promo")
-    async def handle_promo(message: types.Message):
-        lang = await get_user_lang(message.from_user.id)
+    async def handle_promo(message: types.Message, profile: dict):
+        lang = profile["lang"]
         await grant_access(message.from_user.id)
         USER_STATES.pop(message.from_user.id, None)
         await message.answer(t(lang, "access_granted"))
     
     # ==================== REFERRAL ====================
     @dp.callback_query_handler(lambda c: c.data == "menu_ref")
-    async def menu_ref(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def menu_ref(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         text = t(lang, "ref_title")
         await send_photo_or_text(call, IMG_REF, text, ref_kb(lang), is_callback=True)
         await call.answer()
     
     @dp.callback_query_handler(lambda c: c.data == "ref_link")
-    async def ref_link(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def ref_link(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         from aiogram import Bot
         bot = Bot.get_current()
         me = await bot.get_me()
@@ -449,9 +430,9 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.callback_query_handler(lambda c: c.data == "ref_balance")
-    async def ref_balance_handler(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
-        balance = await get_user_balance(call.from_user.id)
+    async def ref_balance_handler(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
+        balance = profile["balance"]
         refs = await get_user_refs_count(call.from_user.id)
         
         text = t(lang, "ref_balance", balance=balance, refs=refs)
@@ -462,8 +443,8 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.callback_query_handler(lambda c: c.data in ["ref_withdraw_crypto", "ref_withdraw_stars"])
-    async def ref_withdraw(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def ref_withdraw(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         
         if call.data == "ref_withdraw_crypto":
             text = t(lang, "withdraw_crypto_format")
@@ -477,8 +458,8 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.callback_query_handler(lambda c: c.data == "ref_guide")
-    async def ref_guide(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def ref_guide(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         text = t(lang, "ref_guide_text")
         
         try:
@@ -488,8 +469,8 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.message_handler(commands=["withdraw"])
-    async def cmd_withdraw(message: types.Message):
-        lang = await get_user_lang(message.from_user.id)
+    async def cmd_withdraw(message: types.Message, profile: dict):
+        lang = profile["lang"]
         parts = message.text.split()
         
         if len(parts) != 5:
@@ -511,17 +492,14 @@ def setup_handlers(dp):
         from aiogram import Bot
         bot = Bot.get_current()
         for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"💸 Вывод\nUser: {message.from_user.id}\n{parts[1]} {parts[2]}\nАдрес: {parts[3]}\nСумма: {amount}"
-                )
-            except:
-                pass
+            await send_message_safe(
+                bot, admin_id,
+                f"💸 Вывод\nUser: {message.from_user.id}\n{parts[1]} {parts[2]}\nАдрес: {parts[3]}\nСумма: {amount}"
+            )
     
     @dp.message_handler(commands=["withdraw_stars"])
-    async def cmd_withdraw_stars(message: types.Message):
-        lang = await get_user_lang(message.from_user.id)
+    async def cmd_withdraw_stars(message: types.Message, profile: dict):
+        lang = profile["lang"]
         parts = message.text.split()
         
         if len(parts) != 2:
@@ -542,8 +520,8 @@ def setup_handlers(dp):
     
     # ==================== GUIDE ====================
     @dp.callback_query_handler(lambda c: c.data == "menu_guide")
-    async def menu_guide(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def menu_guide(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         
         text = t(lang, "guide_title") + "\n\n"
         text += t(lang, "guide_step1") + "\n"
@@ -560,8 +538,8 @@ def setup_handlers(dp):
     
     # ==================== ADMIN ====================
     @dp.callback_query_handler(lambda c: c.data == "menu_admin")
-    async def menu_admin(call: types.CallbackQuery):
-        lang = await get_user_lang(call.from_user.id)
+    async def menu_admin(call: types.CallbackQuery, profile: dict):
+        lang = profile["lang"]
         
         if not is_admin(call.from_user.id):
             await call.answer(t(lang, "admin_no_access"), show_alert=True)
@@ -574,28 +552,69 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.callback_query_handler(lambda c: c.data == "adm_stats")
-    async def adm_stats(call: types.CallbackQuery):
+    async def adm_stats(call: types.CallbackQuery, profile: dict):
         if not is_admin(call.from_user.id):
             return
         
-        lang = await get_user_lang(call.from_user.id)
+        lang = profile["lang"]
         total = await get_users_count()
         paid = await get_paid_users_count()
         active = await get_active_users_count()
+        cache = USER_CACHE.stats()
         
-        text = t(lang, "admin_stats", total=total, paid=paid, active=active)
+        text = t(lang, "admin_stats", total=total, paid=paid, active=active,
+                 cache_hits=cache["hits"], cache_misses=cache["misses"])
         try:
             await call.message.edit_text(text, reply_markup=admin_kb(lang))
         except:
             await call.message.answer(text, reply_markup=admin_kb(lang))
         await call.answer()
     
+    @dp.message_handler(commands=["broadcast_cancel", "broadcast_resume"])
+    async def cmd_broadcast_control(message: types.Message, profile: dict):
+        if not is_admin(message.from_user.id):
+            return
+        
+        lang = profile["lang"]
+        parts = message.text.split()
+        if len(parts) != 2 or not parts[1].isdigit():
+            await message.reply(t(lang, "broadcast_cmd_format"))
+            return
+        
+        from aiogram import Bot
+        bot = Bot.get_current()
+        bid = int(parts[1])
+        if message.get_command(pure=True) == "broadcast_cancel":
+            ok = await BROADCASTS.cancel(bot, bid)
+        else:
+            ok = await BROADCASTS.resume(bot, bid)
+        if not ok:
+            await message.reply(t(lang, "broadcast_not_found"))
+    
+    @dp.callback_query_handler(lambda c: c.data.startswith("bc_"))
+    async def broadcast_control(call: types.CallbackQuery, profile: dict):
+        if not is_admin(call.from_user.id):
+            await call.answer(t(profile["lang"], "admin_no_access"))
+            return
+        
+        lang = profile["lang"]
+        _, action, bid = call.data.split("_")
+        from aiogram import Bot
+        bot = Bot.get_current()
+        if action == "pause":
+            ok = await BROADCASTS.pause(bot, int(bid))
+        elif action == "resume":
+            ok = await BROADCASTS.resume(bot, int(bid))
+        else:
+            ok = await BROADCASTS.cancel(bot, int(bid))
+        await call.answer(None if ok else t(lang, "broadcast_not_found"))
+    
     @dp.callback_query_handler(lambda c: c.data == "adm_broadcast")
-    async def adm_broadcast(call: types.CallbackQuery):
+    async def adm_broadcast(call: types.CallbackQuery, profile: dict):
         if not is_admin(call.from_user.id):
             return
         
-        lang = await get_user_lang(call.from_user.id)
+        lang = profile["lang"]
         USER_STATES[call.from_user.id] = {"mode": "admin_broadcast"}
         
         try:
@@ -605,33 +624,25 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.message_handler(lambda m: USER_STATES.get(m.from_user.id, {}).get("mode") == "admin_broadcast")
-    async def handle_broadcast(message: types.Message):
+    async def handle_broadcast(message: types.Message, profile: dict):
         if not is_admin(message.from_user.id):
             return
         
-        lang = await get_user_lang(message.from_user.id)
         text = message.html_text
-        users = await get_all_user_ids()
         
         from aiogram import Bot
-        from config import BATCH_SEND_DELAY
         bot = Bot.get_current()
         
-        sent = 0
-        for user_id in users:
-            if await send_message_safe_local(bot, user_id, text, disable_web_page_preview=True):
-                sent += 1
-            await asyncio.sleep(BATCH_SEND_DELAY)
-        
+        # Рассылка идёт фоновым заданием - обработчик сразу освобождается
         USER_STATES.pop(message.from_user.id, None)
-        await message.reply(t(lang, "admin_broadcast_done", sent=sent, total=len(users)))
+        await BROADCASTS.start(bot, message.from_user.id, message.chat.id, text)
     
     @dp.callback_query_handler(lambda c: c.data == "adm_grant")
-    async def adm_grant(call: types.CallbackQuery):
+    async def adm_grant(call: types.CallbackQuery, profile: dict):
         if not is_admin(call.from_user.id):
             return
         
-        lang = await get_user_lang(call.from_user.id)
+        lang = profile["lang"]
         USER_STATES[call.from_user.id] = {"mode": "admin_grant"}
         
         try:
@@ -641,11 +652,11 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.message_handler(lambda m: USER_STATES.get(m.from_user.id, {}).get("mode") == "admin_grant")
-    async def handle_grant(message: types.Message):
+    async def handle_grant(message: types.Message, profile: dict):
         if not is_admin(message.from_user.id):
             return
         
-        lang = await get_user_lang(message.from_user.id)
+        lang = profile["lang"]
         
         try:
             uid = int(message.text.strip())
@@ -659,17 +670,14 @@ def setup_handlers(dp):
         
         from aiogram import Bot
         bot = Bot.get_current()
-        try:
-            await bot.send_message(uid, t(lang, "access_granted"))
-        except:
-            pass
+        await send_message_safe(bot, uid, t(lang, "access_granted"))
     
     @dp.callback_query_handler(lambda c: c.data == "adm_give")
-    async def adm_give(call: types.CallbackQuery):
+    async def adm_give(call: types.CallbackQuery, profile: dict):
         if not is_admin(call.from_user.id):
             return
         
-        lang = await get_user_lang(call.from_user.id)
+        lang = profile["lang"]
         USER_STATES[call.from_user.id] = {"mode": "admin_give_uid"}
         
         try:
@@ -679,11 +687,11 @@ def setup_handlers(dp):
         await call.answer()
     
     @dp.message_handler(lambda m: USER_STATES.get(m.from_user.id, {}).get("mode") == "admin_give_uid")
-    async def handle_give_uid(message: types.Message):
+    async def handle_give_uid(message: types.Message, profile: dict):
         if not is_admin(message.from_user.id):
             return
         
-        lang = await get_user_lang(message.from_user.id)
+        lang = profile["lang"]
         
         try:
             uid = int(message.text.strip())
@@ -695,11 +703,11 @@ def setup_handlers(dp):
         await message.reply(t(lang, "admin_send_amount"))
     
     @dp.message_handler(lambda m: USER_STATES.get(m.from_user.id, {}).get("mode") == "admin_give_amount")
-    async def handle_give_amount(message: types.Message):
+    async def handle_give_amount(message: types.Message, profile: dict):
         if not is_admin(message.from_user.id):
             return
         
-        lang = await get_user_lang(message.from_user.id)
+        lang = profile["lang"]
         
         try:
             amount = float(message.text.strip())
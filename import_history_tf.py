@@ -7,11 +7,19 @@ import_history_tf.py - Импорт исторических данных с п
     python import_history_tf.py TONUSDT 1d 100
 """
 import sys
+import time
 import asyncio
+from collections import deque
+from typing import Dict, List, Optional, Tuple
 import httpx
-import time
-from indicators import CANDLES
-from config import CANDLE_TF, TIMEFRAME
+from indicators import fetch_klines
+from market_data import MARKET_DATA
+from database import init_db, db_pool, save_candles, get_candle_ranges, set_candle_depth
+from candle_archive import CandleArchive
+from config import (
+    TIMEFRAME, TIMEFRAME_MAP, CANDLE_STORE,
+    IMPORT_CONCURRENCY, IMPORT_WEIGHT_PER_MINUTE
+)
 
 # Маппинг таймфреймов для Binance API
 BINANCE_INTERVALS = {
@@ -24,6 +32,145 @@ BINANCE_INTERVALS = {
     "1d": "1d",
 }
 
+KLINES_PAGE = 1000   # Binance лимит свечей за запрос
+KLINES_WEIGHT = 2    # Вес запроса klines
+FETCH_RETRIES = 3
+
+class WeightBudget:
+    """Бюджет веса запросов в скользящем окне 60 секунд (общий для всех пар)"""
+    def __init__(self, per_minute: int = IMPORT_WEIGHT_PER_MINUTE):
+        self.per_minute = per_minute
+        self.events: deque = deque()  # (time, weight)
+        self.used = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, weight: int):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.events and now - self.events[0][0] >= 60:
+                    self.used -= self.events.popleft()[1]
+                if self.used + weight <= self.per_minute:
+                    self.events.append((now, weight))
+                    self.used += weight
+                    return
+                await asyncio.sleep(60 - (now - self.events[0][0]))
+
+# ==================== STORE ====================
+async def stored_ranges(tf: int, pairs: List[str]) -> Dict[str, Tuple[int, int, int]]:
+    """Что уже сохранено: {pair: (first_ts, last_ts, count)}"""
+    if CANDLE_STORE == "mmap":
+        archive = CandleArchive(tf=tf)
+        ranges = {pair: archive.range(pair) for pair in pairs}
+        return {pair: r for pair, r in ranges.items() if r}
+    return await get_candle_ranges(tf)
+
+async def store_page(tf: int, pair: str, candles: List[dict]):
+    """Записать страницу свечей одной транзакцией (или слиянием в архив)"""
+    if CANDLE_STORE == "mmap":
+        await asyncio.to_thread(CandleArchive(tf=tf).merge, pair, candles)
+    else:
+        await save_candles(tf, [(pair, c) for c in candles])
+
+# ==================== IMPORT ====================
+def plan_segments(tf: int, count: int, stored: Optional[Tuple[int, int, int]],
+                  now: float) -> List[Tuple[int, int, bool]]:
+    """Недостающие отрезки (start, end, backwards) последних count закрытых свечей.
+
+    Сохранённый диапазон пропускается, если в нём нет дыр (число свечей
+    совпадает с длиной диапазона); иначе он перезапрашивается целиком.
+    Новые свечи грузятся вперёд от last_ts (включая простой бота), старые -
+    назад от first_ts, поэтому оборванный импорт оставляет непрерывный диапазон.
+    """
+    end = int(now // tf) * tf - tf  # последняя закрытая свеча
+    start = end - (count - 1) * tf
+    if stored is None:
+        return [(start, end, True)]
+    first_ts, last_ts, stored_count = stored
+    segments = []
+    if last_ts < end:
+        segments.append((last_ts + tf, end, False))
+    if stored_count < (last_ts - first_ts) // tf + 1:
+        segments.append((first_ts, last_ts, False))
+    if first_ts > start:
+        segments.append((start, min(first_ts - tf, end), True))
+    return segments
+
+async def fetch_page(client: httpx.AsyncClient, budget: WeightBudget, pair: str, interval: str,
+                     start: int, end: int) -> Optional[List[dict]]:
+    """Страница klines [start, end] с повторами при ошибках"""
+    for attempt in range(FETCH_RETRIES):
+        await budget.acquire(KLINES_WEIGHT)
+        page = await fetch_klines(client, pair, interval, start_time=start,
+                                  end_time=end, limit=KLINES_PAGE)
+        if page is not None:
+            return [c for c in page if start <= c["ts"] <= end]
+        await asyncio.sleep(2 ** attempt)
+    return None
+
+async def import_pair(client: httpx.AsyncClient, budget: WeightBudget, pair: str,
+                      interval: str, tf: int, count: int,
+                      stored: Optional[Tuple[int, int, int]], now: float) -> Optional[int]:
+    """Загрузить недостающую историю пары страницами.
+
+    В SQLite каждая страница сразу пишется в хранилище, поэтому прерванный
+    импорт продолжается с того же места. В архив (mmap) страницы копятся и
+    вливаются одним merge в конце - merge переписывает файл целиком.
+    Возвращает число загруженных свечей или None при ошибке.
+    """
+    added = 0
+    buffered: List[dict] = []
+    try:
+        for seg_start, seg_end, backwards in plan_segments(tf, count, stored, now):
+            cursor = seg_end if backwards else seg_start
+            while seg_start <= cursor <= seg_end:
+                if backwards:
+                    page_start, page_end = max(seg_start, cursor - (KLINES_PAGE - 1) * tf), cursor
+                else:
+                    page_start, page_end = cursor, min(seg_end, cursor + (KLINES_PAGE - 1) * tf)
+                page = await fetch_page(client, budget, pair, interval, page_start, page_end)
+                if page is None:
+                    return None
+                if not page:
+                    break  # дошли до начала (или конца) торгов пары
+                if CANDLE_STORE == "mmap":
+                    buffered.extend(page)
+                else:
+                    await store_page(tf, pair, page)
+                added += len(page)
+                cursor = page[0]["ts"] - tf if backwards else page[-1]["ts"] + tf
+    finally:
+        if buffered:
+            await store_page(tf, pair, buffered)
+    return added
+
+async def import_pairs(pairs: List[str], timeframe: str, count: int,
+                       concurrency: int = IMPORT_CONCURRENCY,
+                       weight_per_minute: int = IMPORT_WEIGHT_PER_MINUTE,
+                       now: Optional[float] = None) -> Dict[str, Optional[int]]:
+    """Импортировать историю нескольких пар параллельно в общем бюджете веса"""
+    tf = TIMEFRAME_MAP[timeframe]
+    interval = BINANCE_INTERVALS[timeframe]
+    now = time.time() if now is None else now
+    pairs = [p.upper() for p in pairs]
+    # Очистка старых свечей в боте не должна съесть импортированную глубину
+    await set_candle_depth(tf, pairs, count)
+    ranges = await stored_ranges(tf, pairs)
+    budget = WeightBudget(weight_per_minute)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(pair: str):
+        async with semaphore:
+            added = await import_pair(MARKET_DATA.client, budget, pair, interval,
+                                      tf, count, ranges.get(pair), now)
+        if added is None:
+            print(f"  ❌ {pair}: ошибка загрузки")
+        else:
+            print(f"  ✅ {pair}: добавлено {added} свечей")
+        return pair, added
+
+    return dict(await asyncio.gather(*(run_one(p) for p in pairs)))
+
 async def import_history(pair: str, timeframe: str, count: int = 300):
     """Импортировать историю с Binance для указанного таймфрейма"""
     print(f"📥 Импорт {count} свечей для {pair} на таймфрейме {timeframe}...")
@@ -33,78 +180,8 @@ async def import_history(pair: str, timeframe: str, count: int = 300):
         print(f"     Доступные: {', '.join(BINANCE_INTERVALS.keys())}")
         return False
     
-    async with httpx.AsyncClient() as client:
-        try:
-            # Binance Klines API
-            url = "https://api.binance.com/api/v3/klines"
-            params = {
-                "symbol": pair.upper(),
-                "interval": BINANCE_INTERVALS[timeframe],
-                "limit": min(count, 1000)  # Binance лимит
-            }
-            
-            print(f"  🔗 Запрос к Binance API...")
-            resp = await client.get(url, params=params, timeout=10.0)
-            resp.raise_for_status()
-            
-            klines = resp.json()
-            print(f"  ✅ Получено {len(klines)} свечей ({timeframe})")
-            
-            # Очищаем старые данные
-            CANDLES.candles[pair.upper()].clear()
-            
-            # Добавляем в хранилище
-            added = 0
-            for kline in klines:
-                open_time = kline[0] / 1000  # ms -> s
-                open_price = float(kline[1])
-                high_price = float(kline[2])
-                low_price = float(kline[3])
-                close_price = float(kline[4])
-                volume = float(kline[5])
-                
-                # Рассчитываем bucket на основе таймфрейма
-                tf_seconds = {
-                    "1m": 60, "5m": 300, "15m": 900, "30m": 1800,
-                    "1h": 3600, "4h": 14400, "1d": 86400
-                }[timeframe]
-                
-                bucket = int(open_time // tf_seconds) * tf_seconds
-                
-                candle = {
-                    "ts": bucket,
-                    "o": open_price,
-                    "h": high_price,
-                    "l": low_price,
-                    "c": close_price,
-                    "v": volume
-                }
-                
-                CANDLES.candles[pair.upper()].append(candle)
-                added += 1
-            
-            print(f"  ✅ Добавлено {added} свечей в хранилище")
-            
-            # Проверка
-            total = len(CANDLES.get_candles(pair))
-            print(f"  📊 Всего свечей для {pair}: {total}")
-            
-            if total >= 250:
-                print(f"  ✅ Достаточно данных для анализа!")
-            else:
-                print(f"  ⚠️ Нужно ещё {250 - total} свечей")
-            
-            # Статистика
-            closes = [c["c"] for c in CANDLES.get_candles(pair)]
-            if closes:
-                print(f"  📈 Диапазон цен: {min(closes):.2f} - {max(closes):.2f}")
-                print(f"  📊 Текущая цена: {closes[-1]:.2f}")
-            
-            return True
-            
-        except Exception as e:
-            print(f"  ❌ Ошибка: {e}")
-            return False
+    results = await import_pairs([pair], timeframe, count)
+    return results[pair.upper()] is not None
 
 async def import_all_default(timeframe: str, count: int = 300):
     """Импортировать все дефолтные пары"""
@@ -115,15 +192,14 @@ async def import_all_default(timeframe: str, count: int = 300):
     print("=" * 60)
     print()
     
-    for pair in DEFAULT_PAIRS:
-        success = await import_history(pair, timeframe, count)
-        if not success:
-            print(f"  ⚠️ Пропускаем {pair}")
-        print()
-        await asyncio.sleep(0.5)  # Небольшая задержка между запросами
+    started = time.time()
+    results = await import_pairs(DEFAULT_PAIRS, timeframe, count)
+    failed = [pair for pair, added in results.items() if added is None]
+    if failed:
+        print(f"  ⚠️ Не загружены: {', '.join(failed)}")
     
     print("=" * 60)
-    print("✅ МАССОВЫЙ ИМПОРТ ЗАВЕРШЁН!")
+    print(f"✅ МАССОВЫЙ ИМПОРТ ЗАВЕРШЁН за {time.time() - started:.1f}s!")
     print("=" * 60)
 
 async def main():
@@ -164,6 +240,15 @@ async def main():
     print("=" * 60)
     print()
     
+    await init_db()
+    try:
+        await run_import(pair, timeframe, count)
+    finally:
+        await MARKET_DATA.close()
+        await db_pool.close()
+
+async def run_import(pair: str, timeframe: str, count: int):
+    """Импорт одной пары или всех дефолтных"""
     if pair == "ALL":
         await import_all_default(timeframe, count)
     else:
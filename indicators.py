@@ -1,14 +1,19 @@
 """
 indicators.py - Индикаторы и торговая стратегия
 """
+import json
+import pickle
+import asyncio
 import time
 import logging
 from typing import Optional, Dict, List, Tuple
 from collections import defaultdict, deque
 import httpx
+import numpy as np
 
 from config import (
-    CANDLE_TF, MAX_CANDLES, PRICE_CACHE_TTL,
+    CANDLE_TF, TIMEFRAME, MAX_CANDLES, PRICE_CACHE_TTL,
+    BINANCE_API_URL, BULK_TICKER_MAX_SYMBOLS, HTTP_CONCURRENCY,
     EMA_FAST, EMA_SLOW, EMA_TREND, EMA_LONG_TREND,
     RSI_PERIOD, RSI_OVERSOLD, RSI_OVERBOUGHT,
     MACD_FAST, MACD_SLOW, MACD_SIGNAL,
@@ -44,40 +49,473 @@ class PriceCache:
 
 PRICE_CACHE = PriceCache()
 
+# ==================== STREAMING INDICATORS ====================
+VOLUME_PERIOD = 20
+ATR_PERIOD = 14
+
+def _ema_step(value: float, prev: Optional[float], period: int) -> float:
+    """Один шаг EMA (первое значение - затравка, как в ema())"""
+    if prev is None:
+        return value
+    k = 2 / (period + 1)
+    return value * k + prev * (1 - k)
+
+def _window_sum(window: deque, total: float, size: int, extra: Optional[float]) -> Tuple[float, int]:
+    """Сумма последних size значений окна закрытых свечей + текущее значение"""
+    if extra is None:
+        return total, len(window)
+    if len(window) >= size:
+        return total - window[0] + extra, size
+    return total + extra, len(window) + 1
+
+class IndicatorState:
+    """Инкрементальное состояние индикаторов одной пары.
+
+    Закрытые свечи коммитятся через push() за O(1); текущая (незакрытая)
+    свеча хранится по ссылке, и её вклад досчитывается при чтении тоже за O(1).
+    """
+    EMA_PERIODS = (EMA_FAST, EMA_SLOW, EMA_TREND, EMA_LONG_TREND, MACD_FAST, MACD_SLOW)
+
+    def __init__(self):
+        self.closed = 0
+        self.current: Optional[dict] = None
+        self.last_close: Optional[float] = None
+        self.emas: Dict[int, Optional[float]] = {p: None for p in self.EMA_PERIODS}
+        # RSI: скользящее окно изменений (как rsi()) + сглаживание Уайлдера
+        self.gains: deque = deque(maxlen=RSI_PERIOD)
+        self.losses: deque = deque(maxlen=RSI_PERIOD)
+        self.gain_sum = 0.0
+        self.loss_sum = 0.0
+        self.wilder_gain: Optional[float] = None
+        self.wilder_loss: Optional[float] = None
+        # MACD
+        self.macd_signal: Optional[float] = None
+        # Bollinger: скользящие суммы и суммы квадратов
+        self.bb_window: deque = deque(maxlen=BB_PERIOD)
+        self.bb_sum = 0.0
+        self.bb_sq_sum = 0.0
+        # ATR и объём
+        self.tr_window: deque = deque(maxlen=ATR_PERIOD)
+        self.tr_sum = 0.0
+        self.vol_window: deque = deque(maxlen=VOLUME_PERIOD + 1)
+        self.vol_sum = 0.0
+
+    @property
+    def count(self) -> int:
+        """Количество свечей (закрытые + текущая)"""
+        return self.closed + (1 if self.current is not None else 0)
+
+    @staticmethod
+    def _roll(window: deque, total: float, value: float) -> float:
+        if len(window) == window.maxlen:
+            total -= window[0]
+        window.append(value)
+        return total + value
+
+    def _true_range(self, candle: dict) -> Optional[float]:
+        if self.last_close is None:
+            return None
+        h, l, pc = candle["h"], candle["l"], self.last_close
+        return max(h - l, abs(h - pc), abs(l - pc))
+
+    def push(self, candle: dict):
+        """Закоммитить закрытую свечу"""
+        self.push_values(candle["h"], candle["l"], candle["c"], candle.get("v", 0))
+
+    def push_values(self, high: float, low: float, close: float, volume: float):
+        """Закоммитить закрытую свечу по значениям (загрузка массивов без dict на строку)"""
+        fast_slow_ready = self.closed + 1 >= MACD_SLOW
+
+        for period in self.EMA_PERIODS:
+            self.emas[period] = _ema_step(close, self.emas[period], period)
+
+        if fast_slow_ready:
+            macd_val = self.emas[MACD_FAST] - self.emas[MACD_SLOW]
+            self.macd_signal = _ema_step(macd_val, self.macd_signal, MACD_SIGNAL)
+
+        if self.last_close is not None:
+            change = close - self.last_close
+            gain, loss = max(0, change), max(0, -change)
+            self.gain_sum = self._roll(self.gains, self.gain_sum, gain)
+            self.loss_sum = self._roll(self.losses, self.loss_sum, loss)
+            if self.wilder_gain is None:
+                if len(self.gains) == RSI_PERIOD:
+                    self.wilder_gain = self.gain_sum / RSI_PERIOD
+                    self.wilder_loss = self.loss_sum / RSI_PERIOD
+            else:
+                self.wilder_gain = (self.wilder_gain * (RSI_PERIOD - 1) + gain) / RSI_PERIOD
+                self.wilder_loss = (self.wilder_loss * (RSI_PERIOD - 1) + loss) / RSI_PERIOD
+            pc = self.last_close
+            true_range = max(high - low, abs(high - pc), abs(low - pc))
+            self.tr_sum = self._roll(self.tr_window, self.tr_sum, true_range)
+
+        if len(self.bb_window) == BB_PERIOD:
+            self.bb_sq_sum -= self.bb_window[0] ** 2
+        self.bb_sum = self._roll(self.bb_window, self.bb_sum, close)
+        self.bb_sq_sum += close ** 2
+        self.vol_sum = self._roll(self.vol_window, self.vol_sum, volume)
+
+        self.last_close = close
+        self.closed += 1
+
+    # ---------- чтение (с учётом текущей свечи) ----------
+    def ema(self, period: int) -> Optional[float]:
+        if self.count < period:
+            return None
+        value = self.emas[period]
+        if self.current is not None:
+            value = _ema_step(self.current["c"], value, period)
+        return value
+
+    def _current_change(self) -> Optional[Tuple[float, float]]:
+        if self.current is None or self.last_close is None:
+            return None
+        change = self.current["c"] - self.last_close
+        return max(0, change), max(0, -change)
+
+    def rsi(self) -> Optional[float]:
+        """RSI по простому среднему (совпадает с rsi())"""
+        cur = self._current_change()
+        gain_sum, n = _window_sum(self.gains, self.gain_sum, RSI_PERIOD, cur[0] if cur else None)
+        loss_sum, _ = _window_sum(self.losses, self.loss_sum, RSI_PERIOD, cur[1] if cur else None)
+        if n < RSI_PERIOD:
+            return None
+        if loss_sum <= 0:
+            return 100.0
+        return 100 - (100 / (1 + gain_sum / loss_sum))
+
+    def rsi_wilder(self) -> Optional[float]:
+        """RSI со сглаживанием Уайлдера"""
+        avg_gain, avg_loss = self.wilder_gain, self.wilder_loss
+        cur = self._current_change()
+        if avg_gain is None:
+            if cur is None or len(self.gains) < RSI_PERIOD - 1:
+                return None
+            avg_gain = (self.gain_sum + cur[0]) / RSI_PERIOD
+            avg_loss = (self.loss_sum + cur[1]) / RSI_PERIOD
+        elif cur is not None:
+            avg_gain = (avg_gain * (RSI_PERIOD - 1) + cur[0]) / RSI_PERIOD
+            avg_loss = (avg_loss * (RSI_PERIOD - 1) + cur[1]) / RSI_PERIOD
+        if avg_loss == 0:
+            return 100.0
+        return 100 - (100 / (1 + avg_gain / avg_loss))
+
+    def macd(self) -> Optional[Tuple[float, float, float]]:
+        if self.count < MACD_SLOW + MACD_SIGNAL:
+            return None
+        ema_fast, ema_slow = self.ema(MACD_FAST), self.ema(MACD_SLOW)
+        macd_line = ema_fast - ema_slow
+        signal_line = self.macd_signal
+        if self.current is not None:
+            signal_line = _ema_step(macd_line, signal_line, MACD_SIGNAL)
+        return macd_line, signal_line, macd_line - signal_line
+
+    def bollinger_bands(self) -> Optional[Tuple[float, float, float]]:
+        cur = self.current["c"] if self.current is not None else None
+        total, n = _window_sum(self.bb_window, self.bb_sum, BB_PERIOD, cur)
+        if n < BB_PERIOD:
+            return None
+        sq_total = self.bb_sq_sum
+        if cur is not None:
+            sq_total += cur ** 2
+            if len(self.bb_window) >= BB_PERIOD:
+                sq_total -= self.bb_window[0] ** 2
+        middle = total / BB_PERIOD
+        variance = max(0.0, sq_total / BB_PERIOD - middle ** 2)
+        std = variance ** 0.5
+        return middle + std * BB_STD, middle, middle - std * BB_STD
+
+    def volume_strength(self) -> Optional[float]:
+        if self.current is not None:
+            window = len(self.vol_window)
+            if window < VOLUME_PERIOD:
+                return None
+            prev_sum = self.vol_sum - (self.vol_window[0] if window > VOLUME_PERIOD else 0)
+            current_volume = self.current.get("v", 0)
+        else:
+            if len(self.vol_window) < VOLUME_PERIOD + 1:
+                return None
+            current_volume = self.vol_window[-1]
+            prev_sum = self.vol_sum - current_volume
+        avg_volume = prev_sum / VOLUME_PERIOD
+        if avg_volume == 0:
+            return 1.0
+        return current_volume / avg_volume
+
+    def atr(self) -> Optional[float]:
+        tr = self._true_range(self.current) if self.current is not None else None
+        total, n = _window_sum(self.tr_window, self.tr_sum, ATR_PERIOD, tr)
+        if n < ATR_PERIOD:
+            return None
+        return total / ATR_PERIOD
+
 # ==================== CANDLE STORAGE ====================
+CANDLE_FIELDS = ("ts", "o", "h", "l", "c", "v")
+_FIELD_INDEX = {name: i for i, name in enumerate(CANDLE_FIELDS)}
+
+class CandleRing:
+    """Колоночный кольцевой буфер свечей одной пары (float64).
+
+    Каждая строка пишется дважды - в слот i и i + capacity, поэтому
+    последние size свечей всегда лежат непрерывно и отдаются как view без копий.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.data = np.zeros((len(CANDLE_FIELDS), 2 * capacity), dtype=np.float64)
+        self.start = 0
+        self.size = 0
+
+    def _write(self, slot: int, row):
+        self.data[:, slot] = row
+        self.data[:, slot + self.capacity] = row
+
+    def append(self, row):
+        """Добавить свечу (ts, o, h, l, c, v), вытесняя самую старую"""
+        if self.size < self.capacity:
+            slot = (self.start + self.size) % self.capacity
+            self.size += 1
+        else:
+            slot = self.start
+            self.start = (self.start + 1) % self.capacity
+        self._write(slot, row)
+
+    def extend(self, rows: np.ndarray):
+        """Заполнить пустой буфер пачкой строк (N x 6) одной векторной записью"""
+        rows = rows[-self.capacity:]
+        n = len(rows)
+        self.start = 0
+        self.size = n
+        self.data[:, :n] = rows.T
+        self.data[:, self.capacity:self.capacity + n] = rows.T
+
+    def set_last(self, row):
+        """Перезаписать последнюю свечу"""
+        self._write((self.start + self.size - 1) % self.capacity, row)
+
+    def view(self, field: str) -> np.ndarray:
+        """Колонка в хронологическом порядке (view, меняется при записи)"""
+        return self.data[_FIELD_INDEX[field], self.start:self.start + self.size]
+
+    def views(self) -> np.ndarray:
+        """Все колонки (6 x size) в порядке CANDLE_FIELDS"""
+        return self.data[:, self.start:self.start + self.size]
+
 class CandleStorage:
-    """Хранилище свечей"""
+    """Хранилище свечей (колоночное, на кольцевых буферах NumPy)"""
     def __init__(self, timeframe=CANDLE_TF, maxlen=MAX_CANDLES):
         self.tf = timeframe
         self.maxlen = maxlen
-        self.candles: Dict[str, deque] = defaultdict(lambda: deque(maxlen=maxlen))
+        # maxlen закрытых свечей + текущая (последняя строка буфера)
+        self.rings: Dict[str, CandleRing] = {}
         self.current: Dict[str, dict] = {}
-    
+        self.states: Dict[str, IndicatorState] = defaultdict(IndicatorState)
+        # Закрытые свечи, ещё не записанные в БД (копятся, только если persist=True)
+        self.persist = False
+        self.pending: List[Tuple[str, dict]] = []
+
     def get_bucket(self, ts: float) -> int:
         return int(ts // self.tf) * self.tf
-    
+
+    def _ring(self, pair: str) -> CandleRing:
+        ring = self.rings.get(pair)
+        if ring is None:
+            ring = self.rings[pair] = CandleRing(self.maxlen + 1)
+        return ring
+
+    @staticmethod
+    def _row(candle: dict) -> Tuple[float, ...]:
+        return tuple(candle.get(name, 0) for name in CANDLE_FIELDS)
+
+    def _close_current(self, pair: str):
+        """Закоммитить текущую свечу (она уже лежит в буфере последней строкой)"""
+        candle = self.current[pair]
+        self.states[pair].push(candle)
+        if self.persist:
+            self.pending.append((pair, candle))
+
+    def add_candle(self, pair: str, candle: dict):
+        """Добавить закрытую свечу (импорт истории, до начала сбора цен)"""
+        pair = pair.upper()
+        self._ring(pair).append(self._row(candle))
+        self.states[pair].push(candle)
+
+    def load(self, pair: str, candles: List[dict]):
+        """Загрузить сохранённую историю: последняя свеча становится текущей,
+        чтобы живые цены того же бакета дописывались в неё, а не дублировали
+        """
+        if not candles:
+            return
+        self.clear(pair)
+        for candle in candles[:-1]:
+            self.add_candle(pair, candle)
+        self.upsert_candle(pair, candles[-1])
+
+    def load_array(self, pair: str, rows: np.ndarray):
+        """Загрузить историю из массива (N x 6, порядок CANDLE_FIELDS), например
+        view на mmap-архив: буфер заполняется одной копией, состояние индикаторов
+        считается по колонкам (без dict на строку), последняя строка - текущая свеча
+        """
+        if not len(rows):
+            return
+        pair = pair.upper()
+        self.clear(pair)
+        rows = rows[-(self.maxlen + 1):]
+        self._ring(pair).extend(rows)
+        state = self.states[pair]
+        closed = rows[:-1]
+        columns = (closed[:, _FIELD_INDEX[name]].tolist() for name in ("h", "l", "c", "v"))
+        for high, low, close, volume in zip(*columns):
+            state.push_values(high, low, close, volume)
+        last = dict(zip(CANDLE_FIELDS, rows[-1].tolist()))
+        last["ts"] = int(last["ts"])
+        self.current[pair] = last
+        state.current = last
+
+    def drain_pending(self) -> List[Tuple[str, dict]]:
+        """Забрать накопленные закрытые свечи для записи в БД"""
+        rows, self.pending = self.pending, []
+        return rows
+
     def add_price(self, pair: str, price: float, volume: float, ts: float):
         pair = pair.upper()
         bucket = self.get_bucket(ts)
-        
+        ring = self._ring(pair)
+
         if pair not in self.current or self.current[pair]["ts"] != bucket:
             if pair in self.current:
-                self.candles[pair].append(self.current[pair])
+                self._close_current(pair)
             self.current[pair] = {
                 "ts": bucket, "o": price, "h": price, "l": price, "c": price, "v": volume
             }
+            self.states[pair].current = self.current[pair]
+            ring.append(self._row(self.current[pair]))
         else:
             c = self.current[pair]
             c["h"] = max(c["h"], price)
             c["l"] = min(c["l"], price)
             c["c"] = price
             c["v"] += volume
-    
+            ring.set_last(self._row(c))
+
+    def upsert_candle(self, pair: str, candle: dict):
+        """Записать готовую свечу биржи (kline) вместо синтеза из тиков
+
+        Свеча текущего бакета перезаписывается, свеча нового бакета
+        коммитит текущую; свечи старше текущей игнорируются.
+        """
+        pair = pair.upper()
+        ring = self._ring(pair)
+        current = self.current.get(pair)
+        candle = {name: candle[name] for name in CANDLE_FIELDS}
+        candle["ts"] = self.get_bucket(candle["ts"])
+
+        if current is not None and candle["ts"] < current["ts"]:
+            return
+        if current is not None and candle["ts"] == current["ts"]:
+            current.update(candle)
+            ring.set_last(self._row(current))
+            return
+        if current is not None:
+            self._close_current(pair)
+        self.current[pair] = candle
+        self.states[pair].current = candle
+        ring.append(self._row(candle))
+
+    def last_ts(self, pair: str) -> Optional[int]:
+        """Время открытия последней свечи пары (включая текущую)"""
+        ring = self.rings.get(pair.upper())
+        if ring is None or ring.size == 0:
+            return None
+        return int(ring.view("ts")[-1])
+
+    def missing_buckets(self, pair: str, now: float) -> List[int]:
+        """Пропущенные закрытые бакеты в окне последних maxlen свечей пары"""
+        ts = self.get_column(pair, "ts")
+        if not len(ts):
+            return []
+        end = self.get_bucket(now) - self.tf  # последняя закрытая свеча
+        start = max(int(ts[0]), end - (self.maxlen - 1) * self.tf)
+        if end < start:
+            return []
+        expected = np.arange(start, end + self.tf, self.tf, dtype=np.float64)
+        return [int(b) for b in np.setdiff1d(expected, ts, assume_unique=True)]
+
+    def fill_gaps(self, pair: str, candles: List[dict]) -> int:
+        """Вставить догруженные свечи в пропуски истории (существующие не трогаются).
+
+        Буфер и состояние индикаторов пересобираются по отсортированной истории;
+        последняя свеча остаётся текущей. Возвращает число вставленных свечей.
+        """
+        pair = pair.upper()
+        ring = self.rings.get(pair)
+        if ring is None or not candles:
+            return 0
+        rows = {int(row[0]): row for row in ring.views().T.copy()}
+        added = []
+        for candle in candles:
+            bucket = self.get_bucket(candle["ts"])
+            if bucket not in rows:
+                candle = {name: candle[name] for name in CANDLE_FIELDS}
+                candle["ts"] = bucket
+                rows[bucket] = np.array(self._row(candle), dtype=np.float64)
+                added.append(candle)
+        if not added:
+            return 0
+        self.load_array(pair, np.array([rows[b] for b in sorted(rows)]))
+        if self.persist:
+            self.pending.extend((pair, c) for c in added)
+        return len(added)
+
+    def clear(self, pair: str):
+        """Сбросить историю и состояние индикаторов пары"""
+        pair = pair.upper()
+        self.rings.pop(pair, None)
+        self.current.pop(pair, None)
+        self.states.pop(pair, None)
+
+    def get_state(self, pair: str) -> IndicatorState:
+        return self.states[pair.upper()]
+
+    def snapshot(self, pair: str) -> Tuple[str, IndicatorState, np.ndarray]:
+        """(pair, state, closes) для анализа в другом процессе - без копирования.
+
+        Снимок ссылается на живые данные: сериализуйте его (pickle) сразу,
+        пока event loop не изменил состояние.
+        """
+        pair = pair.upper()
+        return pair, self.get_state(pair), self.get_column(pair, "c")
+
+    def count(self, pair: str) -> int:
+        ring = self.rings.get(pair.upper())
+        return ring.size if ring else 0
+
+    def get_column(self, pair: str, field: str) -> np.ndarray:
+        """Колонка ts/o/h/l/c/v (включая текущую свечу) без копирования"""
+        ring = self.rings.get(pair.upper())
+        if ring is None:
+            return np.empty(0, dtype=np.float64)
+        return ring.view(field)
+
+    def get_columns(self, pair: str) -> np.ndarray:
+        """Все колонки (6 x N) в порядке CANDLE_FIELDS без копирования"""
+        ring = self.rings.get(pair.upper())
+        if ring is None:
+            return np.empty((len(CANDLE_FIELDS), 0), dtype=np.float64)
+        return ring.views()
+
     def get_candles(self, pair: str) -> List[dict]:
+        """Совместимость: свечи списком словарей"""
         pair = pair.upper()
-        result = list(self.candles[pair])
+        ring = self.rings.get(pair)
+        if ring is None:
+            return []
+        ts, o, h, l, c, v = ring.views().tolist()
+        result = [
+            {"ts": int(ts[i]), "o": o[i], "h": h[i], "l": l[i], "c": c[i], "v": v[i]}
+            for i in range(ring.size)
+        ]
         if pair in self.current:
-            result.append(self.current[pair])
+            result[-1] = self.current[pair]
         return result
 
 CANDLES = CandleStorage()
@@ -90,7 +528,7 @@ async def fetch_price(client: httpx.AsyncClient, pair: str) -> Optional[Tuple[fl
         return cached
     
     try:
-        url = f"https://api.binance.com/api/v3/ticker/24hr?symbol={pair.upper()}"
+        url = f"{BINANCE_API_URL}/api/v3/ticker/24hr?symbol={pair.upper()}"
         resp = await client.get(url, timeout=5.0)
         resp.raise_for_status()
         data = resp.json()
@@ -103,6 +541,90 @@ async def fetch_price(client: httpx.AsyncClient, pair: str) -> Optional[Tuple[fl
         logger.error(f"Error fetching {pair}: {e}")
         return None
 
+async def fetch_prices(client: httpx.AsyncClient, pairs: List[str]) -> Dict[str, Tuple[float, float]]:
+    """Получить цены всех пар одним запросом к Binance
+
+    До BULK_TICKER_MAX_SYMBOLS пар - форма symbols=[...], больше - тикеры
+    всех символов. Если bulk-запрос отклонён (например, из-за
+    несуществующего символа), пары добираются по одной через fetch_price.
+    """
+    result: Dict[str, Tuple[float, float]] = {}
+    missing = []
+    for pair in {p.upper() for p in pairs}:
+        cached = PRICE_CACHE.get(pair)
+        if cached:
+            result[pair] = cached
+        else:
+            missing.append(pair)
+    
+    if not missing:
+        return result
+    
+    url = f"{BINANCE_API_URL}/api/v3/ticker/24hr"
+    if len(missing) <= BULK_TICKER_MAX_SYMBOLS:
+        params = {"symbols": json.dumps(sorted(missing), separators=(",", ":"))}
+    else:
+        params = None
+    
+    try:
+        resp = await client.get(url, params=params, timeout=10.0)
+        resp.raise_for_status()
+        wanted = set(missing)
+        for data in resp.json():
+            pair = data["symbol"]
+            if pair not in wanted:
+                continue
+            price = float(data["lastPrice"])
+            volume = float(data["volume"])
+            PRICE_CACHE.set(pair, price, volume)
+            result[pair] = (price, volume)
+    except Exception as e:
+        logger.error(f"Error fetching bulk tickers ({len(missing)} pairs): {e}")
+        result.update(await fetch_prices_concurrent(client, missing))
+    
+    return result
+
+def kline_to_candle(kline: list) -> dict:
+    """Строка klines Binance -> свеча хранилища"""
+    return {
+        "ts": int(kline[0] // 1000),
+        "o": float(kline[1]),
+        "h": float(kline[2]),
+        "l": float(kline[3]),
+        "c": float(kline[4]),
+        "v": float(kline[5]),
+    }
+
+async def fetch_klines(client: httpx.AsyncClient, pair: str, interval: str = TIMEFRAME,
+                       start_time: Optional[int] = None, end_time: Optional[int] = None,
+                       limit: int = 1000) -> Optional[List[dict]]:
+    """Получить свечи с Binance (start_time/end_time - в секундах)"""
+    params = {"symbol": pair.upper(), "interval": interval, "limit": limit}
+    if start_time is not None:
+        params["startTime"] = int(start_time * 1000)
+    if end_time is not None:
+        params["endTime"] = int(end_time * 1000)
+    
+    try:
+        resp = await client.get(f"{BINANCE_API_URL}/api/v3/klines", params=params, timeout=10.0)
+        resp.raise_for_status()
+        return [kline_to_candle(k) for k in resp.json()]
+    except Exception as e:
+        logger.error(f"Error fetching klines {pair}: {e}")
+        return None
+
+async def fetch_prices_concurrent(client: httpx.AsyncClient, pairs: List[str],
+                                  limit: int = HTTP_CONCURRENCY) -> Dict[str, Tuple[float, float]]:
+    """Поштучные запросы цен параллельно, не больше limit одновременно"""
+    semaphore = asyncio.Semaphore(limit)
+    
+    async def fetch_one(pair: str):
+        async with semaphore:
+            return pair, await fetch_price(client, pair)
+    
+    results = await asyncio.gather(*(fetch_one(p.upper()) for p in pairs))
+    return {pair: price_data for pair, price_data in results if price_data}
+
 # ==================== INDICATORS ====================
 def ema(values: List[float], period: int) -> Optional[float]:
     """Exponential Moving Average"""
@@ -135,36 +657,112 @@ def rsi(closes: List[float], period: int = RSI_PERIOD) -> Optional[float]:
         return 100.0
     return 100 - (100 / (1 + avg_gain / avg_loss))
 
-def macd(closes: List[float]) -> Optional[Tuple[float, float, float]]:
-    """MACD индикатор - (macd_line, signal_line, histogram)"""
-    if len(closes) < MACD_SLOW + MACD_SIGNAL:
-        return None
+def rsi_series(closes: List[float], period: int = RSI_PERIOD, wilder: bool = False) -> List[Optional[float]]:
+    """RSI для каждой позиции за один проход (None, пока не хватает данных)
+
+    wilder=False - простое среднее за period изменений (как rsi()),
+    wilder=True  - сглаживание Уайлдера.
+    """
+    result: List[Optional[float]] = [None] * min(len(closes), period)
+    if len(closes) < period + 1:
+        return result
     
-    ema_fast = ema(closes, MACD_FAST)
-    ema_slow = ema(closes, MACD_SLOW)
+    gains: deque = deque()
+    losses: deque = deque()
+    gain_sum = loss_sum = 0.0
+    # Счётчики ненулевых значений в окне - чтобы накопленная погрешность
+    # скользящих сумм не превращала "нет падений" в крошечный loss_sum
+    gain_nonzero = loss_nonzero = 0
+    avg_gain = avg_loss = None
     
-    if ema_fast is None or ema_slow is None:
-        return None
+    for i in range(1, len(closes)):
+        change = closes[i] - closes[i-1]
+        gain, loss = max(0, change), max(0, -change)
+        
+        if wilder and avg_gain is not None:
+            avg_gain = (avg_gain * (period - 1) + gain) / period
+            avg_loss = (avg_loss * (period - 1) + loss) / period
+        else:
+            gains.append(gain)
+            losses.append(loss)
+            gain_sum += gain
+            loss_sum += loss
+            gain_nonzero += gain > 0
+            loss_nonzero += loss > 0
+            if len(gains) > period:
+                old_gain, old_loss = gains.popleft(), losses.popleft()
+                gain_sum -= old_gain
+                loss_sum -= old_loss
+                gain_nonzero -= old_gain > 0
+                loss_nonzero -= old_loss > 0
+            if len(gains) < period:
+                continue
+            avg_gain = gain_sum / period if gain_nonzero else 0.0
+            avg_loss = loss_sum / period if loss_nonzero else 0.0
+        
+        if avg_loss == 0:
+            result.append(100.0)
+        else:
+            result.append(100 - (100 / (1 + avg_gain / avg_loss)))
     
-    macd_line = ema_fast - ema_slow
+    return result
+
+def ema_series(values: List[float], period: int) -> List[Optional[float]]:
+    """EMA для каждой позиции за один проход (None, пока значений меньше period)"""
+    result: List[Optional[float]] = []
+    e = None
+    for i, v in enumerate(values):
+        e = _ema_step(v, e, period)
+        result.append(e if i + 1 >= period else None)
+    return result
+
+def macd_series(closes: List[float]) -> Optional[Tuple[List[Optional[float]], List[Optional[float]], List[Optional[float]]]]:
+    """Серии MACD за один проход - (macd_line, signal_line, histogram)
+
+    Списки выровнены по closes, None - где значение ещё не определено.
+    Сигнальная линия, как в прежнем macd(), - EMA от последних
+    MACD_SLOW + MACD_SIGNAL значений MACD, заново затравленная в начале окна;
+    окно фиксированной длины, поэтому проход линейный.
+    """
+    if len(closes) < MACD_SLOW + MACD_SIGNAL:
+        return None
     
-    macd_history = []
-    for i in range(len(closes) - MACD_SLOW - MACD_SIGNAL, len(closes)):
-        if i < MACD_FAST:
+    macd_line: List[Optional[float]] = []
+    signal_line: List[Optional[float]] = []
+    histogram: List[Optional[float]] = []
+    window: deque = deque(maxlen=MACD_SLOW + MACD_SIGNAL)
+    ef = es = None
+    for i, close in enumerate(closes):
+        ef = _ema_step(close, ef, MACD_FAST)
+        es = _ema_step(close, es, MACD_SLOW)
+        if i + 1 < MACD_SLOW:
+            macd_line.append(None)
+            signal_line.append(None)
+            histogram.append(None)
             continue
-        ef = ema(closes[:i+1], MACD_FAST)
-        es = ema(closes[:i+1], MACD_SLOW)
-        if ef and es:
-            macd_history.append(ef - es)
+        
+        m = ef - es
+        window.append(m)
+        macd_line.append(m)
+        if len(window) >= MACD_SIGNAL:
+            sig = ema(list(window), MACD_SIGNAL)
+            signal_line.append(sig)
+            histogram.append(m - sig)
+        else:
+            signal_line.append(None)
+            histogram.append(None)
     
-    if len(macd_history) < MACD_SIGNAL:
+    return macd_line, signal_line, histogram
+
+def macd(closes: List[float]) -> Optional[Tuple[float, float, float]]:
+    """MACD индикатор - (macd_line, signal_line, histogram)"""
+    series = macd_series(closes)
+    if series is None:
         return None
     
-    signal_line = ema(macd_history, MACD_SIGNAL)
+    macd_line, signal_line, histogram = (s[-1] for s in series)
     if signal_line is None:
         return None
-    
-    histogram = macd_line - signal_line
     return macd_line, signal_line, histogram
 
 def bollinger_bands(closes: List[float]) -> Optional[Tuple[float, float, float]]:
@@ -265,52 +863,78 @@ def calculate_tp_sl(entry: float, side: str, atr_val: float) -> Dict:
     }
 
 # ==================== STRATEGY ====================
-def quick_screen(pair: str) -> bool:
-    """Быстрый скрининг - отсев слабых кандидатов"""
-    candles = CANDLES.get_candles(pair)
-    if len(candles) < 60:
+def batch_screen(pairs: List[str], min_candles: int = 60) -> Dict[str, float]:
+    """Скрининг списка пар (семантика quick_screen) без обращения к свечам
+
+    Цикл по парам читает EMA_FAST/EMA_SLOW из инкрементального IndicatorState
+    (O(1) на пару); RSI, Bollinger и объём здесь не считаются - они нужны
+    только глубокому анализу. Возвращает EMA-спред прошедших скрининг пар.
+    """
+    result = {}
+    for pair in pairs:
+        pair = pair.upper()
+        state = CANDLES.states.get(pair)
+        if state is None or state.count < min_candles:
+            continue
+        ema_fast, ema_slow = state.ema(EMA_FAST), state.ema(EMA_SLOW)
+        spread = abs(ema_fast - ema_slow) / ema_slow
+        if spread > 0.002:
+            result[pair] = spread
+    return result
+
+def _screen_state(state: IndicatorState) -> bool:
+    if state.count < 60:
         return False
     
-    closes = [c["c"] for c in candles]
-    ema9 = ema(closes, EMA_FAST)
-    ema21 = ema(closes, EMA_SLOW)
+    ema9 = state.ema(EMA_FAST)
+    ema21 = state.ema(EMA_SLOW)
     
     if ema9 is None or ema21 is None:
         return False
     
     return abs(ema9 - ema21) / ema21 > 0.002
 
+def quick_screen(pair: str) -> bool:
+    """Быстрый скрининг - отсев слабых кандидатов"""
+    return _screen_state(CANDLES.get_state(pair))
+
 def analyze_signal(pair: str) -> Optional[Dict]:
     """Глубокий анализ сигнала"""
-    if not quick_screen(pair):
+    return analyze_state(CANDLES.get_state(pair), CANDLES.get_column(pair, "c"))
+
+def analyze_batch(snapshots: List[Tuple[str, IndicatorState, np.ndarray]]) -> List[Tuple[str, Optional[Dict]]]:
+    """Анализ пачки снимков (pair, state, closes) - выполняется в воркере пула"""
+    return [(pair, analyze_state(state, closes)) for pair, state, closes in snapshots]
+
+def analyze_pickled(payload: bytes) -> List[Tuple[str, Optional[Dict]]]:
+    """Анализ пачки снимков, сериализованной в основном процессе"""
+    return analyze_batch(pickle.loads(payload))
+
+def analyze_state(state: IndicatorState, closes: np.ndarray) -> Optional[Dict]:
+    """Глубокий анализ по состоянию индикаторов и колонке close"""
+    if not _screen_state(state):
         return None
     
-    candles = CANDLES.get_candles(pair)
-    if len(candles) < 250:
+    if state.count < 250:
         return None
     
-    closes = [c["c"] for c in candles]
+    closes = closes.tolist()
     current_price = closes[-1]
     
-    # Все индикаторы
-    ema9 = ema(closes, EMA_FAST)
-    ema21 = ema(closes, EMA_SLOW)
-    ema50 = ema(closes, EMA_TREND)
-    ema200 = ema(closes, EMA_LONG_TREND) if len(closes) >= 200 else None
-    
-    # RSI история для дивергенций
-    rsi_history = []
-    for i in range(len(closes) - 50, len(closes)):
-        if i >= RSI_PERIOD:
-            rsi_val = rsi(closes[:i+1], RSI_PERIOD)
-            if rsi_val:
-                rsi_history.append(rsi_val)
-    
-    rsi_current = rsi(closes, RSI_PERIOD)
-    macd_data = macd(closes)
-    bb_data = bollinger_bands(closes)
-    vol_strength = volume_strength(candles, 20)
-    atr_val = atr(candles, 14)
+    # Все индикаторы (инкрементальное состояние, O(1))
+    ema9 = state.ema(EMA_FAST)
+    ema21 = state.ema(EMA_SLOW)
+    ema50 = state.ema(EMA_TREND)
+    ema200 = state.ema(EMA_LONG_TREND)
+    
+    # RSI история для дивергенций (один проход по closes)
+    rsi_history = [v for v in rsi_series(closes, RSI_PERIOD)[-50:] if v]
+    
+    rsi_current = state.rsi()
+    macd_data = state.macd()
+    bb_data = state.bollinger_bands()
+    vol_strength = state.volume_strength()
+    atr_val = state.atr()
     
     if None in [ema9, ema21, ema50, rsi_current, macd_data, bb_data, vol_strength, atr_val]:
         return None
@@ -441,4 +1065,4 @@ def analyze_signal(pair: str) -> Optional[Dict]:
             **tp_sl
         }
     
-    return None
\ No newline at end of file
+    return None
\ No newline at end of file
@@ -1,14 +1,23 @@
 """
 main.py - Точка входа приложения
 """
+import time
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher, executor
 
-from config import BOT_TOKEN
-from database import init_db
+from config import BOT_TOKEN, MARKET_DATA_MODE
+from database import init_db, db_pool, SIGNAL_LOG, SUBSCRIPTIONS
 from handlers import setup_handlers
-from tasks import price_collector, signal_analyzer
+from tasks import (
+    price_collector, kline_collector, stream_collector, signal_analyzer,
+    candle_persister, gap_scanner, warm_candles, flush_candles,
+    SIGNAL_COUNTS, OUTBOX, load_last_signals
+)
+from analysis import ANALYZER
+from market_data import MARKET_DATA
+from dispatcher import DISPATCHER
+from broadcasts import BROADCASTS
 
 # Настройка логирования
 logging.basicConfig(
@@ -31,12 +40,45 @@ async def on_startup(dp):
     # Инициализация БД
     await init_db()
     
+    # Индекс подписок: фоновые циклы читают пары и получателей из памяти
+    await SUBSCRIPTIONS.load()
+    
+    # Прогрев свечей из БД - сигналы доступны сразу после рестарта
+    started = time.monotonic()
+    loaded = await warm_candles()
+    logger.info(f"Loaded {loaded} candles in {time.monotonic() - started:.2f}s")
+    
+    # Счётчики сигналов за сегодня - лимит проверяется без запросов к БД
+    await SIGNAL_COUNTS.load()
+    
+    # Cooldown сигналов из БД - после рестарта тот же сигнал не уйдёт повторно
+    await load_last_signals()
+    
     # Регистрация обработчиков
     setup_handlers(dp)
     
+    # Пул процессов для анализа сигналов
+    ANALYZER.start()
+    
+    # Очередь и воркеры рассылки; доставка из outbox продолжает прерванные рассылки
+    DISPATCHER.start(bot)
+    OUTBOX.start()
+    
+    # Рассылки, прерванные рестартом, продолжаются с сохранённой позиции
+    resumed = await BROADCASTS.resume_all(bot)
+    if resumed:
+        logger.info(f"Resumed {resumed} broadcasts")
+    
     # Запуск фоновых задач
     loop = asyncio.get_event_loop()
-    loop.create_task(price_collector(bot))
+    if MARKET_DATA_MODE == "ws":
+        loop.create_task(stream_collector(bot))
+    elif MARKET_DATA_MODE == "klines":
+        loop.create_task(kline_collector(bot))
+    else:
+        loop.create_task(price_collector(bot))
+    loop.create_task(candle_persister())
+    loop.create_task(gap_scanner())
     loop.create_task(signal_analyzer(bot))
     
     logger.info("✅ Bot started successfully!")
@@ -44,6 +86,16 @@ async def on_startup(dp):
 async def on_shutdown(dp):
     """Остановка бота"""
     logger.info("Bot shutting down...")
+    # Ожидание воркеров анализа не должно останавливать event loop
+    await asyncio.get_running_loop().run_in_executor(None, ANALYZER.shutdown)
+    await flush_candles(include_current=True)
+    await BROADCASTS.stop()
+    await OUTBOX.stop()
+    await DISPATCHER.stop()
+    await SIGNAL_LOG.flush()
+    # Писатель дописывает очередь записей, соединения закрываются
+    await db_pool.close()
+    await MARKET_DATA.close()
     await bot.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+"""
+market_data.py - Общий HTTP-клиент для рыночных данных (пул соединений, keep-alive)
+"""
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+import httpx
+
+from config import (
+    HTTP_MAX_CONNECTIONS, HTTP_CONCURRENCY, TIMEFRAME, MAX_CANDLES,
+    KLINE_RETRY_DELAY, CHECK_INTERVAL
+)
+from indicators import (
+    CANDLES, fetch_price, fetch_prices, fetch_prices_concurrent, fetch_klines
+)
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+class MarketDataClient:
+    """Один httpx.AsyncClient на процесс: переиспользует TLS-соединения
+    между сборщиком цен и хендлерами вместо нового клиента на каждый запрос.
+    """
+    def __init__(self, max_connections: int = HTTP_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self._client: Optional[httpx.AsyncClient] = None
+        self._unfillable: Dict[str, Set[int]] = {}
+        self._backoff: Dict[str, Tuple[int, float]] = {}  # pair -> (неудач подряд, когда повторить)
+        self._closed: Dict[str, int] = {}       # pair -> ts последней закрытой свечи из klines
+        self._refreshed: Dict[str, float] = {}  # pair -> когда обновлялась открытая свеча
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=60.0,
+                ),
+                timeout=httpx.Timeout(10.0, connect=5.0),
+            )
+            logger.info(f"Market data client created (http2={HTTP2_AVAILABLE})")
+        return self._client
+
+    async def fetch_price(self, pair: str) -> Optional[Tuple[float, float]]:
+        return await fetch_price(self.client, pair)
+
+    async def fetch_prices(self, pairs: List[str]) -> Dict[str, Tuple[float, float]]:
+        """Bulk-запрос тикеров (с поштучным фолбэком)"""
+        return await fetch_prices(self.client, pairs)
+
+    async def fetch_many(self, pairs: List[str], limit: int = HTTP_CONCURRENCY) -> Dict[str, Tuple[float, float]]:
+        """Поштучные запросы, ограниченные семафором"""
+        return await fetch_prices_concurrent(self.client, pairs, limit)
+
+    def next_close(self, pairs: List[str]) -> Optional[float]:
+        """Ближайшее время, когда у какой-то из пар закроется новая свеча.
+
+        Пары без данных и пары на паузе после неудач не учитываются -
+        их подхватит следующий плановый проход сборщика.
+        """
+        tf = CANDLES.tf
+        times = []
+        for pair in pairs:
+            last_closed = self._last_closed(pair.upper())
+            if last_closed is not None and pair.upper() not in self._backoff:
+                times.append(last_closed + 2 * tf)
+        return min(times) if times else None
+
+    def _last_closed(self, pair: str) -> Optional[int]:
+        """Последняя закрытая свеча пары. До первой синхронизации последняя
+        свеча хранилища считается незакрытой (могла сохраниться при остановке)."""
+        if pair in self._closed:
+            return self._closed[pair]
+        last_ts = CANDLES.last_ts(pair)
+        return None if last_ts is None else last_ts - CANDLES.tf
+
+    def _failed(self, pair: str, now: float):
+        """Пара не дала новой закрытой свечи - повтор не раньше чем через
+        KLINE_RETRY_DELAY, с удвоением до одного таймфрейма"""
+        failures = self._backoff.get(pair, (0, 0.0))[0] + 1
+        delay = min(KLINE_RETRY_DELAY * 2 ** (failures - 1), CANDLES.tf)
+        self._backoff[pair] = (failures, now + delay)
+
+    async def sync_klines(self, pairs: List[str], now: Optional[float] = None,
+                          limit: int = HTTP_CONCURRENCY, refresh: float = CHECK_INTERVAL) -> int:
+        """Дозагрузить свечи после последней закрытой (startTime = last closed + tf)
+
+        Запрос делается для пар, у которых с прошлого раза закрылась свеча,
+        и раз в refresh секунд - чтобы обновить открытую свечу (как опрос
+        тикеров в режиме rest). Ответ включает открытую свечу - она пишется
+        текущей и перезаписывается закрытой при следующем запросе.
+        Возвращает число сделанных запросов.
+        """
+        now = time.time() if now is None else now
+        tf = CANDLES.tf
+        semaphore = asyncio.Semaphore(limit)
+        due = []
+        for pair in {p.upper() for p in pairs}:
+            if pair in self._backoff and now < self._backoff[pair][1]:
+                continue
+            last_closed = self._last_closed(pair)
+            closing = last_closed is None or now >= last_closed + 2 * tf
+            if closing or now - self._refreshed.get(pair, 0.0) >= refresh:
+                due.append((pair, last_closed, closing))
+
+        async def sync_one(pair: str, last_closed: Optional[int], closing: bool):
+            self._refreshed[pair] = now
+            async with semaphore:
+                if last_closed is None:
+                    candles = await fetch_klines(self.client, pair, TIMEFRAME, limit=MAX_CANDLES + 1)
+                else:
+                    candles = await fetch_klines(self.client, pair, TIMEFRAME, start_time=last_closed + tf)
+            candles = candles or []
+            for candle in candles:
+                CANDLES.upsert_candle(pair, candle)
+            closed = [c["ts"] for c in candles if c["ts"] + tf <= now]
+            if closed and (last_closed is None or max(closed) > last_closed):
+                self._closed[pair] = max(closed)
+                self._backoff.pop(pair, None)
+            elif closing:
+                # Ошибка, неизвестная пара или свеча ещё не опубликована - пауза
+                self._failed(pair, now)
+
+        await asyncio.gather(*(sync_one(*item) for item in due))
+        return len(due)
+
+    async def backfill_gaps(self, pairs: List[str], now: Optional[float] = None,
+                            limit: int = HTTP_CONCURRENCY) -> int:
+        """Найти пропущенные свечи в окне истории пар и догрузить только их
+
+        На пару - один запрос klines от первого до последнего пропуска
+        (окно истории меньше лимита 1000). Бакеты, которых нет и на бирже
+        (остановка торгов), запоминаются и больше не запрашиваются, пока
+        не уйдут из окна истории. Возвращает число сделанных запросов.
+        """
+        now = time.time() if now is None else now
+        semaphore = asyncio.Semaphore(limit)
+        # Бакеты старше окна истории больше не проверяются - забываем их
+        window_start = CANDLES.get_bucket(now) - CANDLES.maxlen * CANDLES.tf
+        for pair in list(self._unfillable):
+            buckets = {b for b in self._unfillable[pair] if b >= window_start}
+            if buckets:
+                self._unfillable[pair] = buckets
+            else:
+                del self._unfillable[pair]
+        due = {}
+        for pair in {p.upper() for p in pairs}:
+            missing = [b for b in CANDLES.missing_buckets(pair, now)
+                       if b not in self._unfillable.get(pair, ())]
+            if missing:
+                due[pair] = missing
+
+        async def fill(pair: str, missing: List[int]):
+            async with semaphore:
+                candles = await fetch_klines(self.client, pair, TIMEFRAME,
+                                             start_time=missing[0], end_time=missing[-1])
+            if candles is None:
+                return
+            wanted = set(missing)
+            candles = [c for c in candles if c["ts"] in wanted]
+            self._unfillable.setdefault(pair, set()).update(wanted - {c["ts"] for c in candles})
+            added = CANDLES.fill_gaps(pair, candles)
+            if added:
+                logger.info(f"Backfilled {added} missing candles for {pair}")
+
+        await asyncio.gather(*(fill(pair, missing) for pair, missing in due.items()))
+        return len(due)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+# Глобальный клиент рыночных данных
+MARKET_DATA = MarketDataClient()
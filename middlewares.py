@@ -0,0 +1,18 @@
+"""
+middlewares.py - Middleware aiogram: контекст пользователя для хендлеров
+"""
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from database import get_user_profile
+
+class UserContextMiddleware(BaseMiddleware):
+    """Загружает профиль пользователя (lang, paid, balance, pairs) один раз
+    на апдейт - из кэша или одним запросом - и передаёт его хендлерам
+    аргументом profile.
+    """
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        data["profile"] = await get_user_profile(message.from_user.id)
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        data["profile"] = await get_user_profile(call.from_user.id)
@@ -5,66 +5,321 @@ import time
 import asyncio
 import logging
 from collections import defaultdict
-import httpx
+from datetime import date, datetime
+from typing import Dict, Iterable, Optional
 from aiogram import Bot
-from aiogram.utils.exceptions import RetryAfter, TelegramAPIError
 
 from config import (
     CHECK_INTERVAL, DEFAULT_PAIRS, 
     MAX_SIGNALS_PER_DAY, SIGNAL_COOLDOWN,
-    BATCH_SEND_SIZE, BATCH_SEND_DELAY
+    WS_RECONCILE_INTERVAL,
+    CANDLE_FLUSH_INTERVAL, CANDLE_RETENTION, CANDLE_PRUNE_INTERVAL, CANDLE_STORE, GAP_SCAN_INTERVAL,
+    OUTBOX_BATCH, OUTBOX_POLL_INTERVAL, OUTBOX_RETENTION, OUTBOX_RETRY_DELAY, OUTBOX_MAX_ATTEMPTS,
+    KLINE_RETRY_DELAY
 )
 from database import (
-    get_all_tracked_pairs, get_pairs_with_users,
-    count_signals_today, log_signal
-)
-from indicators import (
-    CANDLES, PRICE_CACHE, fetch_price, analyze_signal
+    SUBSCRIPTIONS,
+    count_signal_events, log_signal, SIGNAL_LOG,
+    save_candles, load_candles, prune_candles, get_candle_depths,
+    queue_signal, claim_outbox, mark_outbox, purge_outbox, load_signal_cooldowns
 )
+from indicators import CANDLES, PRICE_CACHE, batch_screen
+from analysis import ANALYZER
+from market_data import MARKET_DATA
+from ws_ingest import INGESTOR
+from candle_archive import CandleArchive
+from dispatcher import DISPATCHER, SENT, UNREACHABLE
+
+# Бинарный архив свечей (используется при CANDLE_STORE=mmap)
+ARCHIVE = CandleArchive() if CANDLE_STORE == "mmap" else None
 
 logger = logging.getLogger(__name__)
 
-# Глобальный словарь для cooldown сигналов
+# Глобальный словарь для cooldown сигналов (копия таблицы signal_cooldowns)
 LAST_SIGNALS = {}
 
-# ==================== HELPER FUNCTIONS ====================
-async def send_message_safe(bot: Bot, user_id: int, text: str, **kwargs):
-    """Безопасная отправка с обработкой rate limit"""
-    try:
-        await bot.send_message(user_id, text, **kwargs)
-        return True
-    except RetryAfter as e:
-        await asyncio.sleep(e.timeout)
-        return await send_message_safe(bot, user_id, text, **kwargs)
-    except TelegramAPIError:
-        return False
+class DailySignalCounter:
+    """Счётчик сигнальных событий по парам за текущие сутки (в памяти).
+
+    Считает рассылки, а не получателей; при смене дня обнуляется.
+    """
+    def __init__(self):
+        self.day = None
+        self.counts = defaultdict(int)
+
+    def _roll(self):
+        today = date.today()
+        if today != self.day:
+            self.day = today
+            self.counts.clear()
+
+    def get(self, pair: str) -> int:
+        self._roll()
+        return self.counts.get(pair, 0)
+
+    def increment(self, pair: str):
+        self._roll()
+        self.counts[pair] += 1
+
+    async def load(self):
+        """Восстановить счётчики за сегодня из outbox_messages (при старте)"""
+        self._roll()
+        day_start = int(datetime.combine(self.day, datetime.min.time()).timestamp())
+        self.counts.update(await count_signal_events(day_start))
+
+# Глобальные счётчики сигналов за день
+SIGNAL_COUNTS = DailySignalCounter()
+
+class OutboxRelay:
+    """Доставка сообщений из outbox.
+
+    Очередь DISPATCHER не пустеет: следующая пачка забирается, как только
+    отправляемых строк становится меньше low_watermark, а каждая строка
+    отмечается сразу после доставки (готовые строки пишутся вместе).
+    Пока отметка не записана, строка остаётся ожидающей и будет забрана
+    снова (в том числе после рестарта). Временные ошибки (флуд, сеть,
+    остановка) повторяются с паузой, в failed попадают только недоступные
+    чаты и исчерпавшие попытки строки.
+    """
+    def __init__(self, batch: int = OUTBOX_BATCH, poll_interval: float = OUTBOX_POLL_INTERVAL,
+                 dispatcher=DISPATCHER, low_watermark: Optional[int] = None):
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self.dispatcher = dispatcher
+        self.low_watermark = batch // 2 if low_watermark is None else low_watermark
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.last_purge = 0.0
+        self.in_flight: Dict[asyncio.Future, dict] = {}  # future доставки -> строка outbox
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def wake(self):
+        """Есть новые сообщения - не ждать следующего опроса"""
+        self._wake.set()
+
+    async def _claim(self) -> int:
+        """Забрать пачку ожидающих строк (кроме уже отправляемых) и поставить в очередь"""
+        rows = await claim_outbox(self.batch, exclude=[row["id"] for row in self.in_flight.values()])
+        for row in rows:
+            on_sent = None
+            if row["kind"] == "signal":
+                async def on_sent(user_id, row=row):
+                    await log_signal(user_id, row["pair"], row["side"], row["price"], row["score"])
+            self.in_flight[self.dispatcher.enqueue(row["user_id"], row["text"], on_sent)] = row
+        return len(rows)
+
+    async def _mark(self, done: Iterable[asyncio.Future]):
+        """Записать итог доставленных строк одной транзакцией"""
+        # Отменённые при остановке future и прочие исключения - временная ошибка
+        sent, failed, retry = [], [], []
+        for future in done:
+            row = self.in_flight.pop(future)
+            result = None if future.cancelled() or future.exception() else future.result()
+            if result == SENT:
+                sent.append(row["id"])
+            elif result in UNREACHABLE:
+                failed.append(row["id"])
+            else:
+                retry.append(row["id"])
+        await mark_outbox(sent, failed, retry, int(time.time()), OUTBOX_RETRY_DELAY, OUTBOX_MAX_ATTEMPTS)
+        await SIGNAL_LOG.flush()
+        self.sent += len(sent)
+        self.failed += len(failed)
+        self.retried += len(retry)
+
+    async def _drain(self, timeout: Optional[float] = None) -> int:
+        """Дождаться хотя бы одной доставки и отметить готовые; вернуть их число"""
+        if not self.in_flight:
+            return 0
+        done, _ = await asyncio.wait(self.in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if done:
+            await self._mark(done)
+        return len(done)
+
+    async def run_once(self) -> int:
+        """Доставить одну пачку целиком; вернуть число обработанных строк"""
+        claimed = await self._claim()
+        while self.in_flight:
+            await self._drain()
+        return claimed
+
+    async def run(self):
+        logger.info("Outbox relay started")
+        while not self._stopping or self.in_flight:
+            self._wake.clear()
+            try:
+                if not self._stopping and len(self.in_flight) <= self.low_watermark:
+                    if await self._claim():
+                        continue
+                if self.in_flight:
+                    await self._drain(self.poll_interval)
+                    continue
+                now = time.time()
+                if now - self.last_purge >= 3600:
+                    self.last_purge = now
+                    await purge_outbox(int(now) - OUTBOX_RETENTION)
+            except Exception as e:
+                # Неотмеченные строки останутся ожидающими и будут забраны снова
+                logger.error(f"Outbox relay error: {e}")
+                self.in_flight = {f: row for f, row in self.in_flight.items() if not f.done()}
+            if self._stopping:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Не забирать новые строки, дождаться отправляемых (они будут отмечены) и остановиться"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self.wake()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox relay stopped mid-batch; unmarked rows will be resent")
+        self._task = None
+
+# Глобальная доставка из outbox
+OUTBOX = OutboxRelay()
+
+async def load_last_signals() -> int:
+    """Восстановить cooldown сигналов после рестарта"""
+    LAST_SIGNALS.update(await load_signal_cooldowns())
+    return len(LAST_SIGNALS)
 
 # ==================== TASKS ====================
 async def price_collector(bot: Bot):
     """Сбор цен с Binance"""
     logger.info("Price collector started")
-    async with httpx.AsyncClient() as client:
+    while True:
+        try:
+            # Получаем все отслеживаемые пары (из индекса подписок, без БД)
+            pairs = list(set(SUBSCRIPTIONS.tracked_pairs() + DEFAULT_PAIRS))
+            
+            # Собираем цены одним bulk-запросом через общий клиент
+            ts = time.time()
+            prices = await MARKET_DATA.fetch_prices(pairs)
+            for pair, (price, volume) in prices.items():
+                CANDLES.add_price(pair, price, volume, ts)
+            
+            # Очистка старого кэша
+            PRICE_CACHE.clear_old()
+            
+        except Exception as e:
+            logger.error(f"Price collector error: {e}")
+        
+        await asyncio.sleep(CHECK_INTERVAL)
+
+async def kline_collector(bot: Bot):
+    """Синхронизация свечей по klines (MARKET_DATA_MODE=klines): закрытые -
+    по закрытию, открытая - не реже CHECK_INTERVAL"""
+    logger.info("Kline collector started")
+    while True:
+        pairs = []
+        try:
+            pairs = list(set(SUBSCRIPTIONS.tracked_pairs() + DEFAULT_PAIRS))
+            requests = await MARKET_DATA.sync_klines(pairs)
+            if requests:
+                logger.info(f"Kline sync: {requests} pairs updated")
+        except Exception as e:
+            logger.error(f"Kline collector error: {e}")
+        
+        # Спим до ближайшего закрытия свечи (но не дольше CHECK_INTERVAL)
+        next_close = MARKET_DATA.next_close(pairs) if pairs else None
+        delay = CHECK_INTERVAL if next_close is None else next_close - time.time() + 1
+        await asyncio.sleep(min(max(delay, KLINE_RETRY_DELAY), CHECK_INTERVAL))
+
+async def stream_collector(bot: Bot):
+    """Потоковый сбор свечей по WebSocket (MARKET_DATA_MODE=ws)"""
+    logger.info("Stream collector started")
+    try:
         while True:
             try:
-                # Получаем все отслеживаемые пары
-                pairs = await get_all_tracked_pairs()
-                pairs = list(set(pairs + DEFAULT_PAIRS))
-                
-                # Собираем цены
-                ts = time.time()
-                for pair in pairs:
-                    price_data = await fetch_price(client, pair)
-                    if price_data:
-                        price, volume = price_data
-                        CANDLES.add_price(pair, price, volume, ts)
-                
-                # Очистка старого кэша
-                PRICE_CACHE.clear_old()
-                
+                # Сверяем подписки с парами пользователей
+                await INGESTOR.sync(set(SUBSCRIPTIONS.tracked_pairs() + DEFAULT_PAIRS))
             except Exception as e:
-                logger.error(f"Price collector error: {e}")
+                logger.error(f"Stream collector error: {e}")
             
-            await asyncio.sleep(CHECK_INTERVAL)
+            await asyncio.sleep(WS_RECONCILE_INTERVAL)
+    finally:
+        await INGESTOR.stop()
+
+async def flush_candles(include_current: bool = False) -> int:
+    """Записать накопленные закрытые свечи одной транзакцией
+
+    include_current=True (при остановке) сохраняет и незакрытые свечи,
+    чтобы после рестарта они продолжились, а не потерялись.
+    """
+    rows = CANDLES.drain_pending()
+    if include_current:
+        rows += list(CANDLES.current.items())
+    if rows:
+        try:
+            if ARCHIVE is not None:
+                await asyncio.to_thread(ARCHIVE.append_rows, rows)
+            else:
+                await save_candles(CANDLES.tf, rows)
+        except Exception:
+            # Вернём свечи в очередь, чтобы записать их в следующий раз
+            CANDLES.pending[:0] = [(p, c) for p, c in rows if c is not CANDLES.current.get(p)]
+            raise
+    return len(rows)
+
+async def candle_persister():
+    """Периодическая запись закрытых свечей в БД и удаление старых"""
+    logger.info("Candle persister started")
+    last_prune = time.monotonic() - CANDLE_PRUNE_INTERVAL  # первая очистка - сразу
+    while True:
+        await asyncio.sleep(CANDLE_FLUSH_INTERVAL)
+        try:
+            await flush_candles()
+            # Нужна только история для прогрева и импортированная глубина - хвост старше удаляем
+            if time.monotonic() - last_prune >= CANDLE_PRUNE_INTERVAL:
+                last_prune = time.monotonic()
+                if ARCHIVE is not None:
+                    depths = await get_candle_depths(CANDLES.tf)
+                    deleted = await asyncio.to_thread(ARCHIVE.compact_all, CANDLE_RETENTION, depths)
+                else:
+                    deleted = await prune_candles(CANDLES.tf, CANDLE_RETENTION)
+                if deleted:
+                    logger.info(f"Pruned {deleted} old candles")
+        except Exception as e:
+            logger.error(f"Candle persister error: {e}")
+
+async def gap_scanner():
+    """Догрузка пропущенных свечей: сразу после старта и затем периодически"""
+    logger.info("Gap scanner started")
+    while True:
+        try:
+            pairs = SUBSCRIPTIONS.tracked_pairs()
+            requests = await MARKET_DATA.backfill_gaps(list(set(pairs + DEFAULT_PAIRS)))
+            if requests:
+                logger.info(f"Gap scan: {requests} pairs backfilled")
+        except Exception as e:
+            logger.error(f"Gap scanner error: {e}")
+        await asyncio.sleep(GAP_SCAN_INTERVAL)
+
+async def warm_candles() -> int:
+    """Загрузить сохранённую историю свечей в CANDLES и включить запись новых"""
+    if ARCHIVE is not None:
+        total = ARCHIVE.load_into(CANDLES)
+        CANDLES.persist = True
+        return total
+    history = await load_candles(CANDLES.tf, CANDLES.maxlen + 1)
+    for pair, candles in history.items():
+        CANDLES.load(pair, candles)
+    CANDLES.persist = True
+    return sum(len(c) for c in history.values())
 
 async def signal_analyzer(bot: Bot):
     """Анализ и отправка сигналов"""
@@ -72,26 +327,22 @@ async def signal_analyzer(bot: Bot):
     
     while True:
         try:
-            # Получаем пары и пользователей
-            rows = await get_pairs_with_users()
+            # Пары и оплатившие подписчики - из индекса в памяти
+            pairs_users = SUBSCRIPTIONS.paid_subscribers()
             
-            # Группируем по парам
-            pairs_users = defaultdict(list)
-            for row in rows:
-                pairs_users[row["pair"]].append(row["user_id"])
+            # Быстрый скрининг по состоянию индикаторов - глубокий анализ только для кандидатов
+            candidates = batch_screen(list(pairs_users))
+            
+            # Проверка лимита сигналов за день
+            to_analyze = [p for p in candidates if SIGNAL_COUNTS.get(p) < MAX_SIGNALS_PER_DAY]
+            
+            # Глубокий анализ в пуле процессов (event loop не блокируется)
+            signals = await ANALYZER.analyze(to_analyze)
             
-            # Анализируем каждую пару
             now = time.time()
-            for pair, users in pairs_users.items():
-                # Проверка лимита сигналов за день
-                signals_today = await count_signals_today(pair)
-                if signals_today >= MAX_SIGNALS_PER_DAY:
-                    continue
-                
-                signal = analyze_signal(pair)
-                if not signal:
-                    continue
-                
+            for pair, signal in signals.items():
+                # Снимок: индекс может меняться, пока идёт рассылка
+                users = list(pairs_users.get(pair, ()))
                 side = signal["side"]
                 key = (pair, side)
                 
@@ -116,20 +367,13 @@ async def signal_analyzer(bot: Bot):
                     text += f"• {reason}\n"
                 text += f"\n⏰ {time.strftime('%H:%M:%S')}"
                 
-                # Батчинг отправки
-                sent_count = 0
-                for i, user_id in enumerate(users):
-                    if await send_message_safe(bot, user_id, text):
-                        await log_signal(user_id, pair, side, signal["price"], signal["score"])
-                        sent_count += 1
-                    
-                    if (i + 1) % BATCH_SEND_SIZE == 0:
-                        await asyncio.sleep(1)
-                    else:
-                        await asyncio.sleep(BATCH_SEND_DELAY)
-                
+                # Сигнал и получатели - в outbox (переживает рестарт), доставляет OUTBOX
+                if users:
+                    await queue_signal(pair, side, signal["price"], signal["score"], text, users, int(now))
+                    SIGNAL_COUNTS.increment(pair)
+                    OUTBOX.wake()
                 LAST_SIGNALS[key] = now
-                logger.info(f"Signal sent: {pair} {side} to {sent_count} users")
+                logger.info(f"Signal queued: {pair} {side} for {len(users)} users")
                 
         except Exception as e:
             logger.error(f"Signal analyzer error: {e}")
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+test_database.py - Тестирование работы с БД (на временном файле)
+Запуск: python test_database.py
+"""
+import os
+import sys
+import asyncio
+import tempfile
+from datetime import date, datetime
+from contextlib import asynccontextmanager
+
+import database
+from database import (
+    USER_CACHE, get_user_lang, set_user_lang, is_paid, get_user_balance,
+    get_user_pairs, add_user_pair, remove_user_pair, clear_user_pairs, grant_access, add_balance,
+    SubscriptionIndex, SUBSCRIPTIONS, add_user,
+    set_user_status, get_user_ids_page, get_user_profile
+)
+from database import (
+    DBPool, SignalLogWriter, save_candles, load_candles, prune_candles, count_signal_events, queue_signal
+)
+from tasks import DailySignalCounter
+from config import SIGNAL_COOLDOWN
+from indicators import CandleStorage
+from candle_archive import CandleArchive, HEADER, RECORD
+
+async def subscriptions_in_db():
+    """Подписки прямо из БД: ({pair: оплатившие доступные}, отслеживаемые пары)"""
+    conn = await database.db_pool.acquire()
+    try:
+        cursor = await conn.execute(
+            "SELECT up.user_id, up.pair, u.paid FROM user_pairs up "
+            "JOIN users u ON up.user_id = u.id WHERE u.status = 'active'"
+        )
+        rows = await cursor.fetchall()
+    finally:
+        await database.db_pool.release(conn)
+    by_pair = {}
+    for row in rows:
+        if row["paid"]:
+            by_pair.setdefault(row["pair"], set()).add(row["user_id"])
+    return by_pair, sorted({row["pair"] for row in rows})
+
+@asynccontextmanager
+async def temp_db():
+    """Временная БД вместо глобального пула"""
+    old_pool = database.db_pool
+    with tempfile.TemporaryDirectory() as tmp:
+        database.db_pool = DBPool(os.path.join(tmp, "test.db"), pool_size=2)
+        await database.db_pool.init()
+        try:
+            yield database.db_pool
+        finally:
+            await database.db_pool.close()
+            database.db_pool = old_pool
+
+# ==================== TESTS ====================
+def test_candles_roundtrip():
+    """Тест сохранения и загрузки свечей"""
+    print("🧪 Тест save_candles / load_candles...")
+    storage = CandleStorage(timeframe=60, maxlen=50)
+    storage.persist = True
+    for i in range(80):
+        storage.add_price("DBAUSDT", 100.0 + i, 1.0, i * 60)
+        storage.add_price("DBAUSDT", 100.5 + i, 2.0, i * 60 + 30)
+        if i % 2 == 0:
+            storage.add_price("DBBUSDT", 50.0 + i, 1.0, i * 60)
+    
+    rows = storage.drain_pending()
+    assert len(rows) == 79 + 39, f"Закрытых свечей в очереди: {len(rows)}"
+    assert storage.drain_pending() == [], "Очередь очищается"
+    
+    async def run():
+        async with temp_db():
+            await save_candles(60, rows)
+            await save_candles(60, rows[-5:])  # повторная запись не дублирует
+            await save_candles(3600, rows[:3])  # другой таймфрейм не мешает
+            history = await load_candles(60, 20)
+            deleted = await prune_candles(60, 30)
+            pruned = await load_candles(60, 100)
+            untouched = await load_candles(3600, 100)
+            return history, deleted, pruned, untouched
+    
+    history, deleted, pruned, untouched = asyncio.run(run())
+    assert set(history) == {"DBAUSDT", "DBBUSDT"}
+    assert len(history["DBAUSDT"]) == 20, "Последние limit свечей"
+    assert [c["ts"] for c in history["DBAUSDT"]] == [i * 60 for i in range(59, 79)], "По возрастанию времени"
+    assert history["DBAUSDT"][-1]["c"] == 178.5 and history["DBAUSDT"][-1]["v"] == 3.0
+    # Окно - 30 таймфреймов от последней свечи пары: у DBBUSDT свеча раз в 2 минуты
+    assert deleted == 49 + 24, f"Удалено старых свечей: {deleted}"
+    assert [c["ts"] for c in pruned["DBAUSDT"]] == [i * 60 for i in range(49, 79)], "Остались последние 30"
+    assert [c["ts"] for c in pruned["DBBUSDT"]] == [i * 60 for i in range(48, 78, 2)]
+    assert sum(len(c) for c in untouched.values()) == 3, "Другой таймфрейм не очищается"
+    
+    warm = CandleStorage(timeframe=60, maxlen=50)
+    warm.load("DBAUSDT", history["DBAUSDT"])
+    assert warm.count("DBAUSDT") == 20 and warm.get_state("DBAUSDT").count == 20
+    warm.add_price("DBAUSDT", 200.0, 1.0, 78 * 60 + 50)  # тот же бакет - дописывается
+    assert warm.count("DBAUSDT") == 20 and warm.get_candles("DBAUSDT")[-1]["c"] == 200.0
+    print(f"   ✅ {len(rows)} свечей записано, {len(history['DBAUSDT'])} загружено для DBAUSDT")
+
+def test_candle_archive():
+    """Тест mmap-архива свечей: append, перезапись текущей, ремонт хвоста"""
+    print("🧪 Тест CandleArchive...")
+    storage = CandleStorage(timeframe=60, maxlen=50)
+    storage.persist = True
+    for i in range(80):
+        storage.add_price("ARCUSDT", 100.0 + i, 1.0, i * 60)
+        storage.add_price("ARCUSDT", 100.5 + i, 2.0, i * 60 + 30)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = CandleArchive(tmp, tf=60)
+        assert archive.append_rows(storage.drain_pending()) == 79
+        # Незакрытая свеча при остановке, затем она же закрытая - одна запись
+        current = dict(storage.current["ARCUSDT"])
+        archive.append("ARCUSDT", [current])
+        current["c"] = 999.0
+        archive.append("ARCUSDT", [current])
+        archive.append("ARCUSDT", [{"ts": 0, "o": 1, "h": 1, "l": 1, "c": 1, "v": 1}])  # старая - вливается на место
+        
+        rows = archive.open("ARCUSDT")
+        assert rows.shape == (80, 6), f"Записей: {rows.shape}"
+        assert not rows.flags.owndata, "Массив - view на mmap"
+        assert rows[-1, 4] == 999.0 and rows[0, 0] == 0 and rows[0, 4] == 1.0
+        del rows
+        archive.close()
+        
+        # Обрыв записи посреди свечи - хвост отрезается при открытии
+        path = archive.path("ARCUSDT")
+        with open(path, "ab") as f:
+            f.write(b"\x01" * (RECORD.size // 2))
+        assert archive.repair("ARCUSDT") == 80
+        assert os.path.getsize(path) == HEADER.size + 80 * RECORD.size
+        
+        warm = CandleStorage(timeframe=60, maxlen=50)
+        assert archive.pairs() == ["ARCUSDT"]
+        assert archive.load_into(warm) == 51
+        assert warm.count("ARCUSDT") == 51 and warm.get_state("ARCUSDT").count == 51
+        assert warm.current["ARCUSDT"]["ts"] == 79 * 60 and warm.get_column("ARCUSDT", "c")[-1] == 999.0
+        warm.add_price("ARCUSDT", 200.0, 1.0, 79 * 60 + 50)  # тот же бакет - дописывается
+        assert warm.count("ARCUSDT") == 51 and warm.get_column("ARCUSDT", "c")[-1] == 200.0
+        
+        # Сжатие: мелкий излишек не переписывает файл, крупный - обрезается до keep
+        assert archive.compact("ARCUSDT", 70) == 0
+        assert archive.compact_all(40, {"ARCUSDT": 60}) == 20
+        assert archive.range("ARCUSDT") == (20 * 60, 79 * 60, 60)
+        assert os.path.getsize(path) == HEADER.size + 60 * RECORD.size
+        assert archive.compact("ARCUSDT", 40) == 20
+        assert archive.range("ARCUSDT") == (40 * 60, 79 * 60, 40)
+        compacted = CandleStorage(timeframe=60, maxlen=50)
+        assert archive.load_into(compacted) == 40
+        assert compacted.get_state("ARCUSDT").count == 40
+        assert compacted.get_column("ARCUSDT", "c")[-1] == 999.0
+    print("   ✅ 80 свечей в архиве, хвост отремонтирован, 51 загружена, сжатие до 40")
+
+def test_signal_log_writer():
+    """Тест буферизованной записи лога сигналов"""
+    print("🧪 Тест SignalLogWriter...")
+    
+    async def run():
+        async with temp_db() as pool:
+            writer = SignalLogWriter(max_rows=100, max_delay=0.05)
+            for uid in range(250):
+                await writer.add(uid, "LOGUSDT", "LONG", 1.5, 80)
+            commits_by_size = writer.commits
+            await asyncio.sleep(0.2)  # хвост сбрасывается по таймеру
+            commits_by_time = writer.commits
+            await writer.add(999, "LOGUSDT", "SHORT", 1.4, 75)
+            flushed = await writer.flush()
+            empty = await writer.flush()
+            conn = await pool.acquire()
+            try:
+                cursor = await conn.execute("SELECT COUNT(*) AS cnt, COUNT(DISTINCT user_id) AS users FROM signals_sent")
+                row = await cursor.fetchone()
+            finally:
+                await pool.release(conn)
+            return commits_by_size, commits_by_time, flushed, empty, writer.commits, row["cnt"], row["users"]
+    
+    by_size, by_time, flushed, empty, commits, rows, users = asyncio.run(run())
+    assert by_size == 2, f"Сбросы по размеру: {by_size}"
+    assert by_time == 3, f"Сброс хвоста по таймеру: {by_time}"
+    assert (flushed, empty, commits) == (1, 0, 4)
+    assert rows == 251 and users == 251, f"Записано строк: {rows}"
+    print(f"   ✅ {rows} строк за {commits} транзакции")
+
+def test_daily_signal_counts():
+    """Тест счётчиков сигнальных событий (рассылка = одно событие)"""
+    print("🧪 Тест DailySignalCounter...")
+    counter = DailySignalCounter()
+    counter._roll()
+    day_start = int(datetime.combine(counter.day, datetime.min.time()).timestamp())
+    
+    async def run():
+        async with temp_db():
+            # CNTAUSDT: LONG двум сотням получателей, SHORT, затем снова LONG после cooldown
+            await queue_signal("CNTAUSDT", "LONG", 1.0, 80, "signal", list(range(200)), day_start + 60)
+            await queue_signal("CNTAUSDT", "SHORT", 1.0, 80, "signal", list(range(50)), day_start + 90)
+            await queue_signal("CNTAUSDT", "LONG", 1.0, 80, "signal", list(range(20)),
+                               day_start + 60 + SIGNAL_COOLDOWN)
+            await queue_signal("CNTBUSDT", "LONG", 1.0, 80, "signal", list(range(30)), day_start + 120)
+            await queue_signal("CNTBUSDT", "LONG", 1.0, 80, "signal", list(range(30)), day_start - 3600)  # вчера
+            # Доставка растянулась на часы - строки signals_sent не создают новых событий
+            writer = SignalLogWriter()
+            writer.rows = [(uid, "CNTBUSDT", "LONG", 1.0, 80, day_start + 120 + uid * 600) for uid in range(30)]
+            await writer.flush()
+            events = await count_signal_events(day_start)
+            await counter.load()
+            return events
+    
+    events = asyncio.run(run())
+    assert events == {"CNTAUSDT": 3, "CNTBUSDT": 1}, f"События: {events}"
+    assert counter.get("CNTAUSDT") == 3 and counter.get("NONEUSDT") == 0
+    counter.increment("CNTBUSDT")
+    assert counter.get("CNTBUSDT") == 2
+    counter.day = date(2000, 1, 1)  # смена суток
+    assert counter.get("CNTBUSDT") == 0, "Счётчики обнуляются на новый день"
+    print(f"   ✅ События: {events}")
+
+def test_user_profile_cache():
+    """Тест кэша профилей: попадания, сброс при изменениях, TTL"""
+    print("🧪 Тест UserProfileCache...")
+    uid = 4242
+    
+    async def run():
+        async with temp_db():
+            USER_CACHE.clear()
+            await grant_access(uid)
+            await add_user_pair(uid, "ETHUSDT")
+            await add_user_pair(uid, "btcusdt")
+            
+            hits, misses = USER_CACHE.hits, USER_CACHE.misses
+            first = (await get_user_lang(uid), await is_paid(uid), await get_user_balance(uid),
+                     await get_user_pairs(uid))
+            assert (USER_CACHE.hits - hits, USER_CACHE.misses - misses) == (3, 1), "Один запрос к БД на профиль"
+            
+            await set_user_lang(uid, "en")
+            await remove_user_pair(uid, "BTCUSDT")
+            await add_balance(uid, 15.5)
+            second = (await get_user_lang(uid), await get_user_pairs(uid), await get_user_balance(uid))
+            
+            # Профиль, прочитанный до изменения, не должен попасть в кэш
+            version = USER_CACHE.version
+            await add_user_pair(uid, "SOLUSDT")
+            USER_CACHE.set(uid, {"lang": "en", "paid": True, "balance": 0.0, "pairs": ()}, version)
+            third = await get_user_pairs(uid)
+            
+            USER_CACHE.ttl = 0
+            misses = USER_CACHE.misses
+            await get_user_lang(uid)
+            expired = USER_CACHE.misses - misses
+            USER_CACHE.ttl = 300
+            USER_CACHE.clear()
+            return first, second, third, expired
+    
+    first, second, third, expired = asyncio.run(run())
+    assert first == ("ru", True, 0.0, ["BTCUSDT", "ETHUSDT"]), f"Профиль (пары по алфавиту): {first}"
+    assert second == ("en", ["ETHUSDT"], 15.5), f"После изменений: {second}"
+    assert third == ["ETHUSDT", "SOLUSDT"], f"Устаревший профиль закэширован: {third}"
+    assert expired == 1, "Истёкшая запись читается из БД"
+    print(f"   ✅ Статистика: {USER_CACHE.stats()}")
+
+def test_user_context_middleware():
+    """Тест middleware: профиль загружается один раз и передаётся хендлеру"""
+    print("🧪 Тест UserContextMiddleware...")
+    from aiogram import Bot, Dispatcher, types
+    from middlewares import UserContextMiddleware
+    uid = 5151
+    seen = []
+    
+    async def run():
+        async with temp_db():
+            USER_CACHE.clear()
+            await grant_access(uid)
+            await set_user_lang(uid, "en")
+            await add_user_pair(uid, "BTCUSDT")
+            
+            bot = Bot("123456:ABCdefGhIJKlmnoPQRstuVWXyz012345678")
+            dp = Dispatcher(bot)
+            dp.middleware.setup(UserContextMiddleware())
+            
+            @dp.message_handler()
+            async def handler(message: types.Message, profile: dict):
+                seen.append(profile)
+            
+            update = {"update_id": 1, "message": {
+                "message_id": 1, "date": 0, "text": "hi",
+                "chat": {"id": uid, "type": "private"},
+                "from": {"id": uid, "is_bot": False, "first_name": "T"},
+            }}
+            Bot.set_current(bot)
+            misses = USER_CACHE.misses
+            for i in range(3):
+                await dp.process_update(types.Update(**dict(update, update_id=i)))
+            result = USER_CACHE.misses - misses
+            USER_CACHE.clear()
+            return result
+    
+    misses = asyncio.run(run())
+    assert len(seen) == 3, f"Хендлер вызван {len(seen)} раз"
+    assert seen[0] == {"lang": "en", "paid": True, "balance": 0.0, "pairs": ("BTCUSDT",), "status": "active"}, \
+        f"Профиль: {seen[0]}"
+    assert misses == 1, f"Запросов к БД на 3 апдейта: {misses}"
+    print(f"   ✅ 3 апдейта, {misses} запрос к БД")
+
+def test_subscription_index():
+    """Тест индекса подписок: загрузка и инкрементальные обновления совпадают с БД"""
+    print("🧪 Тест SubscriptionIndex...")
+    
+    async def run():
+        async with temp_db():
+            await SUBSCRIPTIONS.load()
+            await grant_access(1)
+            await grant_access(2)
+            await add_user_pair(1, "btcusdt")
+            await add_user_pair(1, "ETHUSDT")
+            await add_user_pair(2, "ETHUSDT")
+            await add_user_pair(3, "SOLUSDT")  # без доступа
+            await remove_user_pair(1, "BTCUSDT")
+            await grant_access(3)              # доступ после подписки
+            await add_user_pair(2, "TONUSDT")
+            await clear_user_pairs(2)
+            live = ({p: set(u) for p, u in SUBSCRIPTIONS.paid_subscribers().items()},
+                    sorted(SUBSCRIPTIONS.tracked_pairs()))
+            expected = await subscriptions_in_db()
+            fresh = SubscriptionIndex()
+            await fresh.load()
+            loaded = ({p: set(u) for p, u in fresh.paid_subscribers().items()}, sorted(fresh.tracked_pairs()))
+            SUBSCRIPTIONS.clear()  # не оставляем данные временной БД
+            return live, expected, loaded
+    
+    live, expected, loaded = asyncio.run(run())
+    assert expected == ({"ETHUSDT": {1}, "SOLUSDT": {3}}, ["ETHUSDT", "SOLUSDT"]), f"БД: {expected}"
+    assert live == expected, f"Индекс разошёлся с БД: {live}"
+    assert loaded == expected, f"Загрузка при старте: {loaded}"
+    print(f"   ✅ Индекс совпадает с БД: {live[0]}")
+
+def test_write_queue():
+    """Тест очереди записи: group commit, изоляция ошибок, читатели только для чтения"""
+    print("🧪 Тест DBPool (один писатель, очередь записи)...")
+    import sqlite3
+    
+    async def run():
+        async with temp_db() as pool:
+            USER_CACHE.clear()
+            commits = pool.commits
+            await asyncio.gather(*(add_user(uid) for uid in range(1, 401)))
+            created_commits = pool.commits - commits
+            
+            # Ошибка одной операции не откатывает соседние в той же транзакции
+            bad_sql = "INSERT INTO user_pairs(user_id, pair) VALUES(?,?)"
+            await pool.write((bad_sql, (1, "DUPUSDT")))
+            results = await asyncio.gather(
+                pool.write((bad_sql, (2, "OKAUSDT"))),
+                pool.write((bad_sql, (1, "DUPUSDT"))),
+                pool.write((bad_sql, (3, "OKBUSDT"))),
+                return_exceptions=True
+            )
+            again = await add_user(1)
+            
+            # Сбой всей пачки (например, ROLLBACK тоже упал) не убивает писателя
+            original_apply = pool._apply
+            
+            async def broken_apply(batch):
+                pool._apply = original_apply
+                raise sqlite3.OperationalError("disk I/O error")
+            
+            pool._apply = broken_apply
+            broken = await asyncio.gather(pool.write((bad_sql, (4, "LOSTUSDT"))), return_exceptions=True)
+            survived = await pool.write((bad_sql, (4, "OKCUSDT")))
+            
+            conn = await pool.acquire()
+            try:
+                cursor = await conn.execute("SELECT COUNT(*) AS cnt FROM users")
+                users = (await cursor.fetchone())["cnt"]
+                cursor = await conn.execute("SELECT COUNT(*) AS cnt FROM user_pairs")
+                pairs = (await cursor.fetchone())["cnt"]
+                try:
+                    await conn.execute("DELETE FROM users")
+                    read_only = False
+                except sqlite3.OperationalError:
+                    read_only = True
+            finally:
+                await pool.release(conn)
+            USER_CACHE.clear()
+            return created_commits, results, again, users, pairs, read_only, broken, survived
+    
+    async def stop_mid_batch():
+        async with temp_db() as pool:
+            # Сигнал остановки посреди пачки: все записи применены, future разрешены
+            loop = asyncio.get_running_loop()
+            futures = [loop.create_future() for _ in range(3)]
+            sql = "INSERT INTO user_pairs(user_id, pair) VALUES(?,?)"
+            pool._writes.put_nowait(([(sql, (1, "AUSDT"), False)], futures[0]))
+            pool._writes.put_nowait(None)
+            pool._writes.put_nowait(([(sql, (1, "BUSDT"), False)], futures[1]))
+            pool._writes.put_nowait(([(sql, (1, "AUSDT"), False)], futures[2]))
+            await asyncio.wait_for(pool._writer_task, 1.0)
+            stopped = await asyncio.gather(*futures, return_exceptions=True)
+        
+        async with temp_db() as pool:
+            # Остановка бота: поставленные в очередь записи дописываются, новые отклоняются
+            writes = [asyncio.create_task(pool.write((sql, (2, f"P{i}USDT")))) for i in range(20)]
+            await asyncio.sleep(0)
+            await pool.close()
+            written = await asyncio.gather(*writes)
+            try:
+                await pool.write((sql, (3, "LATEUSDT")))
+                rejected = False
+            except RuntimeError:
+                rejected = True
+        return stopped, written, rejected
+    
+    commits, results, again, users, pairs, read_only, broken, survived = asyncio.run(run())
+    stopped, written, rejected = asyncio.run(stop_mid_batch())
+    assert users == 400 and not again, "Все пользователи созданы, повторно - нет"
+    assert commits < 20, f"400 записей должны уйти пачками, коммитов: {commits}"
+    assert results[0] == 1 and results[2] == 1, f"Соседние операции применились: {results}"
+    assert isinstance(results[1], sqlite3.IntegrityError), f"Ошибка досталась своей операции: {results[1]}"
+    assert isinstance(broken[0], sqlite3.OperationalError) and survived == 1, "Писатель пережил сбой пачки"
+    assert pairs == 4, f"Пар в БД: {pairs}"
+    assert written == [1] * 20 and rejected, "При закрытии очередь дописана, новые записи отклонены"
+    assert stopped[:2] == [1, 1] and isinstance(stopped[2], sqlite3.IntegrityError), f"Остановка: {stopped}"
+    assert read_only, "Читающие соединения - query_only"
+    print(f"   ✅ 400 записей за {commits} коммитов, ошибка изолирована")
+
+def test_unreachable_users():
+    """Тест недоступных пользователей: исключение из рассылок и возврат по /start"""
+    print("🧪 Тест статуса недоступных пользователей...")
+    import sqlite3
+    
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            # БД старой версии - без колонки status
+            path = os.path.join(tmp, "old.db")
+            conn = sqlite3.connect(path)
+            conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, invited_by INTEGER, balance REAL DEFAULT 0, "
+                         "paid INTEGER DEFAULT 0, language TEXT DEFAULT 'ru', created_ts INTEGER NOT NULL)")
+            conn.execute("INSERT INTO users(id, paid, created_ts) VALUES(1, 1, 0), (2, 1, 0)")
+            conn.commit()
+            conn.close()
+            pool = DBPool(path, pool_size=1)
+            await pool.init()
+            await pool.close()
+            conn = sqlite3.connect(path)
+            migrated = conn.execute("SELECT status FROM users ORDER BY id").fetchall()
+            conn.close()
+        
+        async with temp_db():
+            USER_CACHE.clear()
+            for uid in (1, 2):
+                await grant_access(uid)
+                await add_user_pair(uid, "BTCUSDT")
+            await add_user_pair(2, "DOGEUSDT")
+            await SUBSCRIPTIONS.load()
+            
+            changed = await set_user_status(2, "blocked")
+            repeated = await set_user_status(2, "blocked")
+            by_pair, tracked = await subscriptions_in_db()
+            blocked = (
+                set(SUBSCRIPTIONS.paid_subscribers()), set(SUBSCRIPTIONS.paid_subscribers().get("BTCUSDT", ())),
+                await get_user_ids_page(0, 100), set().union(*by_pair.values()),
+                tracked, (await get_user_profile(2))["status"]
+            )
+            await SUBSCRIPTIONS.load()
+            reloaded = set(SUBSCRIPTIONS.paid_subscribers().get("BTCUSDT", ()))
+            
+            await set_user_status(2, "active")
+            restored = (set(SUBSCRIPTIONS.paid_subscribers().get("DOGEUSDT", ())), await get_user_ids_page(0, 100))
+            SUBSCRIPTIONS.clear()
+            USER_CACHE.clear()
+            return migrated, changed, repeated, blocked, reloaded, restored
+    
+    migrated, changed, repeated, blocked, reloaded, restored = asyncio.run(run())
+    assert migrated == [("active",), ("active",)], f"Миграция старой БД: {migrated}"
+    pairs, btc_users, all_ids, signal_users, tracked, status = blocked
+    assert changed and not repeated, "Статус меняется один раз"
+    assert pairs == {"BTCUSDT"} and btc_users == {1}, f"Индекс без недоступного: {pairs}, {btc_users}"
+    assert all_ids == [1] and signal_users == {1}, f"Запросы БД без недоступного: {all_ids}, {signal_users}"
+    assert tracked == ["BTCUSDT"] and status == "blocked", f"Пары: {tracked}, статус: {status}"
+    assert reloaded == {1}, "Статус переживает перезагрузку индекса"
+    assert restored == ({2}, [1, 2]), f"После /start подписки вернулись: {restored}"
+    print("   ✅ Недоступный исключён из получателей, подписки вернулись после /start")
+
+def run_all_tests():
+    """Запустить все тесты"""
+    print("=" * 50)
+    print("🧪 Тестирование БД")
+    print("=" * 50)
+    print()
+    
+    tests = [
+        test_candles_roundtrip,
+        test_candle_archive,
+        test_signal_log_writer,
+        test_daily_signal_counts,
+        test_user_profile_cache,
+        test_user_context_middleware,
+        test_subscription_index,
+        test_write_queue,
+        test_unreachable_users,
+    ]
+    
+    passed = 0
+    failed = 0
+    
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except AssertionError as e:
+            print(f"   ❌ Тест провален: {e}")
+            failed += 1
+        except Exception as e:
+            print(f"   ❌ Ошибка: {e}")
+            failed += 1
+        print()
+    
+    print("=" * 50)
+    print(f"✅ Пройдено: {passed}")
+    print(f"❌ Провалено: {failed}")
+    print("=" * 50)
+    
+    return failed == 0
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
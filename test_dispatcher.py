@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+test_dispatcher.py - Тестирование диспетчера рассылки (без Telegram)
+Запуск: python test_dispatcher.py
+"""
+import sys
+import time
+import asyncio
+from types import SimpleNamespace
+from aiogram.utils.exceptions import BotBlocked, RetryAfter, NetworkError
+
+from dispatcher import (
+    MessageDispatcher, TokenBucket, FloodGate, send_message_safe, PRIORITY_BROADCAST
+)
+from config import SEND_MAX_RETRIES
+from database import queue_signal, load_signal_cooldowns, add_user, get_broadcast, USER_CACHE
+from broadcasts import BroadcastManager
+import tasks
+from tasks import OutboxRelay
+from test_database import temp_db
+
+class FakeBot:
+    """Бот-заглушка: запоминает время отправки, имитирует задержку сети"""
+    def __init__(self, latency: float = 0.02, blocked=(), flood=(), transient=()):
+        self.latency = latency
+        self.blocked = set(blocked)
+        self.transient = set(transient)  # чаты с временной ошибкой сети
+        self.flood = list(flood)  # RetryAfter на первых вызовах (секунды паузы)
+        self.calls = []
+        self.edits = []  # (chat_id, message_id, text)
+        self.sent = []  # (time, chat_id, text)
+        self.in_flight = 0
+        self.max_in_flight = 0
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            self.calls.append(time.monotonic())
+            await asyncio.sleep(self.latency)
+            if self.flood:
+                raise RetryAfter(self.flood.pop(0))
+            if chat_id in self.transient:
+                raise NetworkError("Connection reset")
+            if chat_id in self.blocked:
+                raise BotBlocked("Forbidden: bot was blocked by the user")
+            self.sent.append((time.monotonic(), chat_id, text))
+            return SimpleNamespace(message_id=len(self.sent))
+        finally:
+            self.in_flight -= 1
+    
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.edits.append((chat_id, message_id, text))
+
+# ==================== TESTS ====================
+def test_token_bucket():
+    """Тест глобального лимита скорости"""
+    print("🧪 Тест TokenBucket...")
+    
+    async def run():
+        bucket = TokenBucket(rate=100, capacity=10)
+        started = time.monotonic()
+        await asyncio.gather(*(bucket.acquire() for _ in range(60)))
+        return time.monotonic() - started
+    
+    elapsed = asyncio.run(run())
+    # 10 из запаса сразу, остальные 50 - со скоростью 100/с
+    assert 0.4 <= elapsed < 1.0, f"60 токенов за {elapsed:.2f}s"
+    print(f"   ✅ 60 токенов при 100/с и запасе 10 за {elapsed:.2f}s")
+
+def test_fanout():
+    """Тест параллельной рассылки: скорость, воркеры, колбэки"""
+    print("🧪 Тест MessageDispatcher (рассылка)...")
+    
+    async def run():
+        bot = FakeBot(latency=0.05, blocked={7})
+        unreachable = []
+        
+        async def on_unreachable(chat_id, status):
+            unreachable.append((chat_id, status))
+        
+        dispatcher = MessageDispatcher(workers=8, gate=FloodGate(TokenBucket(200)), chat_interval=0.0,
+                                       on_unreachable=on_unreachable)
+        dispatcher.start(bot)
+        delivered = []
+        
+        async def on_sent(chat_id):
+            delivered.append(chat_id)
+        
+        started = time.monotonic()
+        futures = dispatcher.enqueue_many(range(100), "signal", on_sent)
+        enqueue_time = time.monotonic() - started
+        results = await asyncio.gather(*futures)
+        elapsed = time.monotonic() - started
+        await dispatcher.stop()
+        return bot, delivered, results, enqueue_time, elapsed, dispatcher, unreachable
+    
+    bot, delivered, results, enqueue_time, elapsed, dispatcher, unreachable = asyncio.run(run())
+    assert enqueue_time < 0.05, f"Постановка в очередь не ждёт отправки: {enqueue_time:.3f}s"
+    assert len(bot.sent) == 99 and results[7] == "blocked", "Заблокировавший бота пропущен"
+    assert sorted(delivered) == [i for i in range(100) if i != 7], "Колбэк - только для доставленных"
+    assert dispatcher.sent == 99 and dispatcher.failed == 1, "Счётчики диспетчера"
+    assert unreachable == [(7, "blocked")], f"Заблокировавший бота отмечен: {unreachable}"
+    assert 2 <= bot.max_in_flight <= 8, f"Параллельных отправок: {bot.max_in_flight}"
+    # Последовательно было бы 100 * 0.05 = 5s, лимит 200/с даёт ~0.5s
+    assert elapsed < 2.0, f"Рассылка 100 сообщений за {elapsed:.2f}s"
+    print(f"   ✅ 100 сообщений за {elapsed:.2f}s, параллельно до {bot.max_in_flight}")
+
+def test_per_chat_limit():
+    """Тест лимита на один чат"""
+    print("🧪 Тест лимита сообщений в один чат...")
+    
+    async def run():
+        bot = FakeBot(latency=0.0)
+        dispatcher = MessageDispatcher(workers=4, gate=FloodGate(TokenBucket(1000)), chat_interval=0.1)
+        dispatcher.start(bot)
+        futures = []
+        for i in range(4):
+            futures.append(dispatcher.enqueue(1, f"a{i}"))
+            futures.append(dispatcher.enqueue(2, f"b{i}"))
+        await asyncio.gather(*futures)
+        await dispatcher.stop()
+        return bot
+    
+    bot = asyncio.run(run())
+    for chat_id in (1, 2):
+        times = [t for t, c, _ in bot.sent if c == chat_id]
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        assert len(times) == 4, f"Чат {chat_id}: отправлено {len(times)}"
+        assert min(gaps) >= 0.08, f"Чат {chat_id}: интервалы {gaps}"
+    print("   ✅ Сообщения в один чат разнесены по времени")
+
+def test_flood_gate():
+    """Тест общей паузы при RetryAfter: все отправители ждут, скорость снижается"""
+    print("🧪 Тест FloodGate (RetryAfter)...")
+    
+    async def run():
+        bot = FakeBot(latency=0.01, flood=[0.3])
+        gate = FloodGate(TokenBucket(100, capacity=5), backoff=0.5, min_rate=10, recovery_interval=60)
+        dispatcher = MessageDispatcher(workers=4, gate=gate, chat_interval=0.0)
+        dispatcher.start(bot)
+        started = time.monotonic()
+        results = await asyncio.gather(*dispatcher.enqueue_many(range(20), "x"))
+        await dispatcher.stop()
+        
+        # Флуд не прекращается - повторы ограничены, без рекурсии
+        always = FakeBot(latency=0.0, flood=[0.01] * 100)
+        dropped = await send_message_safe(always, 1, "x", FloodGate(TokenBucket(1000)), retries=3)
+        return bot, gate, results, started, always, dropped
+    
+    bot, gate, results, started, always, dropped = asyncio.run(run())
+    tripped_at = bot.calls[0] + bot.latency
+    during_pause = [t for t in bot.calls if tripped_at + 0.01 < t < tripped_at + 0.29]
+    assert set(results) == {"sent"} and len(bot.sent) == 20, "Все сообщения доставлены после паузы"
+    assert not during_pause, f"Отправки во время паузы: {len(during_pause)}"
+    assert gate.trips == 1 and gate.bucket.rate == 50, f"Скорость после флуда: {gate.bucket.rate}"
+    assert dropped is False and len(always.calls) == 4, f"Попыток при постоянном флуде: {len(always.calls)}"
+    print(f"   ✅ Пауза общая, скорость 100 -> {gate.bucket.rate:.0f} msg/s, повторов не больше 3")
+
+def test_outbox_retry():
+    """Тест outbox: временные ошибки повторяются, сбой отметки не теряет строки"""
+    print("🧪 Тест OutboxRelay (повторы и сбой отметки)...")
+    
+    async def statuses(pool):
+        conn = await pool.acquire()
+        try:
+            cursor = await conn.execute("SELECT user_id, status, attempts FROM outbox ORDER BY user_id")
+            return {r["user_id"]: (r["status"], r["attempts"]) for r in await cursor.fetchall()}
+        finally:
+            await pool.release(conn)
+    
+    async def run():
+        async with temp_db() as pool:
+            bot = FakeBot(latency=0.0, blocked={203}, transient={202})
+            dispatcher = MessageDispatcher(workers=2, gate=FloodGate(TokenBucket(1000)), chat_interval=0.0)
+            dispatcher.start(bot)
+            relay = OutboxRelay(dispatcher=dispatcher)
+            await queue_signal("RTYUSDT", "LONG", 1.0, 80, "signal", [201, 202, 203], 1000)
+            
+            await relay.run_once()
+            after_first = await statuses(pool)
+            backoff_claim = await relay.run_once()  # 202 ждёт паузы
+            
+            bot.transient.clear()
+            await pool.write(("UPDATE outbox SET next_ts = 0", ()))
+            await relay.run_once()
+            after_retry = await statuses(pool)
+            
+            # Отметка не записалась - строки остаются ожидающими и забираются снова
+            await queue_signal("RTYUSDT", "SHORT", 1.0, 80, "signal", [301], 2000)
+            original_mark = tasks.mark_outbox
+            
+            async def broken_mark(*args):
+                raise RuntimeError("disk I/O error")
+            
+            tasks.mark_outbox = broken_mark
+            try:
+                await relay.run_once()
+                mark_error = None
+            except RuntimeError as e:
+                mark_error = e
+            finally:
+                tasks.mark_outbox = original_mark
+            reclaimed = await relay.run_once()
+            after_mark = await statuses(pool)
+            
+            # Флуд дольше SEND_MAX_RETRIES повторов - сообщение не потеряно
+            bot.flood = [0] * (SEND_MAX_RETRIES + 1)
+            await queue_signal("RTYUSDT", "LONG", 1.0, 80, "signal", [401], 3000)
+            await relay.run_once()
+            after_flood = await statuses(pool)
+            
+            # Остановка диспетчера: отправляемые и ждущие в очереди future отменены
+            bot.latency = 5.0
+            await queue_signal("RTYUSDT", "SHORT", 1.0, 80, "signal", [501, 502, 503], 4000)
+            pending = asyncio.create_task(relay.run_once())
+            await asyncio.sleep(0.05)
+            await dispatcher.stop(timeout=0)
+            await asyncio.wait_for(pending, 1.0)
+            after_stop = await statuses(pool)
+            return after_first, backoff_claim, after_retry, mark_error, reclaimed, after_mark, after_flood, after_stop, bot
+    
+    (after_first, backoff_claim, after_retry, mark_error, reclaimed, after_mark,
+     after_flood, after_stop, bot) = asyncio.run(run())
+    assert after_first == {201: (1, 0), 202: (0, 1), 203: (2, 0)}, f"После первой попытки: {after_first}"
+    assert backoff_claim == 0, "Строка с временной ошибкой ждёт паузы"
+    assert after_retry[202] == (1, 1), f"Повтор доставлен: {after_retry}"
+    assert mark_error is not None and reclaimed == 1, "После сбоя отметки строка забрана снова"
+    assert after_mark[301] == (1, 0), f"Строка отмечена после повтора: {after_mark}"
+    assert [c for _, c, _ in bot.sent].count(301) == 2, "Доставка at-least-once"
+    assert after_flood[401] == (0, 1), f"Сброшенная флудом отправка ждёт повтора: {after_flood}"
+    assert all(after_stop[c] == (0, 1) for c in (501, 502, 503)), f"Отменённые при остановке: {after_stop}"
+    print("   ✅ Временные ошибки и остановка повторяются, сбой отметки не потерял строку")
+
+def test_outbox_pipeline():
+    """Тест outbox: медленный чат не задерживает следующие пачки"""
+    print("🧪 Тест OutboxRelay (непрерывная подача в очередь)...")
+    
+    class SlowChatBot(FakeBot):
+        async def send_message(self, chat_id, text, **kwargs):
+            if chat_id == 900:
+                await asyncio.sleep(1.0)
+            return await super().send_message(chat_id, text, **kwargs)
+    
+    async def run():
+        async with temp_db():
+            bot = SlowChatBot(latency=0.0)
+            dispatcher = MessageDispatcher(workers=4, gate=FloodGate(TokenBucket(1000)), chat_interval=0.0)
+            dispatcher.start(bot)
+            relay = OutboxRelay(batch=4, low_watermark=2, dispatcher=dispatcher)
+            await queue_signal("PIPUSDT", "LONG", 1.0, 80, "signal", [900] + list(range(1, 16)), 1000)
+            started = time.monotonic()
+            relay.start()
+            while len(bot.sent) < 15:
+                await asyncio.sleep(0.005)
+            fast_done = time.monotonic() - started
+            slow_in_flight = 900 not in [c for _, c, _ in bot.sent]
+            await relay.stop()
+            await dispatcher.stop()
+            return fast_done, slow_in_flight, relay
+    
+    fast_done, slow_in_flight, relay = asyncio.run(run())
+    assert slow_in_flight and fast_done < 0.5, f"Остальные строки доставлены за {fast_done:.2f}s"
+    assert relay.sent == 16 and not relay.in_flight, "При остановке отправляемые строки отмечены"
+    print(f"   ✅ 15 сообщений за {fast_done:.2f}s, пока медленный чат ещё отправлялся")
+
+def test_signal_priority():
+    """Тест приоритета: сигнал обгоняет стоящую в очереди рассылку"""
+    print("🧪 Тест приоритета сигналов над рассылкой...")
+    
+    async def run():
+        bot = FakeBot(latency=0.0)
+        dispatcher = MessageDispatcher(workers=1, gate=FloodGate(TokenBucket(100, capacity=1)), chat_interval=0.0)
+        dispatcher.start(bot)
+        broadcast = dispatcher.enqueue_many(range(1000, 1030), "news", priority=PRIORITY_BROADCAST)
+        await asyncio.sleep(0.05)
+        signal = dispatcher.enqueue(1, "signal")
+        await asyncio.gather(signal, *broadcast)
+        await dispatcher.stop()
+        return [c for _, c, _ in bot.sent]
+    
+    order = asyncio.run(run())
+    position = order.index(1)
+    assert position <= 8, f"Сигнал отправлен {position + 1}-м из {len(order)}"
+    print(f"   ✅ Сигнал ушёл {position + 1}-м, не дожидаясь 30 сообщений рассылки")
+
+def test_broadcast_job():
+    """Тест фоновой рассылки: страницы, прогресс, пауза и продолжение"""
+    print("🧪 Тест BroadcastManager (пауза и продолжение)...")
+    
+    async def run():
+        async with temp_db():
+            USER_CACHE.clear()
+            for uid in range(1, 251):
+                await add_user(uid)
+            bot = FakeBot(latency=0.0)
+            dispatcher = MessageDispatcher(workers=8, gate=FloodGate(TokenBucket(1000)), chat_interval=0.0)
+            dispatcher.start(bot)
+            manager = BroadcastManager(page_size=100, progress_interval=0.0, dispatcher=dispatcher)
+            
+            bid = await manager.start(bot, 1, 1, "news")
+            while not any(text == "news" for _, _, text in bot.sent):
+                await asyncio.sleep(0.001)
+            await manager.pause(bot, bid)  # сработает после текущей страницы
+            await asyncio.gather(*manager.tasks.values())
+            paused = await get_broadcast(bid)
+            
+            await manager.resume(bot, bid)
+            await asyncio.gather(*manager.tasks.values())
+            done = await get_broadcast(bid)
+            await dispatcher.stop()
+            USER_CACHE.clear()
+            return bot, paused, done
+    
+    bot, paused, done = asyncio.run(run())
+    recipients = [c for _, c, text in bot.sent if text == "news"]
+    assert paused["status"] == "paused" and paused["cursor"] == 100, f"Пауза после страницы: {paused}"
+    assert done["status"] == "done" and done["sent"] == 250 and done["total"] == 250, f"Итог: {done}"
+    assert sorted(recipients) == list(range(1, 251)), "Каждый получил ровно одно сообщение"
+    assert bot.edits and "250/250" in bot.edits[-1][2], "Прогресс обновляется у админа"
+    print(f"   ✅ 250 получателей страницами по 100, {len(bot.edits)} обновлений прогресса")
+
+def test_broadcast_stop_and_error():
+    """Тест рассылки: остановка бота дописывает страницу, ошибка ставит на паузу"""
+    print("🧪 Тест BroadcastManager (остановка и ошибка)...")
+    import broadcasts
+    
+    async def run():
+        async with temp_db():
+            USER_CACHE.clear()
+            for uid in range(1, 251):
+                await add_user(uid)
+            bot = FakeBot(latency=0.0)
+            dispatcher = MessageDispatcher(workers=8, gate=FloodGate(TokenBucket(1000)), chat_interval=0.0)
+            dispatcher.start(bot)
+            manager = BroadcastManager(page_size=100, progress_interval=60.0, dispatcher=dispatcher)
+            
+            # Остановка посреди страницы: страница дописана, позиция сохранена
+            bid = await manager.start(bot, 1, 1, "news")
+            while not any(text == "news" for _, _, text in bot.sent):
+                await asyncio.sleep(0.001)
+            await manager.stop()
+            stopped = await get_broadcast(bid)
+            sent_before = sum(1 for _, _, text in bot.sent if text == "news")
+            
+            # После рестарта - продолжение с сохранённой позиции без повторов
+            restarted = BroadcastManager(page_size=100, progress_interval=60.0, dispatcher=dispatcher)
+            await restarted.resume_all(bot)
+            await asyncio.gather(*restarted.tasks.values())
+            
+            # Ошибка чтения страницы: задание на паузе, админ видит статус
+            original_page = broadcasts.get_user_ids_page
+            
+            async def broken_page(cursor, limit):
+                raise RuntimeError("database is locked")
+            
+            broadcasts.get_user_ids_page = broken_page
+            try:
+                failed_bid = await restarted.start(bot, 1, 1, "update")
+                await asyncio.gather(*restarted.tasks.values())
+            finally:
+                broadcasts.get_user_ids_page = original_page
+            failed = await get_broadcast(failed_bid)
+            await dispatcher.stop()
+            USER_CACHE.clear()
+            return bot, stopped, sent_before, failed
+    
+    bot, stopped, sent_before, failed = asyncio.run(run())
+    recipients = [c for _, c, text in bot.sent if text == "news"]
+    assert stopped["status"] == "running", f"После остановки задание продолжится: {stopped}"
+    assert stopped["cursor"] == sent_before == 100, f"Страница дописана и сохранена: {stopped}, {sent_before}"
+    assert sorted(recipients) == list(range(1, 251)), "После рестарта повторов нет"
+    assert failed["status"] == "paused", f"Ошибка ставит задание на паузу: {failed}"
+    assert "⏸" in bot.edits[-1][2], "Админ видит паузу"
+    print("   ✅ Остановка сохраняет страницу, ошибка ставит задание на паузу")
+
+def test_outbox_resume():
+    """Тест outbox: рассылка, прерванная рестартом, продолжается без повторов"""
+    print("🧪 Тест OutboxRelay (доставка после рестарта)...")
+    
+    async def run():
+        async with temp_db() as pool:
+            bot = FakeBot(latency=0.0, blocked={104})
+            dispatcher = MessageDispatcher(workers=4, gate=FloodGate(TokenBucket(1000)), chat_interval=0.0)
+            dispatcher.start(bot)
+            await queue_signal("OBXUSDT", "LONG", 1.5, 80, "signal", [101, 102, 103, 104, 105], 1000)
+            
+            # Первый процесс успел доставить одну пачку и "упал"
+            first = OutboxRelay(batch=2, dispatcher=dispatcher)
+            await first.run_once()
+            after_crash = len(bot.sent)
+            
+            # Новый процесс: отмеченные строки не повторяются
+            second = OutboxRelay(batch=2, dispatcher=dispatcher)
+            while await second.run_once():
+                pass
+            await dispatcher.stop()
+            
+            conn = await pool.acquire()
+            try:
+                cursor = await conn.execute("SELECT status, COUNT(*) AS cnt FROM outbox GROUP BY status")
+                statuses = {r["status"]: r["cnt"] for r in await cursor.fetchall()}
+                cursor = await conn.execute("SELECT COUNT(*) AS cnt FROM signals_sent")
+                logged = (await cursor.fetchone())["cnt"]
+            finally:
+                await pool.release(conn)
+            cooldowns = await load_signal_cooldowns()
+            return bot, after_crash, second, statuses, logged, cooldowns
+    
+    bot, after_crash, second, statuses, logged, cooldowns = asyncio.run(run())
+    recipients = [c for _, c, _ in bot.sent]
+    assert after_crash == 2, f"До рестарта доставлено: {after_crash}"
+    assert sorted(recipients) == [101, 102, 103, 105], f"Получатели: {recipients}"
+    assert second.sent == 2 and second.failed == 1, "После рестарта - только остаток"
+    assert statuses == {1: 4, 2: 1}, f"Статусы outbox: {statuses}"
+    assert logged == 4, f"Строк signals_sent: {logged}"
+    assert cooldowns == {("OBXUSDT", "LONG"): 1000}, f"Cooldown сохранён: {cooldowns}"
+    print("   ✅ Остаток рассылки доставлен после рестарта, cooldown восстановлен")
+
+def run_all_tests():
+    """Запустить все тесты"""
+    print("=" * 50)
+    print("🧪 Тестирование диспетчера рассылки")
+    print("=" * 50)
+    print()
+    
+    tests = [
+        test_token_bucket,
+        test_fanout,
+        test_per_chat_limit,
+        test_flood_gate,
+        test_outbox_resume,
+        test_outbox_retry,
+        test_outbox_pipeline,
+        test_signal_priority,
+        test_broadcast_job,
+        test_broadcast_stop_and_error,
+    ]
+    
+    passed = 0
+    failed = 0
+    
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except AssertionError as e:
+            print(f"   ❌ Тест провален: {e}")
+            failed += 1
+        except Exception as e:
+            print(f"   ❌ Ошибка: {e}")
+            failed += 1
+        print()
+    
+    print("=" * 50)
+    print(f"✅ Пройдено: {passed}")
+    print(f"❌ Провалено: {failed}")
+    print("=" * 50)
+    
+    return failed == 0
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
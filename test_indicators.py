@@ -5,9 +5,12 @@ test_indicators.py - Тестирование индикаторов
 """
 import sys
 from indicators import (
-    ema, sma, rsi, macd, bollinger_bands, 
-    volume_strength, atr, calculate_tp_sl
+    ema, sma, rsi, rsi_series, macd, macd_series, bollinger_bands, 
+    volume_strength, atr, calculate_tp_sl,
+    CandleStorage, CANDLES, batch_screen, quick_screen,
+    analyze_signal, analyze_batch
 )
+from analysis import AnalysisExecutor
 
 def test_ema():
     """Тест EMA"""
@@ -31,6 +34,24 @@ def test_rsi():
     assert result > 50, "RSI должен быть > 50 на восходящем тренде"
     print(f"   ✅ RSI(14) = {result:.1f}")
 
+def test_rsi_series():
+    """Тест серии RSI за один проход"""
+    print("🧪 Тест RSI series...")
+    closes = [100 + i * 0.3 + (i % 7) * 1.5 - (i % 3) * 2.1 for i in range(80)]
+    
+    series = rsi_series(closes, 14)
+    assert len(series) == len(closes), "Серия выровнена по closes"
+    assert series[13] is None and series[14] is not None, "RSI определён с period+1 цен"
+    for i in range(14, len(closes)):
+        assert abs(series[i] - rsi(closes[:i+1], 14)) < 1e-9, f"RSI расходится на позиции {i}"
+    
+    assert rsi_series(list(range(50, 80)), 14)[-1] == 100.0, "Без падений RSI = 100"
+    
+    wilder = rsi_series(closes, 14, wilder=True)
+    assert wilder[14] == series[14], "Wilder стартует с простого среднего"
+    assert all(0 <= v <= 100 for v in wilder[14:]), "Wilder RSI вне диапазона"
+    print(f"   ✅ RSI = {series[-1]:.1f}, Wilder RSI = {wilder[-1]:.1f}")
+
 def test_macd():
     """Тест MACD"""
     print("🧪 Тест MACD...")
@@ -42,6 +63,46 @@ def test_macd():
     assert histogram == macd_line - signal_line, "Гистограмма = MACD - Signal"
     print(f"   ✅ MACD = {macd_line:.2f}, Signal = {signal_line:.2f}, Hist = {histogram:.2f}")
 
+def _macd_reference(closes):
+    """Прежняя (квадратичная) реализация MACD - эталон для сравнения"""
+    from config import MACD_FAST, MACD_SLOW, MACD_SIGNAL
+    if len(closes) < MACD_SLOW + MACD_SIGNAL:
+        return None
+    macd_line = ema(closes, MACD_FAST) - ema(closes, MACD_SLOW)
+    macd_history = []
+    for i in range(len(closes) - MACD_SLOW - MACD_SIGNAL, len(closes)):
+        if i < MACD_FAST:
+            continue
+        ef = ema(closes[:i+1], MACD_FAST)
+        es = ema(closes[:i+1], MACD_SLOW)
+        if ef and es:
+            macd_history.append(ef - es)
+    signal_line = ema(macd_history, MACD_SIGNAL)
+    return macd_line, signal_line, macd_line - signal_line
+
+def test_macd_series():
+    """Тест однопроходных серий MACD"""
+    print("🧪 Тест MACD series...")
+    fixtures = [
+        list(range(100, 160)),
+        [100 + (i % 9) * 1.7 - (i % 4) * 2.3 for i in range(36)],
+        [100 + i * 0.3 + (i % 7) * 1.5 for i in range(60)],
+        # Длинная история: окно сигнальной линии уходит от начала данных
+        [100 + i * 0.05 + (i % 11) * 0.9 - (i % 5) * 1.3 for i in range(320)],
+    ]
+    for closes in fixtures:
+        assert macd(closes) == _macd_reference(closes), "MACD расходится с прежней реализацией"
+        macd_line, signal_line, histogram = macd_series(closes)
+        assert len(macd_line) == len(signal_line) == len(histogram) == len(closes), "Серии выровнены по closes"
+        assert macd_line[24] is None and macd_line[25] is not None, "MACD определён с MACD_SLOW свечей"
+        assert (macd_line[-1], signal_line[-1], histogram[-1]) == macd(closes)
+        for end in (40, 100, len(closes)):
+            if end <= len(closes):
+                assert signal_line[end - 1] == _macd_reference(closes[:end])[1], f"Сигнальная линия на {end} свечах"
+    
+    assert macd_series(list(range(30))) is None, "Мало данных - None"
+    print(f"   ✅ Последние значения совпадают на {len(fixtures)} наборах")
+
 def test_bollinger_bands():
     """Тест Bollinger Bands"""
     print("🧪 Тест Bollinger Bands...")
@@ -78,6 +139,102 @@ def test_atr():
     assert result > 0, "ATR должен быть положительным"
     print(f"   ✅ ATR(14) = {result:.2f}")
 
+def test_batch_screen():
+    """Тест скрининга пар по состоянию индикаторов"""
+    print("🧪 Тест batch_screen...")
+    import math
+    pairs = {
+        "TRENDAUSDT": lambda i: 100 + i * 0.8,                 # сильный тренд
+        "FLATAUSDT": lambda i: 100 + math.sin(i) * 0.01,      # флэт
+        "SHORTAUSDT": lambda i: 100 + i * 0.8,                 # мало свечей
+        "WAVEAUSDT": lambda i: 50 + math.sin(i / 5) * 4,       # волна
+    }
+    for name, price in pairs.items():
+        candles = 40 if name == "SHORTAUSDT" else 90 + len(name)
+        for i in range(candles):
+            CANDLES.add_price(name, price(i), 10 + i % 4, i * CANDLES.tf)
+    
+    # Больше maxlen свечей: EMA идут из состояния, а не из окна кольцевого буфера
+    pairs["LONGAUSDT"] = lambda i: 100 + (i if i < 350 else 350 + math.sin(i) * 0.05) * 0.3
+    pairs["LONGBUSDT"] = lambda i: 80 + math.sin(i / 40) * 6
+    for name in ("LONGAUSDT", "LONGBUSDT"):
+        for i in range(CANDLES.maxlen + 100):
+            CANDLES.add_price(name, pairs[name](i), 10.0, i * CANDLES.tf)
+    assert CANDLES.get_state("LONGAUSDT").count > CANDLES.count("LONGAUSDT"), "Окно короче истории"
+    
+    result = batch_screen(list(pairs) + ["NOPEUSDT"])
+    assert "NOPEUSDT" not in result and "NOPEUSDT" not in CANDLES.states, "Пара без свечей не создаёт состояние"
+    for name in pairs:
+        assert (name in result) == quick_screen(name), f"batch_screen расходится с quick_screen для {name}"
+    assert "TRENDAUSDT" in result and "FLATAUSDT" not in result and "SHORTAUSDT" not in result
+    
+    for name, spread in result.items():
+        state = CANDLES.get_state(name)
+        ema9, ema21 = state.ema(9), state.ema(21)
+        assert spread == abs(ema9 - ema21) / ema21, f"EMA-спред {name} расходится с состоянием"
+    print(f"   ✅ Кандидаты: {', '.join(sorted(result))}")
+
+def test_analyze_snapshot():
+    """Тест анализа по снимку (как в воркере пула процессов)"""
+    print("🧪 Тест analyze_batch по снимкам...")
+    import pickle
+    import random
+    random.seed(0)
+    price = 100.0
+    for i in range(300):
+        price *= 1 + random.gauss(0.002, 0.01)
+        CANDLES.add_price("SNAPUSDT", price, random.uniform(5, 15) * (4 if i == 299 else 1), i * CANDLES.tf)
+    
+    snapshot = pickle.loads(pickle.dumps(CANDLES.snapshot("SNAPUSDT")))
+    [(pair, signal)] = analyze_batch([snapshot])
+    assert pair == "SNAPUSDT", "Пара сохраняется в результате"
+    assert signal is not None and signal == analyze_signal("SNAPUSDT"), "Снимок даёт тот же сигнал"
+    print(f"   ✅ {signal['side']} ({signal['score']}/100)")
+
+def test_analysis_executor():
+    """Тест пула анализа: воркеры дают тот же сигнал, упавший пул - переход на inline"""
+    print("🧪 Тест AnalysisExecutor...")
+    import asyncio
+    import random
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+    random.seed(0)
+    price = 100.0
+    for i in range(300):
+        price *= 1 + random.gauss(0.002, 0.01)
+        CANDLES.add_price("POOLUSDT", price, random.uniform(5, 15) * (4 if i == 299 else 1), i * CANDLES.tf)
+    expected = analyze_signal("POOLUSDT")
+    
+    class BrokenPool:
+        """Пул, чьи воркеры умерли"""
+        def submit(self, fn, *args):
+            future = Future()
+            future.set_exception(BrokenProcessPool("worker died"))
+            return future
+        
+        def shutdown(self, wait=True, cancel_futures=False):
+            pass
+    
+    async def run():
+        executor = AnalysisExecutor(workers=1)
+        executor.start()
+        try:
+            pooled = await executor.analyze(["POOLUSDT"])
+            method = executor._pool._mp_context.get_start_method()
+        finally:
+            executor.shutdown()
+        
+        executor._pool = BrokenPool()
+        fallback = await executor.analyze(["POOLUSDT"])
+        return pooled, method, fallback, executor.inline
+    
+    pooled, method, fallback, inline = asyncio.run(run())
+    assert expected is not None, "Тестовая пара даёт сигнал"
+    assert method in ("forkserver", "spawn"), f"Воркеры не через fork: {method}"
+    assert pooled == {"POOLUSDT": expected}, "Пул даёт тот же сигнал, что и inline"
+    assert fallback == {"POOLUSDT": expected} and inline, "Упавший пул - анализ inline"
+    print(f"   ✅ Пул ({method}) и переход на inline дают {expected['side']} ({expected['score']}/100)")
+
 def test_calculate_tp_sl():
     """Тест расчёта TP/SL"""
     print("🧪 Тест TP/SL...")
@@ -106,6 +263,58 @@ def test_calculate_tp_sl():
     print(f"      SL:  {result['stop_loss']:.2f} (+{result['sl_percent']:.2f}%)")
     print(f"      TP1: {result['take_profit_1']:.2f} (-{result['tp1_percent']:.2f}%)")
 
+def test_candle_ring():
+    """Тест колоночного кольцевого буфера свечей"""
+    print("🧪 Тест CandleStorage (ring buffer)...")
+    storage = CandleStorage(timeframe=60, maxlen=10)
+    for i in range(25):
+        storage.add_price("TESTUSDT", 100.0 + i, 5.0, i * 60)
+        storage.add_price("TESTUSDT", 101.5 + i, 1.0, i * 60 + 30)
+    
+    closes = storage.get_column("TESTUSDT", "c")
+    assert len(closes) == storage.count("TESTUSDT") == 11, "maxlen закрытых + текущая"
+    assert closes.flags["C_CONTIGUOUS"], "View должен быть непрерывным"
+    assert closes.base is not None, "Колонка отдаётся без копирования"
+    assert list(closes) == [101.5 + i for i in range(14, 25)], "Хронологический порядок после переполнения"
+    
+    candles = storage.get_candles("TESTUSDT")
+    assert [c["c"] for c in candles] == list(closes), "get_candles совпадает с колонками"
+    assert candles[-1] == {"ts": 24 * 60, "o": 124.0, "h": 125.5, "l": 124.0, "c": 125.5, "v": 6.0}
+    assert storage.get_column("NONEUSDT", "c").size == 0, "Пустая колонка для неизвестной пары"
+    print(f"   ✅ {len(closes)} свечей, последняя close = {closes[-1]:.1f}")
+
+def test_indicator_state():
+    """Тест инкрементального состояния индикаторов"""
+    print("🧪 Тест IndicatorState...")
+    storage = CandleStorage(timeframe=60, maxlen=1000)
+    # Пила с трендом, несколько тиков на свечу
+    for i in range(120):
+        base = 100 + i * 0.3 + (i % 7) * 1.5
+        for j, shift in enumerate((0.0, 0.8, -0.6, 0.2)):
+            storage.add_price("TESTUSDT", base + shift, 10 + (i % 5) + j, i * 60 + j)
+    
+    state = storage.get_state("TESTUSDT")
+    candles = storage.get_candles("TESTUSDT")
+    closes = [c["c"] for c in candles]
+    assert state.count == len(candles) == 120, f"Неверное число свечей: {state.count}"
+    
+    def close_to(a, b):
+        return abs(a - b) <= 1e-9 * max(1.0, abs(b))
+    
+    for period in (9, 21, 50):
+        assert close_to(state.ema(period), ema(closes, period)), f"EMA({period}) расходится"
+    assert close_to(state.rsi(), rsi(closes, 14)), "RSI расходится"
+    for a, b in zip(state.bollinger_bands(), bollinger_bands(closes)):
+        assert close_to(a, b), "BB расходится"
+    assert close_to(state.atr(), atr(candles, 14)), "ATR расходится"
+    assert close_to(state.volume_strength(), volume_strength(candles, 20)), "Volume strength расходится"
+    
+    macd_line, signal_line, histogram = state.macd()
+    assert close_to(macd_line, ema(closes, 12) - ema(closes, 26)), "MACD line расходится"
+    assert histogram == macd_line - signal_line, "Гистограмма = MACD - Signal"
+    assert close_to(state.rsi_wilder(), rsi_series(closes, 14, wilder=True)[-1]), "Wilder RSI расходится"
+    print(f"   ✅ EMA/RSI/MACD/BB/ATR совпадают (RSI={state.rsi():.1f}, Wilder={state.rsi_wilder():.1f})")
+
 def run_all_tests():
     """Запустить все тесты"""
     print("=" * 50)
@@ -116,11 +325,18 @@ def run_all_tests():
     tests = [
         test_ema,
         test_rsi,
+        test_rsi_series,
         test_macd,
+        test_macd_series,
         test_bollinger_bands,
         test_volume_strength,
         test_atr,
-        test_calculate_tp_sl
+        test_calculate_tp_sl,
+        test_indicator_state,
+        test_candle_ring,
+        test_batch_screen,
+        test_analyze_snapshot,
+        test_analysis_executor
     ]
     
     passed = 0
@@ -147,4 +363,4 @@ def run_all_tests():
 
 if __name__ == "__main__":
     success = run_all_tests()
-    sys.exit(0 if success else 1)
\ No newline at end of file
+    sys.exit(0 if success else 1)
\ No newline at end of file
@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+"""
+test_market_data.py - Тестирование сбора рыночных данных на локальной заглушке Binance
+Запуск: python test_market_data.py
+"""
+import sys
+import json
+import asyncio
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import httpx
+from aiohttp import web, WSMsgType
+
+import indicators
+from indicators import CANDLES, PRICE_CACHE, fetch_prices
+from market_data import MARKET_DATA, MarketDataClient
+from config import KLINE_RETRY_DELAY
+from ws_ingest import StreamIngestor
+from database import get_candle_ranges, get_candle_depths
+import tasks
+import import_history_tf
+from import_history_tf import import_pairs
+from test_database import temp_db
+
+# ==================== STUB SERVER ====================
+class StubBinance:
+    """Локальная заглушка REST API Binance (ticker/24hr, klines)"""
+    def __init__(self, tickers: dict, delay: float = 0.0, klines: dict = None):
+        self.tickers = tickers  # symbol -> (lastPrice, volume)
+        self.klines = klines or {}  # symbol -> [[open_ms, o, h, l, c, v, close_ms], ...]
+        self.delay = delay
+        self.requests = []
+        self.fail_after = None  # после стольких запросов - ошибка 500 (обрыв импорта)
+        self.server = None
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def _ticker(self, symbol: str) -> dict:
+        price, volume = self.tickers[symbol]
+        return {"symbol": symbol, "lastPrice": str(price), "volume": str(volume)}
+
+    def handle(self, path: str, query: dict):
+        self.requests.append((path, query))
+        if self.fail_after is not None and len(self.requests) > self.fail_after:
+            return 500, {"code": -1000, "msg": "Unavailable"}
+        if path == "/api/v3/ticker/24hr":
+            if "symbol" in query:
+                symbol = query["symbol"][0]
+                if symbol not in self.tickers:
+                    return 400, {"code": -1121, "msg": "Invalid symbol."}
+                return 200, self._ticker(symbol)
+            if "symbols" in query:
+                symbols = json.loads(query["symbols"][0])
+                if any(s not in self.tickers for s in symbols):
+                    return 400, {"code": -1121, "msg": "Invalid symbol."}
+                return 200, [self._ticker(s) for s in symbols]
+            return 200, [self._ticker(s) for s in self.tickers]
+        if path == "/api/v3/klines":
+            rows = self.klines.get(query["symbol"][0], [])
+            start = int(query.get("startTime", [0])[0])
+            end = int(query.get("endTime", [2 ** 62])[0])
+            limit = int(query.get("limit", [500])[0])
+            rows = [r for r in rows if start <= r[0] <= end]
+            return 200, rows[:limit] if "startTime" in query else rows[-limit:]
+        return 404, {"code": -1, "msg": "Not found"}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    @contextmanager
+    def running(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                time.sleep(stub.delay)
+                parsed = urlparse(self.path)
+                status, body = stub.handle(parsed.path, parse_qs(parsed.query))
+                with stub._lock:
+                    stub.active -= 1
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        old_url = indicators.BINANCE_API_URL
+        indicators.BINANCE_API_URL = self.url
+        try:
+            yield self
+        finally:
+            indicators.BINANCE_API_URL = old_url
+            self.server.shutdown()
+            self.server.server_close()
+
+class StubStream:
+    """Локальная замена WebSocket-стримов Binance (/stream, SUBSCRIBE/UNSUBSCRIBE)"""
+    def __init__(self):
+        self.sockets = {}  # ws -> set(streams)
+        self.connections = 0
+        self.runner = None
+        self.url = None
+
+    @property
+    def streams(self) -> set:
+        return set().union(*self.sockets.values()) if self.sockets else set()
+
+    async def handler(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+        self.sockets[ws] = set()
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                data = json.loads(msg.data)
+                if data["method"] == "SUBSCRIBE":
+                    self.sockets[ws] |= set(data["params"])
+                elif data["method"] == "UNSUBSCRIBE":
+                    self.sockets[ws] -= set(data["params"])
+                await ws.send_json({"result": None, "id": data["id"]})
+        finally:
+            self.sockets.pop(ws, None)
+        return ws
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/stream", self.handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"ws://{host}:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def push(self, stream: str, data: dict):
+        for ws, streams in list(self.sockets.items()):
+            if stream in streams:
+                await ws.send_json({"stream": stream, "data": data})
+
+    async def drop_all(self):
+        for ws in list(self.sockets):
+            await ws.close()
+
+async def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Условие не выполнено за отведённое время")
+        await asyncio.sleep(0.02)
+
+def make_tickers(count: int) -> dict:
+    return {f"C{i:03d}USDT": (100.0 + i, 1000.0 + i) for i in range(count)}
+
+# ==================== TESTS ====================
+def test_bulk_fetch_symbols():
+    """Тест bulk-запроса symbols=[...]"""
+    print("🧪 Тест fetch_prices (symbols=[...])...")
+    PRICE_CACHE.cache.clear()
+    stub = StubBinance(make_tickers(30))
+    pairs = list(stub.tickers)[:20]
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            return await fetch_prices(client, pairs)
+
+    with stub.running():
+        prices = asyncio.run(run())
+
+    assert len(stub.requests) == 1, f"Ожидался 1 запрос, было {len(stub.requests)}"
+    assert "symbols" in stub.requests[0][1], "Должна использоваться форма symbols=[...]"
+    assert set(prices) == set(pairs), "Цены для всех запрошенных пар"
+    assert prices["C005USDT"] == (105.0, 1005.0)
+    assert PRICE_CACHE.get("C005USDT") == (105.0, 1005.0), "Кэш заполнен"
+    print(f"   ✅ {len(prices)} пар за {len(stub.requests)} запрос")
+
+def test_bulk_fetch_all_symbols():
+    """Тест запроса всех тикеров для большого списка пар"""
+    print("🧪 Тест fetch_prices (все символы)...")
+    PRICE_CACHE.cache.clear()
+    stub = StubBinance(make_tickers(300))
+    pairs = list(stub.tickers)[:250]
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            first = await fetch_prices(client, pairs)
+            second = await fetch_prices(client, pairs)
+            return first, second
+
+    with stub.running():
+        first, second = asyncio.run(run())
+
+    assert len(stub.requests) == 1, "Второй вызов должен отдаваться из кэша"
+    assert stub.requests[0][1] == {}, "Должна использоваться форма без параметров"
+    assert set(first) == set(pairs) and first == second
+    print(f"   ✅ {len(first)} пар за {len(stub.requests)} запрос")
+
+def test_bulk_fetch_fallback():
+    """Тест фолбэка на поштучные запросы при неизвестной паре"""
+    print("🧪 Тест fetch_prices (фолбэк)...")
+    PRICE_CACHE.cache.clear()
+    stub = StubBinance(make_tickers(5))
+    pairs = ["C000USDT", "C001USDT", "NOPEUSDT"]
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            return await fetch_prices(client, pairs)
+
+    with stub.running():
+        prices = asyncio.run(run())
+
+    assert set(prices) == {"C000USDT", "C001USDT"}, "Известные пары получены поштучно"
+    assert len(stub.requests) == 1 + len(pairs), "1 bulk + запрос на каждую пару"
+    print(f"   ✅ {len(prices)} из {len(pairs)} пар после фолбэка")
+
+def test_concurrent_fetch():
+    """Тест параллельных поштучных запросов через общий клиент"""
+    print("🧪 Тест MarketDataClient.fetch_many...")
+    PRICE_CACHE.cache.clear()
+    stub = StubBinance(make_tickers(12), delay=0.1)
+    market = MarketDataClient(max_connections=8)
+
+    async def run():
+        try:
+            started = time.monotonic()
+            prices = await market.fetch_many(list(stub.tickers), limit=4)
+            return prices, time.monotonic() - started
+        finally:
+            await market.close()
+
+    with stub.running():
+        prices, elapsed = asyncio.run(run())
+
+    assert len(prices) == 12, "Цены для всех пар"
+    assert 1 < stub.max_active <= 4, f"Одновременных запросов: {stub.max_active}"
+    assert elapsed < 12 * stub.delay * 0.6, f"Запросы должны идти параллельно ({elapsed:.2f}s)"
+    print(f"   ✅ 12 пар за {elapsed:.2f}s, максимум {stub.max_active} одновременно")
+
+def test_stream_ingest():
+    """Тест потокового приёма: подписки, свечи, переподключение и добор пропуска"""
+    print("🧪 Тест StreamIngestor...")
+    tf = CANDLES.tf
+    base = 1_700_000_000 // tf * tf
+    pairs = ["WSAUSDT", "WSBUSDT", "WSCUSDT"]
+    for pair in pairs:
+        CANDLES.clear(pair)
+
+    def kline(i, price):
+        return [(base + i * tf) * 1000, str(price), str(price + 1), str(price - 1), str(price + 0.5), "10", 0]
+
+    rest = StubBinance({}, klines={"WSAUSDT": [kline(i, 100 + i) for i in range(8)]})
+    stream = StubStream()
+
+    async def run():
+        await stream.start()
+        ingestor = StreamIngestor(url=stream.url, interval="1h", streams_per_connection=4)
+        try:
+            await ingestor.sync(pairs)
+            assert len(ingestor.connections) == 2, "2 пары на соединение -> 2 соединения"
+            await wait_for(lambda: len(stream.streams) == 6)
+            assert CANDLES.count("WSAUSDT") == 8, "Новая пара получает историю по REST"
+
+            # Обновление текущей свечи из kline-стрима
+            await stream.push("wsausdt@kline_1h", {"e": "kline", "k": {
+                "s": "WSAUSDT", "t": (base + 7 * tf) * 1000,
+                "o": "107", "h": "120", "l": "106", "c": "118", "v": "42", "x": False}})
+            await stream.push("wsbusdt@miniTicker", {"e": "24hrMiniTicker", "s": "WSBUSDT", "c": "5.5", "v": "900"})
+            await wait_for(lambda: CANDLES.get_column("WSAUSDT", "c")[-1] == 118.0)
+            assert CANDLES.get_candles("WSAUSDT")[-1]["v"] == 42.0, "Объём берётся из kline, не суммируется"
+            assert PRICE_CACHE.get("WSBUSDT") == (5.5, 900.0), "miniTicker обновляет кэш цен"
+
+            # Пользователи убрали пару - её соединение опустело и закрывается
+            await ingestor.sync(pairs[:2])
+            await wait_for(lambda: "wscusdt@kline_1h" not in stream.streams)
+            await wait_for(lambda: len(stream.sockets) == 1)
+            assert len(ingestor.connections) == 1, "Пустое соединение удалено"
+
+            # Разрыв: пока соединения нет, на бирже закрылись новые свечи
+            rest.klines["WSAUSDT"] += [kline(i, 100 + i) for i in range(8, 11)]
+            await stream.drop_all()
+            await wait_for(lambda: CANDLES.count("WSAUSDT") == 11, timeout=8)
+            await wait_for(lambda: len(stream.streams) == 4)
+            assert stream.connections >= 3, "Соединение переподключилось"
+
+            # Пара снова нужна - открывается новое соединение
+            await ingestor.sync(pairs)
+            await wait_for(lambda: len(stream.streams) == 6)
+            assert len(ingestor.connections) == 2
+        finally:
+            await ingestor.stop()
+            await stream.stop()
+            await MARKET_DATA.close()
+
+    with rest.running():
+        asyncio.run(run())
+    print(f"   ✅ {CANDLES.count('WSAUSDT')} свечей после переподключения, подписок: 4")
+
+def test_kline_sync():
+    """Тест синхронизации закрытых свечей по klines"""
+    print("🧪 Тест MarketDataClient.sync_klines...")
+    tf = CANDLES.tf
+    base = 1_700_000_000 // tf * tf
+    pairs = ["KLAUSDT", "KLBUSDT"]
+    for pair in pairs:
+        CANDLES.clear(pair)
+
+    def kline(i):
+        return [(base + i * tf) * 1000, "10", "12", "9", str(10 + i), "5", (base + (i + 1) * tf) * 1000 - 1]
+
+    rest = StubBinance({}, klines={p: [kline(i) for i in range(21)] for p in pairs})
+    market = MarketDataClient()
+
+    async def run():
+        try:
+            # Свеча 20 ещё открыта
+            now = base + 20 * tf + tf // 2
+            first = await market.sync_klines(pairs, now=now, refresh=60)
+            opened = CANDLES.count("KLAUSDT"), CANDLES.get_column("KLAUSDT", "c")[-1]
+            second = await market.sync_klines(pairs, now=now + 10, refresh=60)
+            # Открытая свеча изменилась - обновляется по интервалу refresh
+            rest.klines["KLAUSDT"][20][4] = "42"
+            refreshed = await market.sync_klines(pairs, now=now + 60, refresh=60)
+            partial = CANDLES.count("KLAUSDT"), CANDLES.get_column("KLAUSDT", "c")[-1]
+            # Закрылась свеча 20, открылась 21
+            rest.klines["KLAUSDT"][20][4] = "43"
+            rest.klines["KLAUSDT"].append(kline(21))
+            third = await market.sync_klines(pairs, now=base + 21 * tf + 5, refresh=60)
+            return first, second, refreshed, third, opened, partial
+        finally:
+            await market.close()
+
+    with rest.running():
+        first, second, refreshed, third, opened, partial = asyncio.run(run())
+
+    assert (first, second, refreshed, third) == (2, 0, 2, 2), f"Запросы: {first}, {second}, {refreshed}, {third}"
+    assert opened == (21, 30.0), f"Открытая свеча - текущая: {opened}"
+    assert partial == (21, 42.0), f"Открытая свеча обновлена: {partial}"
+    assert CANDLES.count("KLAUSDT") == 22 and CANDLES.last_ts("KLAUSDT") == base + 21 * tf
+    closed = CANDLES.get_candles("KLAUSDT")[-2]
+    assert closed["ts"] == base + 20 * tf and closed["c"] == 43.0, "Закрытая свеча перезаписана биржевой"
+    assert closed["v"] == 5.0, "Объём свечи - биржевой"
+    assert rest.requests[-1][1]["startTime"] == [str((base + 20 * tf) * 1000)], "startTime = после последней закрытой"
+    assert market.next_close(["KLAUSDT"]) == base + 22 * tf
+    print(f"   ✅ Запросов: {first} + {second} + {refreshed} + {third}, свечей: {CANDLES.count('KLAUSDT')}")
+
+def test_kline_backoff():
+    """Тест паузы для пары без данных: klines не запрашиваются каждую секунду"""
+    print("🧪 Тест паузы sync_klines для пары без данных...")
+    pair = "KLZUSDT"
+    CANDLES.clear(pair)
+    rest = StubBinance({})  # пара неизвестна - klines пустые
+    market = MarketDataClient()
+    now = 1_700_000_000
+
+    async def run():
+        try:
+            counts = [await market.sync_klines([pair], now=now)]
+            counts.append(await market.sync_klines([pair], now=now + 1))
+            counts.append(await market.sync_klines([pair], now=now + KLINE_RETRY_DELAY))
+            # Вторая неудача подряд - пауза удваивается
+            counts.append(await market.sync_klines([pair], now=now + 2 * KLINE_RETRY_DELAY))
+            counts.append(await market.sync_klines([pair], now=now + 3 * KLINE_RETRY_DELAY))
+            return counts
+        finally:
+            await market.close()
+
+    with rest.running():
+        counts = asyncio.run(run())
+
+    requested = [q for path, q in rest.requests if path == "/api/v3/klines"]
+    assert counts == [1, 0, 1, 0, 1], f"Запросы по проходам: {counts}"
+    assert len(requested) == 3, f"Запросов klines: {len(requested)}"
+    assert market.next_close([pair]) is None, "Пара без данных не будит сборщик"
+    print(f"   ✅ Пустая пара: {len(requested)} запроса за 5 проходов")
+
+def test_gap_backfill():
+    """Тест поиска пропусков в истории и точечной догрузки"""
+    print("🧪 Тест MarketDataClient.backfill_gaps...")
+    tf = CANDLES.tf
+    base = 1_700_000_000 // tf * tf
+    pairs = ["GPAUSDT", "GPBUSDT"]
+
+    def candle(i):
+        return {"ts": base + i * tf, "o": 10.0, "h": 12.0, "l": 9.0, "c": 10.0 + i, "v": 5.0}
+
+    def kline(i):
+        return [(base + i * tf) * 1000, "10", "12", "9", str(10 + i), "5", 0]
+
+    # GPAUSDT: дыра 20-24 и простой 30-39 (свечи 35 нет и на бирже)
+    CANDLES.load("GPAUSDT", [candle(i) for i in list(range(20)) + list(range(25, 30))])
+    CANDLES.load("GPBUSDT", [candle(i) for i in range(41)])
+    rest = StubBinance({}, klines={
+        "GPAUSDT": [kline(i) for i in range(45) if i != 35],
+        "GPBUSDT": [kline(i) for i in range(45)],
+    })
+    market = MarketDataClient()
+    now = base + 40 * tf + 10  # свеча 40 открыта
+
+    async def run():
+        try:
+            first = await market.backfill_gaps(pairs, now=now)
+            second = await market.backfill_gaps(pairs, now=now)
+            unfillable = {p: set(b) for p, b in market._unfillable.items()}
+            # Простой ушёл из окна истории - запоминать его больше незачем
+            await market.backfill_gaps([], now=now + CANDLES.maxlen * tf)
+            return first, second, unfillable
+        finally:
+            await market.close()
+
+    with rest.running():
+        first, second, unfillable = asyncio.run(run())
+
+    expected = [i for i in range(40) if i != 35]
+    assert (first, second) == (1, 0), f"Запросы: {first}, {second}"
+    assert unfillable == {"GPAUSDT": {base + 35 * tf}} and not market._unfillable, "Память пропусков ограничена окном"
+    assert rest.requests[0][1]["startTime"] == [str((base + 20 * tf) * 1000)], "Запрос только по пропускам"
+    assert list(CANDLES.get_column("GPAUSDT", "ts")) == [base + i * tf for i in expected]
+    assert CANDLES.get_state("GPAUSDT").count == len(expected), "Состояние индикаторов пересобрано"
+    assert CANDLES.last_ts("GPAUSDT") == base + 39 * tf and CANDLES.count("GPBUSDT") == 41
+    print(f"   ✅ Догружено {len(expected) - 25} свечей за {first} запрос")
+
+def test_history_import():
+    """Тест постраничного параллельного импорта истории с продолжением"""
+    print("🧪 Тест import_pairs...")
+    tf = 3600
+    base = 1_700_000_000 // tf * tf
+    pairs = ["HIAUSDT", "HIBUSDT", "HICUSDT"]
+
+    def kline(i):
+        return [(base + i * tf) * 1000, "10", "12", "9", str(10 + i), "5", (base + (i + 1) * tf) * 1000 - 1]
+
+    klines = {p: [kline(i) for i in range(2500)] for p in pairs[:2]}
+    klines["HICUSDT"] = [kline(i) for i in range(1900, 2500)]  # торгуется недавно
+    rest = StubBinance({}, delay=0.05, klines=klines)
+    now = base + 2500 * tf + tf // 2  # свеча 2500 открыта
+
+    async def run():
+        async with temp_db():
+            try:
+                first = await import_pairs(pairs, "1h", 1200, concurrency=3, now=now)
+                requests_first = len(rest.requests)
+                # Повторный запуск глубже - догружается только старая часть
+                second = await import_pairs(pairs, "1h", 2200, concurrency=3, now=now)
+                requests_second = len(rest.requests) - requests_first
+                # Прошло 2 свечи - догружаются только новые
+                for p in pairs[:2]:
+                    rest.klines[p] += [kline(2500), kline(2501)]
+                third = await import_pairs(pairs, "1h", 2200, concurrency=3, now=now + 2 * tf)
+                requests_third = len(rest.requests) - requests_first - requests_second
+                ranges = await get_candle_ranges(tf)
+                
+                # Очистка в candle_persister оставляет импортированную глубину
+                flush_interval = tasks.CANDLE_FLUSH_INTERVAL
+                tasks.CANDLE_FLUSH_INTERVAL = 0.01
+                try:
+                    persister = asyncio.create_task(tasks.candle_persister())
+                    await asyncio.sleep(0.1)
+                    persister.cancel()
+                    await asyncio.gather(persister, return_exceptions=True)
+                finally:
+                    tasks.CANDLE_FLUSH_INTERVAL = flush_interval
+                pruned = await get_candle_ranges(tf)
+            finally:
+                await MARKET_DATA.close()
+        return first, second, third, (requests_first, requests_second, requests_third), ranges, pruned
+
+    with rest.running():
+        first, second, third, requests, ranges, pruned = asyncio.run(run())
+
+    assert first == {"HIAUSDT": 1200, "HIBUSDT": 1200, "HICUSDT": 600}, f"Первый импорт: {first}"
+    assert second == {"HIAUSDT": 1000, "HIBUSDT": 1000, "HICUSDT": 0}, f"Продолжение: {second}"
+    assert third == {"HIAUSDT": 2, "HIBUSDT": 2, "HICUSDT": 0}, f"Новые свечи: {third}"
+    assert requests == (6, 3, 4), f"Запросов: {requests}"
+    assert rest.max_active > 1, "Пары импортируются параллельно"
+    assert ranges["HIAUSDT"] == (base + 300 * tf, base + 2501 * tf, 2202)
+    assert ranges["HICUSDT"] == (base + 1900 * tf, base + 2499 * tf, 600)
+    # Глубина 2200 от последней свечи: уходят только 2 свечи, сдвинутые новыми
+    assert pruned["HIAUSDT"] == (base + 302 * tf, base + 2501 * tf, 2200), f"После очистки: {pruned}"
+    assert pruned["HICUSDT"] == ranges["HICUSDT"], "Импортированная история не удалена"
+    print(f"   ✅ Запросов: {requests}, свечей HIAUSDT: {ranges['HIAUSDT'][2]}")
+
+def test_history_import_resume():
+    """Тест импорта, оборванного на середине: повторный запуск не оставляет дыр"""
+    print("🧪 Тест import_pairs (обрыв и продолжение)...")
+    tf = 3600
+    base = 1_700_000_000 // tf * tf
+    pair = "HIDUSDT"
+
+    def kline(i):
+        return [(base + i * tf) * 1000, "10", "12", "9", str(10 + i), "5", (base + (i + 1) * tf) * 1000 - 1]
+
+    rest = StubBinance({}, klines={pair: [kline(i) for i in range(5000)]})
+    retries = import_history_tf.FETCH_RETRIES
+
+    async def run():
+        async with temp_db() as pool:
+            try:
+                await import_pairs([pair], "1h", 1200, now=base + 2500 * tf + 5)
+                # Прошло 2500 свечей; импорт обрывается после первой страницы
+                import_history_tf.FETCH_RETRIES = 1
+                rest.fail_after = len(rest.requests) + 1
+                interrupted = await import_pairs([pair], "1h", 1200, now=base + 5000 * tf + 5)
+                after_crash = (await get_candle_ranges(tf))[pair]
+                rest.fail_after = None
+                resumed = await import_pairs([pair], "1h", 1200, now=base + 5000 * tf + 5)
+                after_resume = (await get_candle_ranges(tf))[pair]
+                # Дыра в сохранённой истории перезапрашивается
+                await pool.write(("DELETE FROM candles WHERE pair=? AND ts BETWEEN ? AND ?",
+                                  (pair, base + 4000 * tf, base + 4099 * tf)))
+                await import_pairs([pair], "1h", 1200, now=base + 5000 * tf + 5)
+                after_hole = (await get_candle_ranges(tf))[pair]
+            finally:
+                import_history_tf.FETCH_RETRIES = retries
+                await MARKET_DATA.close()
+        return interrupted, after_crash, resumed, after_resume, after_hole
+
+    with rest.running():
+        interrupted, after_crash, resumed, after_resume, after_hole = asyncio.run(run())
+
+    assert interrupted == {pair: None}, f"Импорт оборван: {interrupted}"
+    assert after_crash == (base + 1300 * tf, base + 3499 * tf, 2200), f"После обрыва без дыры: {after_crash}"
+    assert resumed == {pair: 1500}, f"Продолжение: {resumed}"
+    assert after_resume == (base + 1300 * tf, base + 4999 * tf, 3700), f"После продолжения: {after_resume}"
+    assert after_hole == after_resume, f"Дыра заполнена: {after_hole}"
+    print(f"   ✅ После обрыва и продолжения: {after_resume[2]} свечей без пропусков")
+
+def test_archive_import_merges_once():
+    """Тест импорта в архив (mmap): страницы вливаются в файл одним merge"""
+    print("🧪 Тест import_pairs в CandleArchive...")
+    import tempfile
+    from candle_archive import CandleArchive
+    tf = 3600
+    base = 1_700_000_000 // tf * tf
+    pair = "HIEUSDT"
+
+    def kline(i):
+        return [(base + i * tf) * 1000, "10", "12", "9", str(10 + i), "5", (base + (i + 1) * tf) * 1000 - 1]
+
+    rest = StubBinance({}, klines={pair: [kline(i) for i in range(2500)]})
+    merges = []
+    original_merge = CandleArchive.merge
+    store = import_history_tf.CANDLE_STORE
+
+    def counting_merge(self, pair, candles):
+        merges.append(len(candles))
+        return original_merge(self, pair, candles)
+
+    async def run():
+        async with temp_db():
+            try:
+                result = await import_pairs([pair], "1h", 2400, now=base + 2500 * tf + 5)
+            finally:
+                await MARKET_DATA.close()
+            return result, await get_candle_depths(tf)
+
+    with tempfile.TemporaryDirectory() as tmp, rest.running():
+        import_history_tf.CANDLE_STORE = "mmap"
+        CandleArchive.merge = counting_merge
+        # Архив импорта - во временном каталоге
+        old_init = CandleArchive.__init__
+        CandleArchive.__init__ = lambda self, directory=tmp, tf=tf: old_init(self, directory, tf)
+        try:
+            result, depths = asyncio.run(run())
+            stored = CandleArchive(tmp, tf).range(pair)
+        finally:
+            CandleArchive.__init__ = old_init
+            CandleArchive.merge = original_merge
+            import_history_tf.CANDLE_STORE = store
+
+    assert result == {pair: 2400}, f"Импорт: {result}"
+    assert merges == [2400], f"Слияний с файлом: {merges}"
+    assert stored == (base + 100 * tf, base + 2499 * tf, 2400), f"Архив: {stored}"
+    assert depths == {pair: 2400}, f"Глубина импорта: {depths}"
+    print(f"   ✅ 3 страницы, {len(merges)} merge")
+
+def run_all_tests():
+    """Запустить все тесты"""
+    print("=" * 50)
+    print("🧪 Тестирование сбора рыночных данных")
+    print("=" * 50)
+    print()
+
+    tests = [
+        test_bulk_fetch_symbols,
+        test_bulk_fetch_all_symbols,
+        test_bulk_fetch_fallback,
+        test_concurrent_fetch,
+        test_stream_ingest,
+        test_kline_sync,
+        test_kline_backoff,
+        test_gap_backfill,
+        test_history_import,
+        test_history_import_resume,
+        test_archive_import_merges_once,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except AssertionError as e:
+            print(f"   ❌ Тест провален: {e}")
+            failed += 1
+        except Exception as e:
+            print(f"   ❌ Ошибка: {e}")
+            failed += 1
+        print()
+
+    print("=" * 50)
+    print(f"✅ Пройдено: {passed}")
+    print(f"❌ Провалено: {failed}")
+    print("=" * 50)
+
+    return failed == 0
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
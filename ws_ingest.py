@@ -0,0 +1,203 @@
+"""
+ws_ingest.py - Потоковый приём рыночных данных по WebSocket (kline + miniTicker)
+"""
+import json
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional, Set
+import aiohttp
+
+from config import (
+    BINANCE_WS_URL, TIMEFRAME, MAX_CANDLES,
+    WS_STREAMS_PER_CONNECTION, HTTP_CONCURRENCY
+)
+from indicators import CANDLES, PRICE_CACHE, fetch_klines
+from market_data import MARKET_DATA
+
+logger = logging.getLogger(__name__)
+
+STREAMS_PER_PAIR = 2  # kline + miniTicker
+
+def pair_streams(pair: str, interval: str) -> List[str]:
+    p = pair.lower()
+    return [f"{p}@kline_{interval}", f"{p}@miniTicker"]
+
+class StreamConnection:
+    """Одно WebSocket-соединение с combined-стримами своей группы пар"""
+    def __init__(self, ingestor: "StreamIngestor", index: int):
+        self.ingestor = ingestor
+        self.index = index
+        self.pairs: Set[str] = set()
+        self.ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self.connected = asyncio.Event()
+        self.reconnects = 0
+        self.task: Optional[asyncio.Task] = None
+        self._msg_id = 0
+
+    @property
+    def free_slots(self) -> int:
+        return self.ingestor.streams_per_connection // STREAMS_PER_PAIR - len(self.pairs)
+
+    async def _send(self, method: str, pairs: Iterable[str]):
+        pairs = sorted(pairs)
+        if not pairs or self.ws is None or self.ws.closed:
+            return
+        self._msg_id += 1
+        params = [s for p in pairs for s in pair_streams(p, self.ingestor.interval)]
+        await self.ws.send_json({"method": method, "params": params, "id": self._msg_id})
+
+    async def add(self, pairs: Set[str]):
+        self.pairs |= pairs
+        await self._send("SUBSCRIBE", pairs)
+
+    async def remove(self, pairs: Set[str]):
+        self.pairs -= pairs
+        await self._send("UNSUBSCRIBE", pairs)
+
+    async def close(self):
+        """Закрыть соединение (сокет закрывается при отмене задачи)"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        """Держать соединение: переподключение с бэкоффом, переподписка, добор пропуска"""
+        backoff = 1
+        while True:
+            try:
+                async with self.ingestor.session.ws_connect(
+                    f"{self.ingestor.url}/stream", heartbeat=30
+                ) as ws:
+                    self.ws = ws
+                    backoff = 1
+                    await self._send("SUBSCRIBE", self.pairs)
+                    self.connected.set()
+                    if self.reconnects:
+                        # Подписка уже активна - добираем свечи, пропущенные за время разрыва
+                        await self.ingestor.backfill(self.pairs)
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self.ingestor.handle(json.loads(msg.data))
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Stream connection #{self.index} error: {e}")
+            finally:
+                self.ws = None
+                self.connected.clear()
+
+            self.reconnects += 1
+            logger.info(f"Stream connection #{self.index} reconnecting in {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+class StreamIngestor:
+    """Мультиплексирует стримы всех пар по нескольким соединениям и пишет в CANDLES"""
+    def __init__(self, url: str = BINANCE_WS_URL, interval: str = TIMEFRAME,
+                 streams_per_connection: int = WS_STREAMS_PER_CONNECTION):
+        self.url = url
+        self.interval = interval
+        self.streams_per_connection = streams_per_connection
+        self.connections: List[StreamConnection] = []
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.messages = 0
+        self._opened = 0
+
+    @property
+    def pairs(self) -> Set[str]:
+        return {p for conn in self.connections for p in conn.pairs}
+
+    async def start(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+
+    async def stop(self):
+        for conn in self.connections:
+            if conn.task:
+                conn.task.cancel()
+        await asyncio.gather(*(c.task for c in self.connections if c.task), return_exceptions=True)
+        self.connections.clear()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _new_connection(self) -> StreamConnection:
+        self._opened += 1
+        conn = StreamConnection(self, self._opened)
+        self.connections.append(conn)
+        conn.task = asyncio.create_task(conn.run())
+        return conn
+
+    async def sync(self, pairs: Iterable[str]):
+        """Сверить подписки с нужным набором пар (добавить новые, снять лишние)"""
+        await self.start()
+        wanted = {p.upper() for p in pairs}
+
+        for conn in list(self.connections):
+            stale = conn.pairs - wanted
+            if stale and stale == conn.pairs:
+                # Все стримы соединения сняты - держать пустой сокет незачем
+                await conn.close()
+                self.connections.remove(conn)
+                logger.info(f"Stream connection #{conn.index} closed: no streams left")
+            elif stale:
+                await conn.remove(stale)
+
+        added = sorted(wanted - self.pairs)
+        if not added:
+            return
+
+        groups: Dict[StreamConnection, Set[str]] = {}
+        for pair in added:
+            conn = next((c for c in self.connections if c.free_slots - len(groups.get(c, ())) > 0), None)
+            if conn is None:
+                conn = self._new_connection()
+            groups.setdefault(conn, set()).add(pair)
+        for conn, group in groups.items():
+            await conn.add(group)
+
+        logger.info(f"Subscribed {len(added)} pairs, total {len(self.pairs)} on {len(self.connections)} connections")
+        await self.backfill(added)
+
+    async def backfill(self, pairs: Iterable[str], limit: int = HTTP_CONCURRENCY):
+        """Добрать по REST свечи с последней сохранённой (или последние MAX_CANDLES)"""
+        semaphore = asyncio.Semaphore(limit)
+
+        async def fill(pair: str):
+            async with semaphore:
+                last_ts = CANDLES.last_ts(pair)
+                candles = await fetch_klines(
+                    MARKET_DATA.client, pair, self.interval,
+                    start_time=last_ts, limit=1000 if last_ts else MAX_CANDLES
+                )
+            for candle in candles or []:
+                CANDLES.upsert_candle(pair, candle)
+
+        await asyncio.gather(*(fill(p) for p in pairs))
+
+    def handle(self, message: dict):
+        """Обработать сообщение combined-стрима"""
+        data = message.get("data")
+        if not data:
+            return  # ответы на SUBSCRIBE/UNSUBSCRIBE
+        self.messages += 1
+
+        event = data.get("e")
+        if event == "kline":
+            k = data["k"]
+            CANDLES.upsert_candle(k["s"], {
+                "ts": k["t"] // 1000,
+                "o": float(k["o"]),
+                "h": float(k["h"]),
+                "l": float(k["l"]),
+                "c": float(k["c"]),
+                "v": float(k["v"]),
+            })
+        elif event == "24hrMiniTicker":
+            PRICE_CACHE.set(data["s"], float(data["c"]), float(data["v"]))
+
+# Глобальный потоковый приёмник
+INGESTOR = StreamIngestor()